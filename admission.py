@@ -0,0 +1,244 @@
+"""
+Admission Control Module.
+
+Bounds the number of GraphQL operations executing at once, so that a burst of
+traffic (a recruitment deadline, a mass announcement) queues up in front of
+the service instead of piling onto the Mongo pool and outbound HTTP.
+
+Operations beyond the limit wait in a bounded queue, ordered by priority: the
+cheap public reads go first and the `ccApplications` exports last. When the
+queue is full a new operation displaces the lowest priority waiter, if it
+outranks it, and is rejected otherwise; operations that wait for too long are
+rejected as well. Rejected operations are answered right away with a 503 and
+a `Retry-After` header by the router in `router.py`.
+
+Attributes:
+    ADMISSION_MAX_CONCURRENCY (int): Maximum number of operations executing
+                                     at once, 0 disables admission control.
+                                     Defaults to 64.
+    ADMISSION_MAX_QUEUE (int): Maximum number of operations waiting for a
+                               slot. Defaults to 256.
+    ADMISSION_QUEUE_TIMEOUT (float): Seconds an operation may wait for a
+                                     slot. Defaults to 5.
+    ADMISSION_RETRY_AFTER (int): `Retry-After` of rejected operations, in
+                                 seconds. Defaults to 1.
+    DEFAULT_PRIORITY (int): Priority of operations not listed in
+                            `FIELD_PRIORITIES`, lower values go first.
+    FIELD_PRIORITIES (dict): Priority of root fields, an operation gets the
+                             priority of its lowest priority field.
+    admission (AdmissionController): The process-wide admission controller.
+"""
+
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from os import getenv
+
+from metrics import Gauge
+
+ADMISSION_MAX_CONCURRENCY = int(getenv("ADMISSION_MAX_CONCURRENCY", "64"))
+ADMISSION_MAX_QUEUE = int(getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_QUEUE_TIMEOUT = float(getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+ADMISSION_RETRY_AFTER = int(getenv("ADMISSION_RETRY_AFTER", "1"))
+
+DEFAULT_PRIORITY = 1
+FIELD_PRIORITIES = {
+    # public reads, served from caches most of the time
+    "storagefiles": 0,
+    "storagefile": 0,
+    "storagefilesConnection": 0,
+    "haveAppliedForCC": 0,
+    "__typename": 0,
+    # exports scanning a whole recruitment year
+    "ccApplications": 2,
+    "ccApplicationsConnection": 2,
+}
+
+
+class OverloadedError(Exception):
+    """
+    Raised when an operation is not admitted.
+
+    Attributes:
+        retry_after (int): Seconds after which the client may retry.
+    """
+
+    def __init__(self, retry_after: int = ADMISSION_RETRY_AFTER):
+        super().__init__("Server is overloaded, please retry later")
+        self.retry_after = retry_after
+
+
+def operation_priority(fields: frozenset[str]) -> int:
+    """
+    Priority of an operation, lower values are admitted first.
+
+    Args:
+        fields (frozenset[str]): Root fields selected by the operation.
+
+    Returns:
+        (int): The priority of its lowest priority field.
+    """
+    return max(
+        (FIELD_PRIORITIES.get(field, DEFAULT_PRIORITY) for field in fields),
+        default=DEFAULT_PRIORITY,
+    )
+
+
+class AdmissionController:
+    """
+    Concurrency limiter with a bounded, prioritised wait queue.
+
+    A finishing operation hands its slot over directly to the first waiter,
+    so waiters are never overtaken by operations arriving later.
+
+    Attributes:
+        max_concurrency (int): Maximum number of operations executing at once.
+        max_queue (int): Maximum number of waiting operations.
+        queue_timeout (float): Seconds an operation may wait for a slot.
+        active (int): Number of operations executing.
+        rejected (int): Number of operations rejected so far.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.rejected = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    @property
+    def queued(self) -> int:
+        """
+        Number of operations waiting for a slot.
+        """
+        return len(self._waiters)
+
+    @asynccontextmanager
+    async def admit(self, priority: int = DEFAULT_PRIORITY):
+        """
+        Holds an execution slot for the duration of the block.
+
+        Args:
+            priority (int): Priority of the operation, lower values are
+                            admitted first. Defaults to `DEFAULT_PRIORITY`.
+
+        Raises:
+            OverloadedError: If the operation is not admitted.
+        """
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: int = DEFAULT_PRIORITY) -> None:
+        """
+        Waits for an execution slot, to be given back with `release`.
+
+        Prefer `admit`, this is for slots held beyond a single block, like
+        the lifetime of a streamed response.
+
+        Args:
+            priority (int): Priority of the operation, lower values are
+                            admitted first. Defaults to `DEFAULT_PRIORITY`.
+
+        Raises:
+            OverloadedError: If the operation is not admitted.
+        """
+        if not self.enabled:
+            return
+
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            worst = max(self._waiters, default=None)
+            if worst is None or worst[0] <= priority:
+                self._reject()
+            self._remove(worst)
+            worst[2].set_exception(OverloadedError())
+            self.rejected += 1
+
+        waiter = (
+            priority,
+            next(self._counter),
+            asyncio.get_running_loop().create_future(),
+        )
+        heapq.heappush(self._waiters, waiter)
+        try:
+            async with asyncio.timeout(self.queue_timeout):
+                await waiter[2]
+        except (TimeoutError, asyncio.CancelledError) as e:
+            future = waiter[2]
+            if future.done() and not future.cancelled():
+                if future.exception() is not None:
+                    raise future.exception() from None
+                if isinstance(e, TimeoutError):
+                    # the slot was handed over just in time
+                    return
+                self._release()
+                raise
+
+            self._remove(waiter)
+            if isinstance(e, TimeoutError):
+                self._reject()
+            raise
+
+    def release(self) -> None:
+        """
+        Gives back a slot taken with `acquire`.
+        """
+        if self.enabled:
+            self._release()
+
+    def _reject(self) -> None:
+        self.rejected += 1
+        raise OverloadedError()
+
+    def _remove(self, waiter: tuple[int, int, asyncio.Future]) -> None:
+        # a cancelled waiter may already have been skipped by `_release`
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # the slot goes to the waiter, `active` stays the same
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+admission = AdmissionController()
+
+Gauge(
+    "admission_active",
+    "GraphQL operations executing.",
+    lambda: admission.active,
+)
+Gauge(
+    "admission_queued",
+    "GraphQL operations waiting for a slot.",
+    lambda: admission.queued,
+)
+Gauge(
+    "admission_rejected_total",
+    "GraphQL operations rejected by admission control.",
+    lambda: admission.rejected,
+    kind="counter",
+)
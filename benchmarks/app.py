@@ -0,0 +1,25 @@
+"""
+Benchmarked Application.
+
+`main.app` on the in-memory collections of `benchmarks.run`, served by
+`benchmarks.serving` through `serve.py`.
+
+Attributes:
+    BENCHMARK_SIZE (int): Number of CC applications. Defaults to 1000.
+    app (FastAPI): The application.
+"""
+
+import os
+
+# the benchmarked server needs neither Mongo nor the Graph API
+os.environ.setdefault("WARMUP_ENABLED", "False")
+os.environ.setdefault("MONGO_ENSURE_INDEXES", "False")
+
+from benchmarks.run import install  # noqa: E402
+from main import app  # noqa: E402
+
+BENCHMARK_SIZE = int(os.getenv("BENCHMARK_SIZE", "1000"))
+
+install(BENCHMARK_SIZE)
+
+__all__ = ["app"]
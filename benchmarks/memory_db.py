@@ -0,0 +1,220 @@
+"""
+In-memory Collection Stand-in.
+
+A small, dependency free stand-in for the subset of
+`pymongo.asynchronous.collection.AsyncCollection` used by the resolvers, so
+that benchmarks run offline.
+
+Every document returned goes through a BSON encode and decode, to account
+for the cost Mongo documents have on the wire; projections are applied
+before that, as the server would. Filters scan all documents, like a
+collection scan, and support equality, `$in`, `$gt`, `$gte`, `$lt`, `$lte`,
+`$exists` and `$or`; updates only support `$set`.
+"""
+
+from typing import Any
+
+import bson
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+
+def _compare(value: Any, operator: str, argument: Any) -> bool:
+    if value is _MISSING or value is None:
+        return False
+    if operator == "$gt":
+        return value > argument
+    if operator == "$gte":
+        return value >= argument
+    if operator == "$lt":
+        return value < argument
+    return value <= argument
+
+
+def _equals(value: Any, argument: Any) -> bool:
+    if isinstance(value, list) and not isinstance(argument, list):
+        return argument in value
+    return value == argument
+
+
+def matches(document: dict, query: dict) -> bool:
+    """
+    Whether a document matches a Mongo filter.
+    """
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+            continue
+
+        value = document.get(key, _MISSING)
+        if isinstance(condition, dict) and any(
+            operator.startswith("$") for operator in condition
+        ):
+            for operator, argument in condition.items():
+                if operator == "$in":
+                    if not any(
+                        (item is None and value in (None, _MISSING))
+                        or (value is not _MISSING and _equals(value, item))
+                        for item in argument
+                    ):
+                        return False
+                elif operator == "$exists":
+                    if (value is not _MISSING) != argument:
+                        return False
+                elif not _compare(value, operator, argument):
+                    return False
+        elif value is _MISSING:
+            if condition is not None:
+                return False
+        elif not _equals(value, condition):
+            return False
+    return True
+
+
+def _wire(document: dict, projection: dict | None) -> dict:
+    if projection:
+        document = {
+            key: value
+            for key, value in document.items()
+            if key == "_id" or projection.get(key)
+        }
+    return bson.decode(bson.encode(document))
+
+
+class MemoryCursor:
+    """
+    Stand-in for `AsyncCursor`.
+    """
+
+    def __init__(self, documents: list[dict], projection: dict | None):
+        self._documents = documents
+        self._projection = projection
+        self._iterator = None
+
+    def sort(self, key, direction: int = 1) -> "MemoryCursor":
+        keys = [(key, direction)] if isinstance(key, str) else key
+        for field, order in reversed(keys):
+            self._documents.sort(
+                key=lambda document: (
+                    document.get(field) is not None,
+                    document.get(field),
+                ),
+                reverse=order == -1,
+            )
+        return self
+
+    def limit(self, count: int) -> "MemoryCursor":
+        if count:
+            self._documents = self._documents[:count]
+        return self
+
+    def batch_size(self, size: int) -> "MemoryCursor":
+        return self
+
+    async def close(self) -> None:
+        self._iterator = None
+
+    async def to_list(self, length: int | None = None) -> list[dict]:
+        return [
+            _wire(document, self._projection)
+            for document in self._documents[:length]
+        ]
+
+    def __aiter__(self) -> "MemoryCursor":
+        self._iterator = iter(self._documents)
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return _wire(next(self._iterator), self._projection)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class InsertResult:
+    def __init__(self, inserted_id: Any):
+        self.inserted_id = inserted_id
+
+
+class MemoryCollection:
+    """
+    Stand-in for `AsyncCollection`, holding its documents in a list.
+
+    Attributes:
+        name (str): Name of the collection.
+        documents (List[dict]): Its documents.
+        unique (List[tuple]): Field combinations that must be unique, like
+                              unique indexes. Defaults to none.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documents: list[dict] | None = None,
+        unique: list[tuple[str, ...]] | None = None,
+    ):
+        self.name = name
+        self.documents = list(documents or [])
+        self.unique = unique or []
+        self._keys = {
+            fields: {
+                self._key(document, fields) for document in self.documents
+            }
+            for fields in self.unique
+        }
+
+    @staticmethod
+    def _key(document: dict, fields: tuple[str, ...]) -> tuple:
+        return tuple(document.get(field) for field in fields)
+
+    def find(
+        self, query: dict | None = None, projection: dict | None = None, **_
+    ) -> MemoryCursor:
+        return MemoryCursor(
+            [
+                document
+                for document in self.documents
+                if matches(document, query or {})
+            ],
+            projection,
+        )
+
+    async def find_one(
+        self, query: dict | None = None, projection: dict | None = None, **_
+    ) -> dict | None:
+        for document in self.documents:
+            if matches(document, query or {}):
+                return _wire(document, projection)
+        return None
+
+    async def count_documents(self, query: dict, **_) -> int:
+        return sum(matches(document, query) for document in self.documents)
+
+    async def insert_one(self, document: dict, **_) -> InsertResult:
+        document.setdefault("_id", str(bson.ObjectId()))
+        for fields, keys in self._keys.items():
+            key = self._key(document, fields)
+            if key in keys:
+                raise DuplicateKeyError(f"duplicate key {fields}: {key}")
+        for fields, keys in self._keys.items():
+            keys.add(self._key(document, fields))
+        self.documents.append(document)
+        return InsertResult(document["_id"])
+
+    async def insert_many(self, documents: list[dict], **_) -> None:
+        for document in documents:
+            await self.insert_one(document)
+
+    async def find_one_and_update(
+        self, query: dict, update: dict, **_
+    ) -> dict | None:
+        """
+        Applies the `$set` of an update to the first matching document.
+        """
+        for document in self.documents:
+            if matches(document, query):
+                document.update(update.get("$set", {}))
+                return _wire(document, None)
+        return None
@@ -0,0 +1,401 @@
+"""
+Benchmark Suite.
+
+Measures the hot paths of `queries.py` and `mutations.py` offline, against
+in-memory stand-ins of `ccdb`, `docsstoragedb` and `mailoutboxdb` (see
+`memory_db.py`), along with the model costs behind them. Resolvers are run
+through `main.schema`, so GraphQL parsing and serialization are included.
+
+Results are written as JSON, one entry per benchmark and data size, with keys
+in a stable order so that two runs can be diffed, or compared with
+`--compare`.
+
+Usage, from the repository root:
+
+    python -m benchmarks.run --sizes 100,1000,10000 --output bench.json
+    python -m benchmarks.run --compare bench.json --output new.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+
+import cache
+import main
+import mutations
+import outbox
+import projections
+import queries
+from benchmarks.memory_db import MemoryCollection
+from models import CCRecruitment, Mails
+from otypes import CCRecruitmentType, Context
+
+YEAR = 2025
+ESSAY = "I would like to contribute to the clubs council. " * 10
+
+
+def application(index: int, year: int = YEAR) -> dict:
+    """
+    A stored CC application, as written by `ccApply`.
+    """
+    return {
+        "_id": f"{index:024x}",
+        "uid": f"applicant{index}",
+        "email": f"applicant{index}@students.iiit.ac.in",
+        "teams": ["design", "finance"][: 1 + index % 2],
+        "design_experience": None,
+        "why_this_position": ESSAY,
+        "why_cc": ESSAY,
+        "ideas1": ESSAY,
+        "ideas": ESSAY,
+        "other_bodies": None,
+        "good_fit": ESSAY,
+        "sent_time": "2025-01-01T10:00:00+00:00",
+        "apply_year": year,
+    }
+
+
+def storage_file(index: int) -> dict:
+    """
+    A stored storage file, as written by `createStorageFile`.
+    """
+    return {
+        "_id": f"{index:024x}",
+        "title": f"Minutes of meeting {index}",
+        "filename": f"minutes_{index}",
+        "filetype": "pdf",
+        "latest_version": 1 + index % 3,
+        "modified_time": f"2025-{1 + index % 12:02d}-01 10:00:00",
+        "creation_time": "2024-01-01 10:00:00",
+    }
+
+
+def mail() -> dict:
+    return {
+        "subject": "Application received",
+        "body": ESSAY,
+        "to_recipients": ["applicant@students.iiit.ac.in"],
+        "cc_recipients": [],
+        "uid": "applicant",
+        "html_body": False,
+    }
+
+
+class _Request:
+    def __init__(self, user: dict):
+        self.headers = {"user": json.dumps(user)}
+
+
+def context(role: str, uid: str = "benchmark") -> Context:
+    """
+    A request context of a logged in user.
+    """
+    value = Context()
+    value.request = _Request({"uid": uid, "role": role})
+    return value
+
+
+def install(size: int) -> None:
+    """
+    Replaces the collections used by the resolvers with in-memory ones.
+
+    Args:
+        size (int): Number of CC applications; there are a tenth as many
+                    storage files.
+    """
+    ccdb = MemoryCollection(
+        "cc",
+        [application(index) for index in range(size)],
+        unique=[("email", "apply_year")],
+    )
+    docsstoragedb = MemoryCollection(
+        "docsstorage",
+        [storage_file(index) for index in range(max(size // 10, 10))],
+    )
+    queries.ccdb = mutations.ccdb_majority = ccdb
+    queries.docsstorage_reads = queries.docsstoragedb = docsstoragedb
+    outbox.mailoutboxdb = MemoryCollection("mailoutbox")
+    cache.invalidate_storagefile()
+
+
+async def execute(query: str, role: str, **variables) -> None:
+    result = await main.schema.execute(
+        query, variable_values=variables, context_value=context(role)
+    )
+    if result.errors:
+        raise RuntimeError(result.errors[0])
+
+
+CC_APPLICATIONS_FULL = """
+query ($year: Int!) {
+  ccApplications(year: $year) {
+    _id uid email teams designExperience whyThisPosition whyCc ideas1
+    ideas otherBodies goodFit sentTime applyYear
+  }
+}
+"""
+CC_APPLICATIONS_TABLE = """
+query ($year: Int!) { ccApplications(year: $year) { uid email teams } }
+"""
+CC_APPLICATIONS_PAGE = """
+query ($year: Int!) {
+  ccApplicationsConnection(year: $year, first: 50) {
+    edges { cursor node { uid email teams } }
+    pageInfo { hasNextPage endCursor }
+  }
+}
+"""
+HAVE_APPLIED = """
+query ($year: Int!) { haveAppliedForCC(year: $year) }
+"""
+STORAGEFILES = """
+{ storagefiles(filetype: "pdf") { _id title filename modifiedTime } }
+"""
+STORAGEFILES_PAGE = """
+{
+  storagefilesConnection(filetype: "pdf", first: 20) {
+    edges { node { _id title modifiedTime } }
+    pageInfo { hasNextPage endCursor }
+  }
+}
+"""
+CC_APPLY = """
+mutation ($input: CCRecruitmentInput!) { ccApply(ccRecruitmentInput: $input) }
+"""
+
+
+def _apply_input(index: int) -> dict:
+    return {
+        "uid": f"new{index}",
+        "email": f"new{index}@students.iiit.ac.in",
+        "teams": ["Design"],
+        "whyThisPosition": ESSAY,
+        "whyCc": ESSAY,
+        "ideas1": ESSAY,
+        "ideas": ESSAY,
+        "goodFit": ESSAY,
+    }
+
+
+async def _fast_path(query: str) -> None:
+    projections.READ_FAST_PATH = True
+    try:
+        await execute(query, "cc", year=YEAR)
+    finally:
+        projections.READ_FAST_PATH = False
+
+
+async def _uncached(query: str) -> None:
+    ttl = cache.storagefiles_cache.ttl
+    cache.storagefiles_cache.ttl = 0
+    try:
+        await execute(query, "public")
+    finally:
+        cache.storagefiles_cache.ttl = ttl
+
+
+_apply_counter = iter(range(10**9))
+
+
+def resolver_benchmarks() -> dict[str, Callable[[], Awaitable]]:
+    """
+    Resolver benchmarks, by name; they depend on the installed data size.
+    """
+    return {
+        "ccApplications.all_fields": lambda: execute(
+            CC_APPLICATIONS_FULL, "cc", year=YEAR
+        ),
+        "ccApplications.table_fields": lambda: execute(
+            CC_APPLICATIONS_TABLE, "cc", year=YEAR
+        ),
+        "ccApplications.all_fields.fast_path": lambda: _fast_path(
+            CC_APPLICATIONS_FULL
+        ),
+        "ccApplicationsConnection.first_50": lambda: execute(
+            CC_APPLICATIONS_PAGE, "cc", year=YEAR
+        ),
+        "haveAppliedForCC": lambda: execute(HAVE_APPLIED, "public", year=YEAR),
+        "storagefiles.cached": lambda: execute(STORAGEFILES, "public"),
+        "storagefiles.uncached": lambda: _uncached(STORAGEFILES),
+        "storagefilesConnection.first_20": lambda: execute(
+            STORAGEFILES_PAGE, "public"
+        ),
+        "ccApply": lambda: execute(
+            CC_APPLY, "public", input=_apply_input(next(_apply_counter))
+        ),
+    }
+
+
+def model_benchmarks() -> dict[str, Callable[[], object]]:
+    """
+    Model benchmarks, by name; every call handles a single document.
+    """
+    document = application(0)
+    model = CCRecruitment.model_validate(document)
+    mail_document = mail()
+    return {
+        "CCRecruitment.model_validate": lambda: CCRecruitment.model_validate(
+            document
+        ),
+        "Mails.model_validate": lambda: Mails.model_validate(mail_document),
+        "jsonable_encoder.CCRecruitment": lambda: jsonable_encoder(model),
+        "CCRecruitmentType.from_pydantic": lambda: (
+            CCRecruitmentType.from_pydantic(model)
+        ),
+    }
+
+
+def summarize(name: str, size: int | None, timings: list[float]) -> dict:
+    """
+    Latency statistics of a benchmark, in milliseconds.
+    """
+    timings = sorted(timings)
+    mean = statistics.fmean(timings)
+    return {
+        "name": name,
+        "size": size,
+        "iterations": len(timings),
+        "mean_ms": round(mean * 1e3, 4),
+        "p50_ms": round(timings[len(timings) // 2] * 1e3, 4),
+        "p95_ms": round(timings[int(len(timings) * 0.95)] * 1e3, 4),
+        "min_ms": round(timings[0] * 1e3, 4),
+        "ops_per_sec": round(1 / mean, 2) if mean else None,
+    }
+
+
+async def run_resolvers(size: int, repeat: int, only: str | None) -> list:
+    install(size)
+    # keep the total work per benchmark roughly constant across sizes
+    iterations = max(3, min(repeat, repeat * 1000 // size))
+    results = []
+    for name, benchmark in resolver_benchmarks().items():
+        if only and only not in name:
+            continue
+        await benchmark()  # warm up caches and code paths
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await benchmark()
+            timings.append(time.perf_counter() - start)
+        results.append(summarize(name, size, timings))
+    return results
+
+
+def run_models(repeat: int, only: str | None) -> list:
+    results = []
+    for name, benchmark in model_benchmarks().items():
+        if only and only not in name:
+            continue
+        timings = []
+        for _ in range(repeat * 100):
+            start = time.perf_counter()
+            benchmark()
+            timings.append(time.perf_counter() - start)
+        results.append(summarize(name, None, timings))
+    return results
+
+
+def _revision() -> str | None:
+    try:
+        process = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return process.stdout.strip() or None
+
+
+def table(report: dict) -> list[str]:
+    """
+    Lines summarizing the results of a run, for humans.
+    """
+    lines = [f"{'benchmark':<40} {'size':>7} {'mean ms':>10} {'p95 ms':>10}"]
+    for result in report["results"]:
+        lines.append(
+            f"{result['name']:<40} {str(result['size']):>7} "
+            f"{result['mean_ms']:>10.3f} {result['p95_ms']:>10.3f}"
+        )
+    return lines
+
+
+def compare(previous: dict, current: dict) -> list[str]:
+    """
+    Lines comparing the mean latency of two runs, benchmark by benchmark.
+    """
+    before = {
+        (result["name"], result["size"]): result["mean_ms"]
+        for result in previous["results"]
+    }
+    lines = []
+    for result in current["results"]:
+        old = before.get((result["name"], result["size"]))
+        if not old:
+            continue
+        lines.append(
+            f"{result['name']:<40} {str(result['size']):>7} "
+            f"{old:>10.3f} -> {result['mean_ms']:>10.3f} ms "
+            f"({result['mean_ms'] / old:.2f}x)"
+        )
+    return lines
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = run_models(args.repeat, args.only)
+    for size in args.sizes:
+        results += await run_resolvers(size, args.repeat, args.only)
+    return {
+        "meta": {
+            "revision": _revision(),
+            "python": platform.python_version(),
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[100, 1000, 10000],
+        help="comma separated numbers of CC applications, e.g. 100,100000",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="iterations per benchmark"
+    )
+    parser.add_argument("--only", help="run benchmarks with this in the name")
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--compare", help="results of a previous run")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as file:
+            lines = compare(json.load(file), report)
+    else:
+        lines = table(report)
+    print("\n".join(lines), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_cli()
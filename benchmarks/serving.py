@@ -0,0 +1,205 @@
+"""
+Serving Throughput Benchmark.
+
+Measures how the throughput of `serve.py` scales with its number of worker
+processes. For every worker count a server is started on the in-memory
+collections of `benchmarks.run`, and loaded over HTTP by several client
+processes for a fixed time; the client processes keep the load generator
+from being the bottleneck, but share the machine with the workers, so run
+it with more cores than workers.
+
+Results are written as JSON, like `benchmarks.run`.
+
+Usage, from the repository root:
+
+    python -m benchmarks.serving --workers 1,2,4 --output serving.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import httpx
+
+YEAR = 2025
+
+WORKLOADS = {
+    "storagefiles": (
+        {"uid": "benchmark", "role": "public"},
+        {"query": '{ storagefiles(filetype: "pdf") { _id title } }'},
+    ),
+    "ccApplicationsConnection": (
+        {"uid": "benchmark", "role": "cc"},
+        {
+            "query": (
+                "query ($year: Int!) { ccApplicationsConnection(year: $year,"
+                " first: 50) { edges { node { uid email teams } } } }"
+            ),
+            "variables": {"year": YEAR},
+        },
+    ),
+}
+
+
+async def _load(
+    url: str, workload: str, connections: int, duration: float
+) -> tuple[list[float], int]:
+    user, body = WORKLOADS[workload]
+    headers = {"user": json.dumps(user)}
+    timings = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def connection(client: httpx.AsyncClient) -> None:
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json=body, headers=headers)
+                ok = response.status_code == 200 and (
+                    "errors" not in response.json()
+                )
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                timings.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=connections)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        await asyncio.gather(*(connection(client) for _ in range(connections)))
+    return timings, errors
+
+
+def load(arguments: tuple) -> tuple[list[float], int]:
+    """
+    Loads the server from a client process.
+    """
+    return asyncio.run(_load(*arguments))
+
+
+def _wait_until_ready(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not become ready")
+
+
+def measure(workers: int, args: argparse.Namespace) -> dict:
+    """
+    Starts a server with the given number of workers and loads it.
+    """
+    base = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "serve.py",
+            "--app",
+            "benchmarks.app:app",
+            "--port",
+            str(args.port),
+            "--workers",
+            str(workers),
+        ],
+        env=os.environ | {"BENCHMARK_SIZE": str(args.size)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_until_ready(f"{base}/ready")
+        per_client = max(1, args.connections // args.clients)
+        with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+            outcomes = pool.map(
+                load,
+                [
+                    (
+                        f"{base}/graphql",
+                        args.workload,
+                        per_client,
+                        args.duration,
+                    )
+                ]
+                * args.clients,
+            )
+    finally:
+        server.terminate()
+        server.wait()
+
+    timings = sorted(t for client, _ in outcomes for t in client)
+    errors = sum(errors for _, errors in outcomes)
+
+    def percentile(fraction: float) -> float | None:
+        if not timings:
+            return None
+        return round(timings[int(len(timings) * fraction)] * 1e3, 2)
+
+    return {
+        "workload": args.workload,
+        "workers": workers,
+        "connections": per_client * args.clients,
+        "duration_s": args.duration,
+        "requests": len(timings),
+        "errors": errors,
+        "requests_per_sec": round(len(timings) / args.duration, 1),
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+    }
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--workers",
+        type=lambda value: [int(count) for count in value.split(",")],
+        default=[1, 2, 4],
+        help="comma separated worker counts",
+    )
+    parser.add_argument(
+        "--workload", choices=sorted(WORKLOADS), default="storagefiles"
+    )
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="file to write the results to")
+    args = parser.parse_args()
+
+    results = [measure(workers, args) for workers in args.workers]
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "size": args.size,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    for result in results:
+        print(
+            f"{result['workers']:>3} workers {result['requests_per_sec']:>10}"
+            f" req/s  p95 {result['p95_ms']} ms  errors {result['errors']}",
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
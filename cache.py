@@ -0,0 +1,298 @@
+"""
+In-process Caches Module.
+
+Storage files are read on every page view of the documents section but only
+change a few times a month, so `storagefiles` and `storagefile` are served
+from small TTL caches kept in memory. The storage file mutations invalidate
+exactly the entries they affect; with several replicas, an optional Mongo
+change stream listener invalidates entries changed by other replicas, and
+the TTL bounds staleness otherwise.
+
+Public storage file reads may be served by replica set secondaries (see
+`db.MONGO_PUBLIC_READ_PREFERENCE`), which can lag behind a write. A value
+read from a lagging secondary right after an invalidation would be cached
+for the whole TTL, so for `STORAGEFILES_PRIMARY_READ_WINDOW` seconds after
+an invalidation the caches are filled from the primary instead.
+
+Parsed and validated GraphQL documents are kept in the LRU caches of
+Strawberry, see `extensions.py`; they register in `lru_caches` to be
+reported along with the caches here.
+
+Attributes:
+    STORAGEFILES_CACHE_TTL (float): Seconds an entry is served for, 0
+                                    disables caching. Defaults to 300.
+    STORAGEFILES_CACHE_SIZE (int): Maximum number of entries per cache.
+                                   Defaults to 256.
+    STORAGEFILES_CHANGE_STREAM (bool): Whether to listen to the Mongo change
+                                       stream of storage files. Defaults to
+                                       False.
+    STORAGEFILES_PRIMARY_READ_WINDOW (float): Seconds after an invalidation
+                                              during which entries are read
+                                              from the primary, should cover
+                                              the replication lag. Defaults
+                                              to 30.
+    storagefiles_cache (TTLCache): Storage files lists, by filetype.
+    storagefile_cache (TTLCache): Single storage files, by id.
+    lru_caches (dict): Functions wrapped by `functools.lru_cache` whose
+                       lookups are reported, by name.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from os import getenv
+from typing import Any
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from db import docsstoragedb
+from metrics import Gauge
+from shared import SharedCounter, shared_counter
+
+STORAGEFILES_CACHE_TTL = float(getenv("STORAGEFILES_CACHE_TTL", "300"))
+STORAGEFILES_CACHE_SIZE = int(getenv("STORAGEFILES_CACHE_SIZE", "256"))
+STORAGEFILES_CHANGE_STREAM = getenv(
+    "STORAGEFILES_CHANGE_STREAM", "False"
+).lower() in ("true", "1", "t")
+STORAGEFILES_PRIMARY_READ_WINDOW = float(
+    getenv("STORAGEFILES_PRIMARY_READ_WINDOW", "30")
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    Size-bounded mapping whose entries expire after a fixed time.
+
+    The least recently used entry is evicted when the cache is full. Every
+    invalidation bumps `generation`; a value loaded from the database is
+    only stored if no invalidation happened since the load started, so a
+    slow read can never put back data that a concurrent write invalidated.
+
+    With a shared counter, invalidations are also counted across the
+    worker processes of `serve.py`; a worker seeing the counter move drops
+    all of its entries.
+
+    Attributes:
+        ttl (float): Seconds an entry is served for.
+        maxsize (int): Maximum number of entries.
+        shared (SharedCounter | None): Invalidations of every worker process,
+                                       None if the cache is not shared.
+        generation (int): Number of invalidations so far.
+        invalidated_time (float): `time.monotonic()` of the last
+                                  invalidation seen, -inf if none.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups not served from the cache.
+    """
+
+    def __init__(
+        self, ttl: float, maxsize: int, shared: SharedCounter | None = None
+    ):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.shared = shared
+        self._shared_seen = shared.value if shared is not None else 0
+        self.generation = 0
+        self.invalidated_time = float("-inf")
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.maxsize > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _sync(self) -> None:
+        # drop everything another worker may have invalidated
+        if self.shared is not None and self.shared.value != self._shared_seen:
+            self._shared_seen = self.shared.value
+            self.generation += 1
+            self.invalidated_time = time.monotonic()
+            self._entries.clear()
+
+    def _invalidated(self) -> None:
+        self.generation += 1
+        self.invalidated_time = time.monotonic()
+        if self.shared is not None:
+            value = self.shared.increment()
+            if value != self._shared_seen + 1:
+                # another worker invalidated since we last looked
+                self._entries.clear()
+            self._shared_seen = value
+
+    def invalidated_within(self, seconds: float) -> bool:
+        """
+        Whether the cache was invalidated in the last `seconds` seconds.
+        """
+        self._sync()
+        return time.monotonic() - self.invalidated_time < seconds
+
+    def get(self, key: Any) -> Any | None:
+        """
+        Returns the cached value of a key, None if absent or expired, or
+        if the cache is disabled.
+        """
+        if not self.enabled:
+            self.misses += 1
+            return None
+        self._sync()
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Any, value: Any, generation: int | None = None):
+        """
+        Stores a value, unless the cache was invalidated since `generation`.
+
+        Args:
+            key (Any): The key.
+            value (Any): The value, None values are not stored.
+            generation (int | None): `generation` read before the value was
+                                     loaded. Defaults to None.
+        """
+        if not self.enabled or value is None:
+            return
+        self._sync()
+        if generation is not None and generation != self.generation:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Any) -> None:
+        """
+        Drops the entry of a key.
+        """
+        self._invalidated()
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Drops every entry.
+        """
+        self._invalidated()
+        self._entries.clear()
+
+
+storagefiles_cache = TTLCache(
+    STORAGEFILES_CACHE_TTL,
+    STORAGEFILES_CACHE_SIZE,
+    shared_counter("storagefiles_cache"),
+)
+storagefile_cache = TTLCache(
+    STORAGEFILES_CACHE_TTL,
+    STORAGEFILES_CACHE_SIZE,
+    shared_counter("storagefile_cache"),
+)
+lru_caches: dict[str, Callable] = {}
+
+_caches = {
+    "storagefiles": storagefiles_cache,
+    "storagefile": storagefile_cache,
+}
+
+
+def _lookups() -> dict[tuple, int]:
+    lookups = {}
+    for name, cache in _caches.items():
+        lookups[(name, "hits")] = cache.hits
+        lookups[(name, "misses")] = cache.misses
+    for name, function in lru_caches.items():
+        info = function.cache_info()
+        lookups[(name, "hits")] = info.hits
+        lookups[(name, "misses")] = info.misses
+    return lookups
+
+
+def _entries() -> dict[tuple, int]:
+    entries = {(name,): len(cache) for name, cache in _caches.items()}
+    for name, function in lru_caches.items():
+        entries[(name,)] = function.cache_info().currsize
+    return entries
+
+
+Gauge(
+    "cache_lookups_total",
+    "Lookups of the in-process caches, by result.",
+    _lookups,
+    ("cache", "result"),
+    kind="counter",
+)
+Gauge(
+    "cache_entries",
+    "Entries of the in-process caches.",
+    _entries,
+    ("cache",),
+)
+
+
+def invalidate_storagefile(
+    file_id: str | None = None, filetype: str | None = None
+) -> None:
+    """
+    Drops the cached entries a change to a storage file affects.
+
+    Args:
+        file_id (str | None): Id of the changed file, every file is dropped
+                              if not known. Defaults to None.
+        filetype (str | None): Type of the changed file, every list is
+                               dropped if not known. Defaults to None.
+    """
+    if file_id is not None:
+        storagefile_cache.invalidate(file_id)
+    elif filetype is None:
+        storagefile_cache.clear()
+
+    if filetype is not None:
+        storagefiles_cache.invalidate(filetype)
+    else:
+        storagefiles_cache.clear()
+
+
+async def watch_storagefiles() -> None:
+    """
+    Invalidates cached storage files changed by any replica.
+
+    Listens to the change stream of the storage files collection until
+    cancelled, resuming after transient errors. Change streams need a
+    replica set; on a standalone server the listener logs and stops.
+    """
+    resume_token = None
+    while True:
+        try:
+            async with await docsstoragedb.watch(
+                resume_after=resume_token
+            ) as stream:
+                # anything may have changed while we were not listening
+                invalidate_storagefile()
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    key = change.get("documentKey", {}).get("_id")
+                    invalidate_storagefile(
+                        str(key) if key is not None else None
+                    )
+        except OperationFailure as e:
+            if resume_token is not None:
+                # e.g. the resume point fell out of the oplog, start afresh
+                resume_token = None
+                continue
+            logger.error("Storage files change stream unavailable: %s", e)
+            return
+        except PyMongoError as e:
+            logger.warning("Storage files change stream interrupted: %s", e)
+            await asyncio.sleep(1)
@@ -11,30 +11,127 @@ Attributes:
     MONGO_PORT (str): MongoDB port. Defaults to "27017".
     MONGO_URI (str): MongoDB URI.
     MONGO_DATABASE (str): MongoDB database name.
+    MONGO_MAX_POOL_SIZE (int): Maximum number of connections per server.
+                               Defaults to 100.
+    MONGO_MIN_POOL_SIZE (int): Number of connections per server kept open
+                               even when idle. Defaults to 0.
+    MONGO_MAX_IDLE_TIME_MS (int | None): Milliseconds a connection may stay
+                                         idle in the pool before it is
+                                         closed. Defaults to None, never.
+    MONGO_COMPRESSORS (str): Comma separated wire compressors, in order of
+                             preference, e.g. "zstd,snappy,zlib".
+                             Compressors whose library is not installed
+                             are skipped with a warning. Defaults to none.
+    MONGO_SERVER_SELECTION_TIMEOUT_MS (int): Milliseconds to wait for a
+                                             suitable server. Defaults to
+                                             30000.
+    MONGO_CONNECT_TIMEOUT_MS (int): Milliseconds to wait for a connection
+                                    to open. Defaults to 20000.
+    MONGO_MAX_TIME_MS (int | None): Default server-side time limit, in
+                                    milliseconds, of the queries serving
+                                    GraphQL reads. Defaults to None, no
+                                    limit.
+    MONGO_PUBLIC_READ_PREFERENCE (str): Read preference of the public reads,
+                                        like `storagefiles`, e.g.
+                                        "secondaryPreferred" to serve them
+                                        from replica set secondaries.
+                                        Defaults to "primary".
+    MONGO_MAX_STALENESS_SECONDS (int): Maximum replication lag, in seconds,
+                                       of a secondary serving public reads,
+                                       -1 for no limit. Defaults to -1.
     client (pymongo.AsyncMongoClient): MongoDB client.
     db (pymongo.asynchronous.database.AsyncDatabase): MongoDB database.
     ccdb (pymongo.asynchronous.collection.AsyncCollection): MongoDB Clubs
                                                         Council collection.
     docsstoragedb (pymongo.asynchronous.collection.AsyncCollection): MongoDB
                                                          documents collection.
+    mailoutboxdb (pymongo.asynchronous.collection.AsyncCollection): MongoDB
+                                                    outgoing mails collection.
+    ccdigestdb (pymongo.asynchronous.collection.AsyncCollection): MongoDB
+                                    CC applications waiting for a digest.
+    migrationsdb (pymongo.asynchronous.collection.AsyncCollection): MongoDB
+                                      data migrations that ran, or are running.
+    docsstorage_reads (pymongo.asynchronous.collection.AsyncCollection):
+        `docsstoragedb` with the read preference of public reads.
+    ccdb_majority (pymongo.asynchronous.collection.AsyncCollection): `ccdb`
+        acknowledging writes once a majority of the replica set has them.
+    TITLE_COLLATION (pymongo.collation.Collation): Case-insensitive collation
+                                                  of storage file titles.
 """
 
 from os import getenv
 
-from pymongo import AsyncMongoClient
+from pymongo import AsyncMongoClient, WriteConcern
+from pymongo.collation import Collation, CollationStrength
+from pymongo.read_preferences import (
+    make_read_preference,
+    read_pref_mode_from_name,
+)
+
+from metrics import METRICS_ENABLED, MongoCommandMetrics
 
 # get mongodb URI and database name from environment variale
 MONGO_URI = "mongodb://{}:{}@mongo:{}/".format(
     getenv("MONGO_USERNAME", default="username"),
     getenv("MONGO_PASSWORD", default="password"),
-    getenv("MONGO_PORT", default="27107"),
+    getenv("MONGO_PORT", default="27017"),
 )
 MONGO_DATABASE = getenv("MONGO_DATABASE", default="default")
 
+
+def _optional_int(name: str) -> int | None:
+    value = getenv(name)
+    return int(value) if value else None
+
+
+# connection pool, compression and timeouts
+MONGO_MAX_POOL_SIZE = int(getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = _optional_int("MONGO_MAX_IDLE_TIME_MS")
+MONGO_COMPRESSORS = getenv("MONGO_COMPRESSORS", "")
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000")
+)
+MONGO_CONNECT_TIMEOUT_MS = int(getenv("MONGO_CONNECT_TIMEOUT_MS", "20000"))
+MONGO_MAX_TIME_MS = _optional_int("MONGO_MAX_TIME_MS")
+
+# where public reads are served from
+MONGO_PUBLIC_READ_PREFERENCE = getenv(
+    "MONGO_PUBLIC_READ_PREFERENCE", "primary"
+)
+MONGO_MAX_STALENESS_SECONDS = int(getenv("MONGO_MAX_STALENESS_SECONDS", "-1"))
+
 # instantiate mongo client
-client = AsyncMongoClient(MONGO_URI)
+client = AsyncMongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    event_listeners=[MongoCommandMetrics()] if METRICS_ENABLED else [],
+    **({"compressors": MONGO_COMPRESSORS} if MONGO_COMPRESSORS else {}),
+)
 
 # get database
 db = client[MONGO_DATABASE]
 ccdb = db.cc
 docsstoragedb = db.docsstorage
+mailoutboxdb = db.mailoutbox
+ccdigestdb = db.ccdigest
+migrationsdb = db.migrations
+
+# storage files are public, so slightly stale reads are fine; cache fills
+# right after a write read from the primary instead, see `cache.py`
+docsstorage_reads = docsstoragedb.with_options(
+    read_preference=make_read_preference(
+        read_pref_mode_from_name(MONGO_PUBLIC_READ_PREFERENCE),
+        None,
+        MONGO_MAX_STALENESS_SECONDS,
+    )
+)
+# a submitted application must survive a primary failover
+ccdb_majority = ccdb.with_options(write_concern=WriteConcern("majority"))
+
+# titles differing only in case are considered equal
+TITLE_COLLATION = Collation(locale="en", strength=CollationStrength.SECONDARY)
@@ -0,0 +1,286 @@
+"""
+CC Application Digest Module.
+
+Every `ccApply` mails the full application to the CC mailbox. Close to a
+deadline that is hundreds of Graph sends to a single mailbox, which Graph
+throttles per mailbox. In digest mode `ccApply` only records the new
+application in the `ccdigest` collection, and a flusher sends CC one mail
+summarizing many applications: once the oldest recorded application has
+waited `CC_DIGEST_INTERVAL`, or as soon as `CC_DIGEST_MAX_APPLICATIONS`
+are waiting. Applicants still get their confirmation right away.
+
+Digests are queued in the mail outbox like any other mail. The flusher
+claims the applications of a digest by stamping them with the id of its
+outbox mail, so flushers of several processes never list an application
+twice; a claim left behind by a crashed process is released, or dropped if
+its mail was queued, once it is older than the outbox lease.
+
+Attributes:
+    CC_DIGEST_ENABLED (bool): Whether CC gets digests instead of one mail
+                              per application. Defaults to False.
+    CC_DIGEST_INTERVAL (float): Seconds an application waits for a digest
+                                at most. Defaults to 900.
+    CC_DIGEST_MAX_APPLICATIONS (int): Applications after which a digest is
+                                      sent right away, and the most one
+                                      digest lists, at least 1. Defaults
+                                      to 25.
+    CC_MAILBOX (str): Address the CC mails go to.
+    cc_digest (CCDigest): The process-wide digest flusher.
+"""
+
+import asyncio
+import logging
+from datetime import timedelta
+from os import getenv
+
+from bson import ObjectId
+
+from db import ccdb, ccdigestdb, mailoutboxdb
+from mailing_templates import (
+    CC_DIGEST_APPLICATION,
+    CC_DIGEST_BODY,
+    CC_DIGEST_SUBJECT,
+)
+from metrics import Counter
+from models import CCRecruitment, OutboxMail
+from outbox import OUTBOX_LEASE, enqueue_mails
+from utils import get_utc_time
+
+CC_DIGEST_ENABLED = getenv("CC_DIGEST_ENABLED", "False").lower() in (
+    "true",
+    "1",
+    "t",
+)
+CC_DIGEST_INTERVAL = float(getenv("CC_DIGEST_INTERVAL", "900"))
+CC_DIGEST_MAX_APPLICATIONS = int(getenv("CC_DIGEST_MAX_APPLICATIONS", "25"))
+
+if CC_DIGEST_MAX_APPLICATIONS < 1:
+    raise Exception("CC_DIGEST_MAX_APPLICATIONS must be at least 1")
+
+CC_MAILBOX = "clubs@iiit.ac.in"
+
+logger = logging.getLogger(__name__)
+
+digested_applications = Counter(
+    "cc_digest_applications_total", "Applications sent to CC in digests."
+)
+
+
+def application_fields(application: CCRecruitment) -> dict:
+    """
+    Template fields describing an application, for the mails to CC.
+    """
+    return {
+        "uid": application.uid,
+        "email": application.email,
+        "teams": ", ".join(application.teams),
+        "why_this_position": application.why_this_position,
+        "why_cc": application.why_cc,
+        "good_fit": application.good_fit,
+        "ideas1": application.ideas1,
+        "ideas": application.ideas,
+        "other_bodies": application.other_bodies,
+        "design_experience": application.design_experience or "N/A",
+    }
+
+
+def render_digest(applications: list[CCRecruitment]) -> tuple[str, str]:
+    """
+    Subject and body of a digest.
+
+    Args:
+        applications (List[models.CCRecruitment]): The applications listed.
+
+    Returns:
+        (tuple[str, str]): The subject and the body.
+    """
+    sections = "".join(
+        CC_DIGEST_APPLICATION.safe_substitute(
+            number=number, **application_fields(application)
+        )
+        for number, application in enumerate(applications, 1)
+    )
+    return (
+        CC_DIGEST_SUBJECT.safe_substitute(count=len(applications)),
+        CC_DIGEST_BODY.safe_substitute(
+            count=len(applications), applications=sections
+        ),
+    )
+
+
+async def record_application(application: CCRecruitment) -> None:
+    """
+    Records a new application for the next digest.
+
+    Args:
+        application (models.CCRecruitment): The stored application.
+    """
+    await ccdigestdb.insert_one(
+        {
+            "_id": str(application.id),
+            "created_time": get_utc_time(),
+            "digest_id": None,
+            "claimed_time": None,
+        }
+    )
+    cc_digest.wake()
+
+
+class CCDigest:
+    """
+    Flusher sending CC digests of new applications.
+
+    A single loop checks whether a digest is due every `poll_interval`
+    seconds, or when woken by a new application.
+
+    Attributes:
+        interval (float): Seconds an application waits for a digest at most.
+        max_applications (int): Applications after which a digest is sent
+                                right away, and the most one digest lists.
+        poll_interval (float): Seconds between checks when idle.
+    """
+
+    def __init__(
+        self,
+        interval: float = CC_DIGEST_INTERVAL,
+        max_applications: int = CC_DIGEST_MAX_APPLICATIONS,
+    ):
+        self.interval = interval
+        self.max_applications = max_applications
+        self.poll_interval = min(interval, 30.0)
+        self._wakeup = asyncio.Event()
+        self._runner: asyncio.Task | None = None
+
+    def wake(self) -> None:
+        """
+        Makes the loop check for a due digest right away.
+        """
+        self._wakeup.set()
+
+    async def start(self) -> None:
+        """
+        Starts the loop, if it is not running already.
+        """
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the loop; waiting applications are sent by the next start.
+        """
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._release_stale()
+                while await self.due():
+                    await self.flush()
+            except Exception:
+                logger.exception("Failed to send the CC application digest")
+
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=self.poll_interval
+                )
+            except TimeoutError:
+                pass
+
+    async def due(self) -> bool:
+        """
+        Whether enough applications waited long enough for a digest.
+        """
+        waiting = {"digest_id": None}
+        count = await ccdigestdb.count_documents(
+            waiting, limit=self.max_applications
+        )
+        if count >= self.max_applications:
+            return True
+
+        cutoff = get_utc_time() - timedelta(seconds=self.interval)
+        overdue = await ccdigestdb.find_one(
+            {**waiting, "created_time": {"$lte": cutoff}}, {"_id": 1}
+        )
+        return overdue is not None
+
+    async def flush(self) -> int:
+        """
+        Queues a digest of the oldest waiting applications.
+
+        Returns:
+            (int): Number of applications in the digest.
+        """
+        ids = [
+            entry["_id"]
+            async for entry in ccdigestdb.find({"digest_id": None}, {"_id": 1})
+            .sort("created_time", 1)
+            .limit(self.max_applications)
+        ]
+        if not ids:
+            return 0
+
+        # the outbox mail of the digest gets the same id
+        digest_id = ObjectId()
+        await ccdigestdb.update_many(
+            {"_id": {"$in": ids}, "digest_id": None},
+            {"$set": {"digest_id": digest_id, "claimed_time": get_utc_time()}},
+        )
+        await self._send(digest_id)
+        return await self._sent(digest_id)
+
+    async def _send(self, digest_id: ObjectId) -> None:
+        claimed = [
+            entry["_id"]
+            async for entry in ccdigestdb.find(
+                {"digest_id": digest_id}, {"_id": 1}
+            )
+        ]
+        applications = [
+            CCRecruitment.model_validate(document)
+            async for document in ccdb.find({"_id": {"$in": claimed}}).sort(
+                "_id", 1
+            )
+        ]
+        if not applications:
+            return
+
+        subject, body = render_digest(applications)
+        await enqueue_mails(
+            [
+                OutboxMail(
+                    id=digest_id,
+                    subject=subject,
+                    body=body,
+                    to_recipients=[CC_MAILBOX],
+                )
+            ]
+        )
+        digested_applications.inc(amount=len(applications))
+
+    async def _sent(self, digest_id: ObjectId) -> int:
+        result = await ccdigestdb.delete_many({"digest_id": digest_id})
+        return result.deleted_count
+
+    async def _release_stale(self) -> None:
+        stale = get_utc_time() - timedelta(seconds=OUTBOX_LEASE)
+        for digest_id in await ccdigestdb.distinct(
+            "digest_id", {"claimed_time": {"$lte": stale}}
+        ):
+            if await mailoutboxdb.find_one({"_id": digest_id}, {"_id": 1}):
+                # the digest was queued, only the cleanup was missed
+                await self._sent(digest_id)
+            else:
+                await ccdigestdb.update_many(
+                    {"digest_id": digest_id},
+                    {"$set": {"digest_id": None, "claimed_time": None}},
+                )
+
+
+cc_digest = CCDigest()
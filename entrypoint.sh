@@ -1,4 +1,5 @@
 #!/bin/bash
 
 cp ./schema.graphql /subgraphs/interfaces.graphql
-uvicorn main:app --host 0.0.0.0 --port 80 --log-config config/uvicorn_config.json
+# SERVER_WORKERS sets the number of worker processes, see serve.py
+exec python serve.py --host 0.0.0.0 --port 80 --log-config config/uvicorn_config.json
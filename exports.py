@@ -0,0 +1,210 @@
+"""
+Exports Module.
+
+Plain HTTP routes streaming large result sets, mounted on the FastAPI `app`
+in `main.py` under `/export`. Unlike `ccApplications`, which builds the whole
+list and JSON response in memory, rows are written as they come off the
+Mongo cursor, so memory use stays flat and the first byte is sent right away.
+
+Exports run under an admission limit of their own, so slow downloads never
+hold the execution slots of GraphQL operations. The export slot and the
+cursor are released when the response is done, whether it was sent in full,
+cut short by the client, or never started.
+
+Attributes:
+    EXPORT_CHUNK_ROWS (int): Number of rows written per chunk of the
+                             response. Defaults to 100.
+    EXPORT_MAX_CONCURRENCY (int): Maximum number of exports streamed at
+                                  once, further ones are answered with a
+                                  503, 0 for no limit. Defaults to 4.
+    CC_APPLICATION_COLUMNS (list): Columns of the CC applications export.
+    export_admission (admission.AdmissionController): Limits the exports
+                                                      streamed at once.
+    router (APIRouter): The export routes.
+"""
+
+import csv
+import io
+import json
+import os
+from collections.abc import AsyncIterator, Awaitable, Callable
+from enum import StrEnum, auto
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from admission import AdmissionController, OverloadedError
+from db import ccdb
+from metrics import Gauge
+from models import CCRecruitment, Team
+from otypes import Context
+from queries import cc_applications_batch_size, cc_applications_filter
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "100"))
+EXPORT_MAX_CONCURRENCY = int(os.getenv("EXPORT_MAX_CONCURRENCY", "4"))
+
+CC_APPLICATION_COLUMNS = [
+    field.alias or name for name, field in CCRecruitment.model_fields.items()
+]
+
+# exports beyond the limit are rejected right away instead of queueing
+export_admission = AdmissionController(
+    max_concurrency=EXPORT_MAX_CONCURRENCY, max_queue=0
+)
+
+Gauge(
+    "export_active",
+    "Exports being streamed by this process.",
+    lambda: export_admission.active,
+)
+
+router = APIRouter()
+
+
+class ExportFormat(StrEnum):
+    """
+    Enum for the formats of an export.
+    """
+
+    ndjson = auto()
+    csv = auto()
+
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+}
+
+
+def _cc_application_row(document: dict) -> dict:
+    row = {column: document.get(column) for column in CC_APPLICATION_COLUMNS}
+    # applications stored before apply_year was introduced belong to 2024
+    if row["apply_year"] is None:
+        row["apply_year"] = 2024
+    return row
+
+
+async def _ndjson_chunks(cursor) -> AsyncIterator[str]:
+    lines = []
+    async for document in cursor:
+        row = _cc_application_row(document)
+        lines.append(json.dumps(row, default=str) + "\n")
+        if len(lines) >= EXPORT_CHUNK_ROWS:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+async def _csv_chunks(cursor) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CC_APPLICATION_COLUMNS)
+    writer.writeheader()
+    rows = 0
+    async for document in cursor:
+        row = _cc_application_row(document)
+        row["teams"] = ";".join(row["teams"] or [])
+        writer.writerow(row)
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class ExportResponse(StreamingResponse):
+    """
+    Streaming response running a cleanup once it is done, sent or not.
+
+    Attributes:
+        cleanup (Callable): Releases what the export holds.
+    """
+
+    def __init__(
+        self,
+        content: AsyncIterator[str],
+        cleanup: Callable[[], Awaitable[None]],
+        **kwargs,
+    ):
+        super().__init__(content, **kwargs)
+        self.cleanup = cleanup
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.cleanup()
+
+
+@router.get("/cc-applications")
+async def export_cc_applications(
+    request: Request,
+    year: int = 2024,
+    team: Team | None = None,
+    format: ExportFormat = ExportFormat.ndjson,
+) -> StreamingResponse:
+    """
+    Streams all CC Applications of a year, for CC.
+
+    Takes the same filters and access checks as the `ccApplications` query.
+
+    Args:
+        request (fastapi.Request): The request, carrying the user header.
+        year (int): The year of application. Defaults to 2024.
+        team (models.Team | None): Only export applications to this team.
+                                   Defaults to None.
+        format (ExportFormat): Format of the export, NDJSON or CSV. Defaults
+                               to NDJSON.
+
+    Returns:
+        (StreamingResponse): One application per line, in submission order.
+
+    Raises:
+        HTTPException: Not logged in!
+        HTTPException: Not Authenticated to access this API!!
+        HTTPException: Invalid year
+        HTTPException: Server is overloaded, please retry later
+    """
+    context = Context()
+    context.request = request
+    user = context.user
+    if not user:
+        raise HTTPException(401, "Not logged in!")
+
+    if user.get("role", None) not in ["cc"]:
+        raise HTTPException(403, "Not Authenticated to access this API!!")
+
+    if year < 2024:
+        raise HTTPException(400, "Invalid year")
+
+    # the slot is held until the response is done
+    try:
+        await export_admission.acquire()
+    except OverloadedError as e:
+        raise HTTPException(
+            503, str(e), headers={"Retry-After": str(e.retry_after)}
+        )
+
+    cursor = (
+        ccdb.find(cc_applications_filter(year, team))
+        .sort("_id", 1)
+        .batch_size(cc_applications_batch_size)
+    )
+    chunks = _csv_chunks if format == ExportFormat.csv else _ndjson_chunks
+
+    async def cleanup() -> None:
+        export_admission.release()
+        await cursor.close()
+
+    return ExportResponse(
+        chunks(cursor),
+        cleanup,
+        media_type=MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="cc-applications-{year}.{format}"'
+            )
+        },
+    )
@@ -0,0 +1,85 @@
+"""
+Schema Extensions Module.
+
+Strawberry schema and field extensions used by the schema in `main.py`.
+
+The same few operations are sent over and over, so parsing and validating
+their query text on every request is wasted work: Strawberry's parser and
+validation caches keep the results in LRU caches, whose hits and misses are
+reported with the other in-process caches of `cache.py`. Validation only
+depends on the schema, which never changes while the process runs.
+
+Attributes:
+    DOCUMENT_CACHE_SIZE (int): Maximum number of parsed, and of validated,
+                               documents kept. Defaults to 512.
+    parser_cache (ParserCache): Caches parsed documents by query text.
+    validation_cache (ValidationCache): Caches validation errors by parsed
+                                        document.
+"""
+
+import time
+from inspect import isawaitable
+from os import getenv
+
+from strawberry.extensions import FieldExtension, ParserCache, ValidationCache
+from strawberry.types.field import StrawberryField
+
+from cache import lru_caches
+from metrics import resolver_duration, resolver_errors
+
+DOCUMENT_CACHE_SIZE = int(getenv("DOCUMENT_CACHE_SIZE", "512"))
+
+parser_cache = ParserCache(maxsize=DOCUMENT_CACHE_SIZE)
+validation_cache = ValidationCache(maxsize=DOCUMENT_CACHE_SIZE)
+lru_caches["document"] = parser_cache.cached_parse_document
+lru_caches["validation"] = validation_cache.cached_validate_document
+
+
+class ResolverMetrics(FieldExtension):
+    """
+    Records the duration and errors of a root field resolver in `metrics`.
+
+    Only root fields are measured: they are the ones doing database and HTTP
+    work. The extension is added to the root fields themselves, see
+    `time_root_fields`, so nested fields resolve without any overhead.
+    """
+
+    def resolve(self, next_, source, info, **kwargs):
+        operation = info.operation.operation.value
+        start = time.perf_counter()
+        try:
+            return next_(source, info, **kwargs)
+        except Exception:
+            resolver_errors.inc(operation, info.field_name)
+            raise
+        finally:
+            resolver_duration.observe(
+                time.perf_counter() - start, operation, info.field_name
+            )
+
+    async def resolve_async(self, next_, source, info, **kwargs):
+        operation = info.operation.operation.value
+        start = time.perf_counter()
+        try:
+            result = next_(source, info, **kwargs)
+            if isawaitable(result):
+                result = await result
+            return result
+        except Exception:
+            resolver_errors.inc(operation, info.field_name)
+            raise
+        finally:
+            resolver_duration.observe(
+                time.perf_counter() - start, operation, info.field_name
+            )
+
+
+def time_root_fields(fields: list[StrawberryField]) -> None:
+    """
+    Adds `ResolverMetrics` to root fields, before their type is created.
+
+    Args:
+        fields (list[StrawberryField]): The queries or mutations.
+    """
+    for field in fields:
+        field.extensions.append(ResolverMetrics())
@@ -0,0 +1,135 @@
+"""
+Shared HTTP Clients Module.
+
+Keeps one connection-pooled `httpx.AsyncClient` per upstream service so
+outbound calls reuse TCP (and TLS) connections instead of paying for a new
+handshake on every request. The clients are opened and closed by the FastAPI
+lifespan in `main.py`; when used outside of it (scripts, the schema export)
+they are created lazily on first use.
+
+Every setting is read from the environment as `<SERVICE>_HTTP_<NAME>`, falling
+back to `HTTP_<NAME>` and then to the default, e.g. `GRAPH_HTTP_HTTP2=true`
+or `HTTP_MAX_CONNECTIONS=50`.
+
+Attributes:
+    GRAPH_BASE_URL (str): Base URL of the Microsoft Graph API.
+    FILES_BASE_URL (str): Base URL of the files service. Defaults to
+                          "http://files".
+    SERVICES (dict): Base URL of every service a client is kept for.
+"""
+
+import logging
+from importlib.util import find_spec
+from os import getenv
+
+import httpx
+
+from metrics import METRICS_ENABLED, http_event_hooks
+
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+FILES_BASE_URL = getenv("FILES_SERVICE_URL", "http://files")
+
+SERVICES = {
+    "graph": GRAPH_BASE_URL,
+    "files": FILES_BASE_URL,
+}
+
+logger = logging.getLogger(__name__)
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def _setting(service: str, name: str, default: str) -> str:
+    return getenv(
+        f"{service.upper()}_HTTP_{name}",
+        getenv(f"HTTP_{name}", default),
+    )
+
+
+def _build_client(service: str) -> httpx.AsyncClient:
+    """
+    Builds the pooled client of a service from its environment settings.
+
+    Args:
+        service (str): Name of the service, a key of `SERVICES`.
+
+    Returns:
+        (httpx.AsyncClient): The configured client.
+    """
+    limits = httpx.Limits(
+        max_connections=int(_setting(service, "MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(
+            _setting(service, "MAX_KEEPALIVE_CONNECTIONS", "20")
+        ),
+        keepalive_expiry=float(_setting(service, "KEEPALIVE_EXPIRY", "30")),
+    )
+    timeout = httpx.Timeout(
+        float(_setting(service, "TIMEOUT", "10")),
+        connect=float(_setting(service, "CONNECT_TIMEOUT", "5")),
+        pool=float(_setting(service, "POOL_TIMEOUT", "5")),
+    )
+
+    http2 = _setting(service, "HTTP2", "False").lower() in ("true", "1", "t")
+    if http2 and find_spec("h2") is None:
+        logger.warning(
+            "HTTP/2 requested for %s but the 'h2' package is not installed, "
+            "falling back to HTTP/1.1",
+            service,
+        )
+        http2 = False
+
+    return httpx.AsyncClient(
+        base_url=SERVICES[service],
+        limits=limits,
+        timeout=timeout,
+        http2=http2,
+        event_hooks=http_event_hooks(service) if METRICS_ENABLED else None,
+    )
+
+
+def get_client(service: str) -> httpx.AsyncClient:
+    """
+    Returns the shared client of a service, creating it if required.
+
+    Args:
+        service (str): Name of the service, a key of `SERVICES`.
+
+    Returns:
+        (httpx.AsyncClient): The shared client.
+    """
+    client = _clients.get(service)
+    if client is None or client.is_closed:
+        client = _clients[service] = _build_client(service)
+    return client
+
+
+def graph_client() -> httpx.AsyncClient:
+    """
+    Shared client for the Microsoft Graph API.
+    """
+    return get_client("graph")
+
+
+def files_client() -> httpx.AsyncClient:
+    """
+    Shared client for the files service.
+    """
+    return get_client("files")
+
+
+async def start_http_clients() -> None:
+    """
+    Opens the pooled clients of all services.
+    """
+    for service in SERVICES:
+        get_client(service)
+
+
+async def close_http_clients() -> None:
+    """
+    Closes the pooled clients of all services, releasing their connections.
+    """
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
@@ -0,0 +1,430 @@
+"""
+MongoDB Index Management Module.
+
+Declares the indexes every lookup in the queries and mutations relies on, and
+makes sure they exist when the application starts. Building is idempotent:
+indexes that already exist with the same definition are left untouched, and
+an index whose existing definition differs is reported instead of being
+dropped, so a deploy never rebuilds or removes an index behind our back.
+
+Constraint indexes are the exception. Mutations rely on their uniqueness
+instead of checking before a write, so a conflicting index, e.g. an older
+non-unique one of the same name, is replaced by the declared one; if the
+declared one can not be built, the indexes it replaced are restored. Whether
+they exist as declared is verified after the build and during warm-up, and
+reported by the `mongo_constraint_index_enforced` metric; until then the
+mutations keep checking before they write.
+
+A unique index can not be built over documents that already violate it.
+Duplicate storage file titles are renamed by a migration, but duplicate CC
+applications are only reported: which one to keep is for a human to decide,
+and the index is built by the next start after they are resolved.
+
+Data migrations needed by newly declared constraints (see `migrations.py`)
+run right before the indexes are built.
+
+The bootstrap runs as a background task from the FastAPI lifespan in
+`main.py`, so the service starts serving while indexes are being built.
+
+Attributes:
+    ENSURE_INDEXES (bool): Whether indexes are built on startup. Defaults to
+                           True.
+    INDEXES (dict): The declared indexes of every collection.
+    CONSTRAINT_INDEXES (dict): Names of the unique indexes of every
+                               collection that writes rely on.
+"""
+
+import logging
+from os import getenv
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import OperationFailure
+
+from db import (
+    TITLE_COLLATION,
+    ccdb,
+    ccdigestdb,
+    docsstoragedb,
+    mailoutboxdb,
+)
+from metrics import Gauge
+from migrations import run_migrations
+from outbox import OUTBOX_RETENTION
+
+ENSURE_INDEXES = getenv("MONGO_ENSURE_INDEXES", "True").lower() in (
+    "true",
+    "1",
+    "t",
+)
+
+INDEXES: dict[AsyncCollection, list[IndexModel]] = {
+    ccdb: [
+        # haveAppliedForCC
+        IndexModel([("uid", ASCENDING)], name="uid_1"),
+        # one application per email and year, enforced on ccApply insert;
+        # legacy applications without apply_year are left out
+        IndexModel(
+            [("email", ASCENDING), ("apply_year", ASCENDING)],
+            name="email_1_apply_year_1",
+            unique=True,
+            partialFilterExpression={"apply_year": {"$exists": True}},
+        ),
+        # ccApplications and its pages, ordered by _id
+        IndexModel(
+            [("apply_year", ASCENDING), ("_id", ASCENDING)],
+            name="apply_year_1__id_1",
+        ),
+    ],
+    docsstoragedb: [
+        # storagefiles
+        IndexModel([("filetype", ASCENDING)], name="filetype_1"),
+        # storagefilesConnection, by modified_time or title; the title
+        # order ignores case, like the unique title index
+        IndexModel(
+            [
+                ("filetype", ASCENDING),
+                ("modified_time", ASCENDING),
+                ("_id", ASCENDING),
+            ],
+            name="filetype_1_modified_time_1__id_1",
+        ),
+        IndexModel(
+            [
+                ("filetype", ASCENDING),
+                ("title", ASCENDING),
+                ("_id", ASCENDING),
+            ],
+            name="filetype_1_title_1__id_1_ci",
+            collation=TITLE_COLLATION,
+        ),
+        # createStorageFile, titles are unique ignoring case
+        IndexModel(
+            [("title", ASCENDING)],
+            name="title_1_ci",
+            unique=True,
+            collation=TITLE_COLLATION,
+        ),
+    ],
+    mailoutboxdb: [
+        # outbox workers claiming due mails, by priority
+        IndexModel(
+            [
+                ("status", ASCENDING),
+                ("priority", ASCENDING),
+                ("next_attempt_time", ASCENDING),
+            ],
+            name="status_1_priority_1_next_attempt_time_1",
+        ),
+        # outbox workers reading back their claim
+        IndexModel([("claim_id", ASCENDING)], name="claim_id_1"),
+        # delivered and given up mails are deleted after a while
+        IndexModel(
+            [("sent_time", ASCENDING)],
+            name="sent_time_1",
+            expireAfterSeconds=int(OUTBOX_RETENTION),
+        ),
+        IndexModel(
+            [("failed_time", ASCENDING)],
+            name="failed_time_1",
+            expireAfterSeconds=int(OUTBOX_RETENTION),
+        ),
+    ],
+    ccdigestdb: [
+        # digest flusher, waiting applications oldest first
+        IndexModel(
+            [("digest_id", ASCENDING), ("created_time", ASCENDING)],
+            name="digest_id_1_created_time_1",
+        ),
+        # releasing stale claims
+        IndexModel([("claimed_time", ASCENDING)], name="claimed_time_1"),
+    ],
+}
+
+CONSTRAINT_INDEXES: dict[AsyncCollection, list[str]] = {
+    ccdb: ["email_1_apply_year_1"],
+    docsstoragedb: ["title_1_ci"],
+}
+
+# constraint indexes verified to exist as declared
+_enforced: set[str] = set()
+
+# Mongo error codes of an index conflicting with an existing one
+_CONFLICT_CODES = (85, 86)
+# Mongo error code of documents violating a unique index being built
+_DUPLICATE_KEY_CODE = 11000
+# duplicate groups logged when a unique index can not be built
+_REPORTED_DUPLICATES = 20
+
+# options that are part of an index definition, as reported by Mongo
+_DEFINING_OPTIONS = (
+    "unique",
+    "sparse",
+    "partialFilterExpression",
+    "collation",
+    "expireAfterSeconds",
+)
+
+logger = logging.getLogger(__name__)
+
+Gauge(
+    "mongo_constraint_index_enforced",
+    "Whether a unique index writes rely on was verified to exist.",
+    lambda: {
+        (name,): int(name in _enforced)
+        for names in CONSTRAINT_INDEXES.values()
+        for name in names
+    },
+    ("index",),
+)
+
+
+def _definition(document: dict) -> dict:
+    """
+    Normalises an index document for comparison.
+
+    Args:
+        document (dict): The index document, as listed by Mongo or from
+                         `IndexModel.document`.
+
+    Returns:
+        (dict): The key and defining options of the index.
+    """
+    definition = {"key": list(dict(document["key"]).items())}
+    for option in _DEFINING_OPTIONS:
+        if option in document:
+            value = document[option]
+            if option == "collation":
+                # Mongo reports every collation field, compare the declared
+                value = {
+                    "locale": value.get("locale"),
+                    "strength": value.get("strength"),
+                }
+            definition[option] = value
+    return definition
+
+
+async def index_drift(
+    collection: AsyncCollection, declared: list[IndexModel]
+) -> dict[str, list[str]]:
+    """
+    Compares the indexes of a collection with the declared ones.
+
+    Args:
+        collection (AsyncCollection): The collection to inspect.
+        declared (List[IndexModel]): Its declared indexes.
+
+    Returns:
+        (dict): Names of the `missing`, `changed` and `extra` indexes.
+    """
+    existing = {
+        index["name"]: _definition(index)
+        async for index in await collection.list_indexes()
+    }
+    existing.pop("_id_", None)
+
+    drift = {"missing": [], "changed": [], "extra": []}
+    for model in declared:
+        name = model.document["name"]
+        if name not in existing:
+            drift["missing"].append(name)
+        elif existing.pop(name) != _definition(model.document):
+            drift["changed"].append(name)
+    drift["extra"] = sorted(existing)
+
+    return drift
+
+
+async def ensure_collection_indexes(
+    collection: AsyncCollection, declared: list[IndexModel]
+) -> dict[str, list[str]]:
+    """
+    Builds the missing declared indexes of a collection and reports drift.
+
+    Args:
+        collection (AsyncCollection): The collection to index.
+        declared (List[IndexModel]): Its declared indexes.
+
+    Returns:
+        (dict): Names of the `missing`, `changed` and `extra` indexes left
+                after the build.
+    """
+    constraints = CONSTRAINT_INDEXES.get(collection, [])
+    for model in declared:
+        try:
+            await collection.create_indexes([model])
+        except OperationFailure as e:
+            if (
+                e.code in _CONFLICT_CODES
+                and model.document["name"] in constraints
+            ):
+                await replace_index(collection, model)
+                continue
+            # e.g. same name with other options, or data violating `unique`
+            logger.error(
+                "Could not build index %s on %s: %s",
+                model.document["name"],
+                collection.name,
+                e,
+            )
+            if e.code == _DUPLICATE_KEY_CODE:
+                await report_duplicates(collection, model)
+
+    drift = await index_drift(collection, declared)
+    for kind, names in drift.items():
+        if names:
+            logger.warning(
+                "Index drift on %s, %s: %s",
+                collection.name,
+                kind,
+                ", ".join(names),
+            )
+    return drift
+
+
+async def replace_index(collection: AsyncCollection, model: IndexModel):
+    """
+    Replaces the indexes conflicting with a declared one by it.
+
+    An index conflicts when it has the same name or the same key. The
+    conflicting indexes have to be dropped first; if the declared index
+    can not be built, e.g. because of duplicates, they are built again, so
+    lookups on the key keep their index.
+
+    Args:
+        collection (AsyncCollection): The collection to index.
+        model (IndexModel): The declared index.
+    """
+    name = model.document["name"]
+    key = list(dict(model.document["key"]).items())
+    dropped = []
+    async for index in await collection.list_indexes():
+        if index["name"] == name or list(index["key"].items()) == key:
+            logger.warning(
+                "Dropping index %s on %s, it conflicts with %s",
+                index["name"],
+                collection.name,
+                name,
+            )
+            await collection.drop_index(index["name"])
+            dropped.append(index)
+
+    try:
+        await collection.create_indexes([model])
+        return
+    except OperationFailure as e:
+        logger.error(
+            "Could not build index %s on %s: %s", name, collection.name, e
+        )
+        if e.code == _DUPLICATE_KEY_CODE:
+            await report_duplicates(collection, model)
+
+    for index in dropped:
+        options = {
+            option: value
+            for option, value in index.items()
+            if option not in ("key", "v", "ns")
+        }
+        logger.warning(
+            "Restoring index %s on %s", index["name"], collection.name
+        )
+        await collection.create_indexes(
+            [IndexModel(list(index["key"].items()), **options)]
+        )
+
+
+async def report_duplicates(
+    collection: AsyncCollection, model: IndexModel
+) -> None:
+    """
+    Logs the documents that keep a unique index from being built.
+
+    Args:
+        collection (AsyncCollection): The collection to index.
+        model (IndexModel): The unique index.
+    """
+    fields = list(dict(model.document["key"]))
+    pipeline = [
+        {"$match": model.document.get("partialFilterExpression", {})},
+        {"$sort": {"_id": 1}},
+        {
+            "$group": {
+                "_id": {field: f"${field}" for field in fields},
+                "ids": {"$push": "$_id"},
+            }
+        },
+        {"$match": {"ids.1": {"$exists": True}}},
+        {"$limit": _REPORTED_DUPLICATES},
+    ]
+    options = {}
+    if "collation" in model.document:
+        options["collation"] = model.document["collation"]
+
+    async for group in await collection.aggregate(pipeline, **options):
+        logger.error(
+            "Duplicates of %s on %s, %s: %s",
+            model.document["name"],
+            collection.name,
+            group["_id"],
+            ", ".join(str(_id) for _id in group["ids"]),
+        )
+
+
+async def verify_constraints() -> list[str]:
+    """
+    Checks that every constraint index exists as declared.
+
+    Returns:
+        (List[str]): Names of the constraint indexes that are missing or
+                     differ from their declaration.
+    """
+    broken = []
+    for collection, names in CONSTRAINT_INDEXES.items():
+        drift = await index_drift(collection, INDEXES[collection])
+        for name in names:
+            if name in drift["missing"] or name in drift["changed"]:
+                broken.append(name)
+                _enforced.discard(name)
+            else:
+                _enforced.add(name)
+    return broken
+
+
+def constraint_enforced(name: str) -> bool:
+    """
+    Whether the constraint index of the given name was verified to exist.
+    """
+    return name in _enforced
+
+
+async def ensure_indexes() -> dict[str, dict[str, list[str]]]:
+    """
+    Builds the declared indexes of every collection.
+
+    Errors are logged, never raised, so a failing build does not take the
+    application down.
+
+    Returns:
+        (dict): Drift report of every collection, by collection name.
+    """
+    await run_migrations()
+
+    report = {}
+    for collection, declared in INDEXES.items():
+        try:
+            report[collection.name] = await ensure_collection_indexes(
+                collection, declared
+            )
+        except Exception:
+            logger.exception("Failed to ensure indexes on %s", collection.name)
+
+    try:
+        broken = await verify_constraints()
+    except Exception:
+        logger.exception("Failed to verify the constraint indexes")
+    else:
+        if broken:
+            logger.error(
+                "Constraint indexes are not in place: %s", ", ".join(broken)
+            )
+    return report
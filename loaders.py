@@ -0,0 +1,30 @@
+"""
+DataLoaders Module.
+
+Batch functions behind the per-request DataLoaders of `otypes.Context`. Every
+key requested while resolving a query is collected and fetched with a single
+`$in` query, instead of one round trip per key.
+"""
+
+from db import MONGO_MAX_TIME_MS, docsstorage_reads
+from models import StorageFile
+
+
+async def load_storagefiles(ids: list[str]) -> list[StorageFile | None]:
+    """
+    Fetches storage files by id in one query.
+
+    Args:
+        ids (List[str]): Ids of the storage files.
+
+    Returns:
+        (List[models.StorageFile | None]): The storage files in the order of
+                                           `ids`, None for unknown ids.
+    """
+    storage_files = {
+        storage_file["_id"]: StorageFile.model_validate(storage_file)
+        async for storage_file in docsstorage_reads.find(
+            {"_id": {"$in": list(set(ids))}}, max_time_ms=MONGO_MAX_TIME_MS
+        )
+    }
+    return [storage_files.get(file_id) for file_id in ids]
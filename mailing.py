@@ -6,46 +6,280 @@ Attributes:
     CLIENT_ID (str): Client ID for Microsoft Graph API.
     CLIENT_SECRET (str): Client Secret for Microsoft Graph API.
     CLIENT_EMAIL (str): Client Email for Microsoft Graph API.
+    GRAPH_SCOPES (list): Scopes requested for the Graph access token.
+    TOKEN_REFRESH_MARGIN (float): Seconds before expiry at which the cached
+                                  token is refreshed. Defaults to 300.
+    BATCHING_ENABLED (bool): Whether concurrent sends are coalesced into
+                             Graph `$batch` requests. Defaults to True.
+    BATCH_WINDOW (float): Seconds a send waits for others to join its batch.
+                          Defaults to 0.05.
+    BATCH_MAX_SIZE (int): Maximum number of mails per batch, between 1 and
+                          `MAILBOX_CONCURRENCY`. Defaults to 4.
+    MAILBOX_CONCURRENCY (int): Requests Graph runs against a mailbox at
+                               once; it throttles further concurrent ones.
+    token_manager (GraphTokenManager): Process-wide Graph token manager.
+    mail_batcher (SendMailBatcher): Process-wide `$batch` coalescer.
 """
 
+import asyncio
+import logging
 import os
+import time
+from typing import NamedTuple
 
-import httpx
 import msal
 
+from http_clients import graph_client
+from models import MailPriority
+from shared import file_lock, read_json, shared_path, write_json
+from throttling import MAIL_SCHEDULER_ENABLED, ThrottledError, send_scheduler
+
 TENANT_ID = os.environ.get("AD_TENANT_ID")
 CLIENT_ID = os.environ.get("AD_CLIENT_ID")
 CLIENT_SECRET = os.environ.get("AD_CLIENT_SECRET")
 CLIENT_EMAIL = os.environ.get("AD_CLIENT_EMAIL")
 
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+TOKEN_REFRESH_MARGIN = float(
+    os.environ.get("GRAPH_TOKEN_REFRESH_MARGIN", "300")
+)
+
+BATCHING_ENABLED = os.environ.get("GRAPH_MAIL_BATCHING", "True").lower() in (
+    "true",
+    "1",
+    "t",
+)
+BATCH_WINDOW = float(os.environ.get("GRAPH_BATCH_WINDOW_MS", "50")) / 1000
+MAILBOX_CONCURRENCY = 4
+# the requests of a batch run concurrently, all against our mailbox
+BATCH_MAX_SIZE = max(
+    1,
+    min(int(os.environ.get("GRAPH_BATCH_MAX_SIZE", "4")), MAILBOX_CONCURRENCY),
+)
+
+logger = logging.getLogger(__name__)
+
+
+class GraphTokenManager:
+    """
+    Keeps a single MSAL client application and caches its access token.
+
+    The token is served from memory until it gets close to its expiry. Once
+    inside the refresh margin a refresh is started in the background while
+    the still-valid token keeps being served; only an expired (or missing)
+    token makes callers wait. MSAL calls are blocking, so they run in a
+    worker thread, and a lock makes sure that at most one refresh is in
+    flight no matter how many mails are being sent concurrently.
+
+    With a shared file, the worker processes of `serve.py` share the token
+    too: a file lock lets one of them refresh it, the others pick it up.
+
+    Attributes:
+        refresh_margin (float): Seconds before expiry at which the token is
+                                refreshed.
+        shared_file (str | None): File the token is shared through, None if
+                                  it is not shared.
+    """
+
+    def __init__(
+        self,
+        refresh_margin: float = TOKEN_REFRESH_MARGIN,
+        shared_file: str | None = None,
+    ):
+        self.refresh_margin = refresh_margin
+        self.shared_file = shared_file
+        self._app = None
+        self._access_token = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+    @property
+    def app(self) -> msal.ConfidentialClientApplication:
+        """
+        The shared MSAL client application, built on first use.
+        """
+        if self._app is None:
+            self._app = msal.ConfidentialClientApplication(
+                authority=f"https://login.microsoftonline.com/{TENANT_ID}/",
+                client_id=f"{CLIENT_ID}",
+                client_credential=f"{CLIENT_SECRET}",
+            )
+        return self._app
+
+    def _is_fresh(self) -> bool:
+        return (
+            self._access_token is not None
+            and time.monotonic() < self._expires_at - self.refresh_margin
+        )
+
+    def _is_valid(self) -> bool:
+        return (
+            self._access_token is not None
+            and time.monotonic() < self._expires_at
+        )
+
+    def _load_shared(self) -> None:
+        # adopt the token of another worker if it lasts longer than ours
+        token = read_json(self.shared_file)
+        if not isinstance(token, dict) or "access_token" not in token:
+            return
+        expires_at = time.monotonic() + token["expires_at"] - time.time()
+        if expires_at > self._expires_at:
+            self._access_token = token["access_token"]
+            self._expires_at = expires_at
+
+    def _acquire_shared(self) -> dict | None:
+        # blocking, one worker at a time acquires and stores a new token
+        with file_lock(self.shared_file):
+            self._load_shared()
+            if self._is_fresh():
+                # refreshed by another worker
+                return {
+                    "access_token": self._access_token,
+                    "expires_in": self._expires_at - time.monotonic(),
+                }
+
+            token = acquire_token()
+            if token is not None and "access_token" in token:
+                write_json(
+                    self.shared_file,
+                    {
+                        "access_token": token["access_token"],
+                        "expires_at": time.time()
+                        + float(token.get("expires_in", 0)),
+                    },
+                )
+            return token
+
+    async def get_token(self) -> str:
+        """
+        Returns a valid access token, refreshing it only when required.
+
+        Returns:
+            (str): The Graph access token.
+
+        Raises:
+            ValueError: Failed to acquire access token
+        """
+        if self._is_fresh():
+            return self._access_token
+
+        if self.shared_file is not None:
+            self._load_shared()
+            if self._is_fresh():
+                return self._access_token
+
+        if self._is_valid():
+            self._schedule_refresh()
+            return self._access_token
+
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        """
+        Acquires a new token from MSAL, coalescing concurrent callers.
+
+        Returns:
+            (str): The Graph access token.
+
+        Raises:
+            ValueError: Failed to acquire access token
+        """
+        async with self._lock:
+            # another caller may have refreshed while we were waiting
+            if self._is_fresh():
+                return self._access_token
+
+            if self.shared_file is None:
+                token = await asyncio.to_thread(acquire_token)
+            else:
+                token = await asyncio.to_thread(self._acquire_shared)
+
+            if token is None or "access_token" not in token:
+                raise ValueError("Failed to acquire access token")
+
+            self._access_token = token["access_token"]
+            self._expires_at = time.monotonic() + float(
+                token.get("expires_in", 0)
+            )
+            return self._access_token
+
+    def _schedule_refresh(self) -> None:
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+
+        self._refresh_task = asyncio.create_task(self.refresh())
+        self._refresh_task.add_done_callback(self._refresh_done)
+
+    @staticmethod
+    def _refresh_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                "Background Graph token refresh failed: %s", task.exception()
+            )
+
 
 def acquire_token():
     """
-    Returns token aquired via MSAL
+    Returns token aquired via MSAL, using the shared client application.
+
+    This call is blocking, use `token_manager.get_token()` from async code.
     """
 
-    authority_url = f"https://login.microsoftonline.com/{TENANT_ID}/"
-    app = msal.ConfidentialClientApplication(
-        authority=authority_url,
-        client_id=f"{CLIENT_ID}",
-        client_credential=f"{CLIENT_SECRET}",
-    )
-    token = app.acquire_token_for_client(
-        scopes=["https://graph.microsoft.com/.default"]
-    )
-    return token
+    return token_manager.app.acquire_token_for_client(scopes=GRAPH_SCOPES)
 
 
-async def send_mail(
+token_manager = GraphTokenManager(shared_file=shared_path("graph_token"))
+
+
+class MailResult(NamedTuple):
+    """
+    Outcome of handing a single mail over to Microsoft Graph.
+
+    Attributes:
+        sent (bool): Whether Graph accepted the mail.
+        status_code (int): HTTP status code returned by Graph.
+        retry_after (float | None): Seconds Graph asked us to wait before
+                                    retrying, if any.
+        attempted (bool): Whether the mail was handed to Graph at all, False
+                          when it timed out in the send scheduler.
+    """
+
+    sent: bool
+    status_code: int
+    retry_after: float | None = None
+    attempted: bool = True
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Parses the value of a `Retry-After` header given in seconds.
+
+    Args:
+        value (str | None): The header value.
+
+    Returns:
+        (float | None): Number of seconds to wait, None if not present.
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+def build_message(
     subject: str,
     body: str,
     to: list,
     cc: list = [],
     reply_to: str | None = None,
     html_body: bool | None = False,
-) -> bool:
+) -> dict:
     """
-    Method to send email
+    Builds the Graph `sendMail` payload of an email.
 
     Args:
         subject (str): subject for an email.
@@ -53,23 +287,14 @@ async def send_mail(
         to (list): The list of recipients for an email.
         cc (list, optional): The list of recipients for an email. Default is
                              empty.
+        reply_to (str, optional): Address replies should go to. Defaults to
+                                  None.
         html_body (bool, optional): Whether the body is HTML or not.
                                     Defaults to False.
 
     Returns:
-        (bool): Whether the email was sent successfully or not.
+        (dict): The request body for the Graph `sendMail` endpoint.
     """
-    token = acquire_token()
-    if token is None or "access_token" not in token:
-        raise ValueError("Failed to acquire access token")
-    token = token["access_token"]
-
-    url = f"https://graph.microsoft.com/v1.0/users/{CLIENT_EMAIL}/sendMail"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-
     message = {
         "message": {
             "subject": subject,
@@ -92,6 +317,255 @@ async def send_mail(
             {"emailAddress": {"address": reply_to}}
         ]
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=message)
-        return response.status_code == 202
+    return message
+
+
+async def _auth_headers() -> dict:
+    token = await token_manager.get_token()
+    return {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+
+
+async def post_message(message: dict) -> MailResult:
+    """
+    Submits a single `sendMail` payload to Microsoft Graph.
+
+    Args:
+        message (dict): Payload built by `build_message`.
+
+    Returns:
+        (MailResult): The outcome reported by Graph.
+
+    Raises:
+        ValueError: Failed to acquire access token
+        httpx.TransportError: If Graph could not be reached.
+    """
+    url = f"/users/{CLIENT_EMAIL}/sendMail"
+    headers = await _auth_headers()
+
+    response = await graph_client().post(url, headers=headers, json=message)
+    return MailResult(
+        sent=response.status_code == 202,
+        status_code=response.status_code,
+        retry_after=parse_retry_after(response.headers.get("Retry-After")),
+    )
+
+
+async def post_message_batch(messages: list[dict]) -> list[MailResult]:
+    """
+    Submits `sendMail` payloads in one Graph JSON `$batch` request.
+
+    Graph runs the requests of a batch concurrently, so a batch should hold
+    no more than `MAILBOX_CONCURRENCY` of them.
+
+    If the batch request itself is rejected (e.g. throttled), every mail in
+    it gets that outcome.
+
+    Args:
+        messages (List[dict]): Payloads built by `build_message`.
+
+    Returns:
+        (List[MailResult]): The outcome of every mail, in the same order.
+
+    Raises:
+        ValueError: Failed to acquire access token
+        httpx.TransportError: If Graph could not be reached.
+    """
+    requests = [
+        {
+            "id": str(index),
+            "method": "POST",
+            "url": f"/users/{CLIENT_EMAIL}/sendMail",
+            "headers": {"Content-Type": "application/json"},
+            "body": message,
+        }
+        for index, message in enumerate(messages)
+    ]
+    headers = await _auth_headers()
+
+    response = await graph_client().post(
+        "/$batch", headers=headers, json={"requests": requests}
+    )
+    if response.status_code != 200:
+        failed = MailResult(
+            sent=False,
+            status_code=response.status_code,
+            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+        )
+        return [failed] * len(messages)
+
+    # responses may come back in any order, match them up by id
+    results = [MailResult(sent=False, status_code=500)] * len(messages)
+    for item in response.json().get("responses", []):
+        status_code = int(item.get("status", 500))
+        results[int(item["id"])] = MailResult(
+            sent=status_code == 202,
+            status_code=status_code,
+            retry_after=parse_retry_after(
+                (item.get("headers") or {}).get("Retry-After")
+            ),
+        )
+    return results
+
+
+class SendMailBatcher:
+    """
+    Coalesces concurrent sends into Graph JSON `$batch` requests.
+
+    The first send of a batch opens a short window; every send arriving
+    within it joins the same batch, which is submitted when the window
+    closes or as soon as it is full. Each caller still awaits, and gets,
+    the outcome of its own mail. A batch of one is sent as a plain
+    `sendMail` request.
+
+    Batches are sent one at a time, so no more than `max_size` requests run
+    against the mailbox at once.
+
+    Attributes:
+        window (float): Seconds to wait for a batch to fill up.
+        max_size (int): Maximum number of mails per batch.
+    """
+
+    def __init__(
+        self, window: float = BATCH_WINDOW, max_size: int = BATCH_MAX_SIZE
+    ):
+        self.window = window
+        self.max_size = max_size
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._sending = asyncio.Lock()
+
+    async def submit(self, message: dict) -> MailResult:
+        """
+        Queues a mail for the next batch and waits for its outcome.
+
+        Args:
+            message (dict): Payload built by `build_message`.
+
+        Returns:
+            (MailResult): The outcome reported by Graph for this mail.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._pending:
+            batch = self._pending[: self.max_size]
+            self._pending = self._pending[self.max_size :]
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        messages = [message for message, _ in batch]
+        try:
+            async with self._sending:
+                if len(messages) == 1:
+                    results = [await post_message(messages[0])]
+                else:
+                    results = await post_message_batch(messages)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+mail_batcher = SendMailBatcher()
+
+# bounds unbatched sends like batching does
+_mailbox_slots = asyncio.Semaphore(MAILBOX_CONCURRENCY)
+
+
+async def deliver_message(
+    message: dict, priority: MailPriority = MailPriority.normal
+) -> MailResult:
+    """
+    Submits a `sendMail` payload to Microsoft Graph.
+
+    Sends are paced by the send scheduler of `throttling.py` unless it is
+    disabled, and coalesced into `$batch` requests unless batching is
+    disabled.
+
+    Args:
+        message (dict): Payload built by `build_message`.
+        priority (models.MailPriority): Lane of the mail in the send
+                                        scheduler. Defaults to normal.
+
+    Returns:
+        (MailResult): The outcome reported by Graph, or a 429 that was not
+                      attempted when the mail waited too long in the send
+                      scheduler.
+
+    Raises:
+        ValueError: Failed to acquire access token
+        httpx.TransportError: If Graph could not be reached.
+    """
+
+    async def send() -> MailResult:
+        if BATCHING_ENABLED:
+            return await mail_batcher.submit(message)
+        async with _mailbox_slots:
+            return await post_message(message)
+
+    if not MAIL_SCHEDULER_ENABLED:
+        return await send()
+    try:
+        return await send_scheduler.submit(CLIENT_EMAIL or "", priority, send)
+    except ThrottledError as e:
+        return MailResult(
+            sent=False,
+            status_code=429,
+            retry_after=e.retry_after,
+            attempted=False,
+        )
+
+
+async def send_mail(
+    subject: str,
+    body: str,
+    to: list,
+    cc: list = [],
+    reply_to: str | None = None,
+    html_body: bool | None = False,
+) -> bool:
+    """
+    Method to send email
+
+    Args:
+        subject (str): subject for an email.
+        body (str): body of the email.
+        to (list): The list of recipients for an email.
+        cc (list, optional): The list of recipients for an email. Default is
+                             empty.
+        reply_to (str, optional): Address replies should go to. Defaults to
+                                  None.
+        html_body (bool, optional): Whether the body is HTML or not.
+                                    Defaults to False.
+
+    Returns:
+        (bool): Whether the email was sent successfully or not.
+    """
+    result = await deliver_message(
+        build_message(subject, body, to, cc, reply_to, html_body)
+    )
+    return result.sent
@@ -1,5 +1,9 @@
 """
 Subjects and bodies for mails to CC and applicant after successful application.
+
+In digest mode CC gets one `CC_DIGEST_BODY` for many applications instead of
+a `CC_APPLICANT_CONFIRMATION_BODY` each, with one `CC_DIGEST_APPLICATION`
+section per application.
 """
 
 from string import Template
@@ -75,3 +79,47 @@ Note: This automated email has been generated from the Clubs Council website.
 For more details, visit clubs.iiit.ac.in.
 """  # noqa: E501
 )
+
+CC_DIGEST_SUBJECT = Template(
+    """
+Clubs Council - $count new CC Application(s)
+"""
+)
+
+CC_DIGEST_BODY = Template(
+    """
+Dear Clubs Council,
+
+$count new application(s) have been received for CC. The details are as follows:
+$applications
+Best regards,
+Tech Team
+Clubs Council.
+
+Note: This automated email has been generated from the Clubs Council website.
+For more details, visit clubs.iiit.ac.in.
+"""  # noqa: E501
+)
+
+CC_DIGEST_APPLICATION = Template(
+    """
+Application $number
+    1. User ID: $uid
+    2. Email: $email
+    3. Teams: $teams
+    4. Why did you choose the team(s) you have chosen?
+        $why_this_position
+    5. Why do you want to be a part of the Clubs Council?
+        $why_cc
+    6. Why do you believe you are a good fit for the position?
+        $good_fit
+    7. Did you often want to take part in an event, but couldn't or didn't?
+        $ideas1
+    8. Ideas and thoughts to improve campus life
+        $ideas
+    9. Student-run bodies or clubs you have been a part of
+        $other_bodies
+    10. Design Experience
+        $design_experience
+"""
+)
@@ -9,24 +9,43 @@ Attributes:
     GLOBAL_DEBUG (str): Environment variable that Enables or Disables debug
                         mode. Defaults to "False".
     DEBUG (bool): Indicates whether the application is running in debug mode.
-    gql_app (GraphQLRouter): The GraphQL router for handling GraphQL requests.
+    gql_app (CachingGraphQLRouter): The GraphQL router for handling GraphQL
+                                    requests.
     app (FastAPI): The FastAPI application instance.
 """
 
+import asyncio
+from contextlib import asynccontextmanager
 from os import getenv
 
 import strawberry
 from fastapi import FastAPI
-from strawberry.fastapi import GraphQLRouter
 from strawberry.tools import create_type
 
+from cache import STORAGEFILES_CHANGE_STREAM, watch_storagefiles
+from digest import CC_DIGEST_ENABLED, cc_digest
+from exports import router as export_router
+from extensions import parser_cache, time_root_fields, validation_cache
+from http_clients import close_http_clients, start_http_clients
+from indexes import ENSURE_INDEXES, ensure_indexes
+from metrics import METRICS_ENABLED, publish_snapshots
+from metrics import router as metrics_router
+
 # override Context scalar
 from models import PyObjectId
 from mutations import mutations
 from otypes import Context, PyObjectIdType
+from outbox import mail_outbox
 
 # import all queries and mutations
 from queries import queries
+from router import CachingGraphQLRouter
+from warmup import WARMUP_ENABLED, readiness, warm_up
+from warmup import router as readiness_router
+
+if METRICS_ENABLED:
+    time_root_fields(queries)
+    time_root_fields(mutations)
 
 # create query types
 Query = create_type("Query", queries)
@@ -44,15 +63,67 @@ schema = strawberry.federation.Schema(
     query=Query,
     mutation=Mutation,
     scalar_overrides={PyObjectId: PyObjectIdType},
+    extensions=[parser_cache, validation_cache],
 )
 
 DEBUG = getenv("GLOBAL_DEBUG", "False").lower() in ("true", "1", "t")
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Opens shared resources on startup and releases them on shutdown.
+    """
+    # build indexes in the background, serving does not wait for them
+    index_bootstrap = (
+        asyncio.create_task(ensure_indexes()) if ENSURE_INDEXES else None
+    )
+    cache_listener = (
+        asyncio.create_task(watch_storagefiles())
+        if STORAGEFILES_CHANGE_STREAM
+        else None
+    )
+    await start_http_clients()
+    # with several workers, only the first one runs the background jobs;
+    # `serve.py` sets the index after forking, so it is read here
+    if getenv("SERVER_WORKER_INDEX", "0") == "0":
+        await mail_outbox.start()
+        if CC_DIGEST_ENABLED:
+            await cc_digest.start()
+    metrics_publisher = (
+        asyncio.create_task(publish_snapshots()) if METRICS_ENABLED else None
+    )
+    # `/ready` answers 503 until the process is warm
+    warmup = asyncio.create_task(warm_up(schema)) if WARMUP_ENABLED else None
+    readiness.ready = not WARMUP_ENABLED
+    try:
+        yield
+    finally:
+        # stop getting traffic while shutting down
+        readiness.ready = False
+        await cc_digest.stop()
+        await mail_outbox.stop()
+        await close_http_clients()
+        for task in (
+            index_bootstrap,
+            cache_listener,
+            metrics_publisher,
+            warmup,
+        ):
+            if task is not None:
+                task.cancel()
+
+
 # serve API with FastAPI router
-gql_app = GraphQLRouter(schema, context_getter=get_context)
+gql_app = CachingGraphQLRouter(schema, context_getter=get_context)
 app = FastAPI(
     debug=DEBUG,
     title="CC Interfaces Microservice",
     desciption="Handles several smaller Interface based APIs",
+    lifespan=lifespan,
 )
 app.include_router(gql_app, prefix="/graphql")
+app.include_router(export_router, prefix="/export")
+app.include_router(readiness_router)
+if METRICS_ENABLED:
+    app.include_router(metrics_router)
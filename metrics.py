@@ -0,0 +1,414 @@
+"""
+Metrics Module.
+
+In-process metrics, served in the Prometheus text format on `/metrics`.
+
+Metrics are plain counters and histograms updated in place by the code being
+measured, so recording costs a dict lookup and an addition. Values that are
+cheaper to read when scraped than to keep up to date, like queue depths and
+cache sizes, are gauges whose collect function is called on every scrape.
+
+The collectors of the resolvers, Mongo commands and outbound HTTP requests
+are defined here and hooked up by `extensions.py`, `db.py` and
+`http_clients.py`; the mail outbox, caches and admission control register
+gauges of their own.
+
+With several worker processes (see `serve.py`) a scrape is answered by
+whichever worker accepts the connection, so every worker publishes a
+snapshot of its metrics to the shared state directory of `shared.py`, and
+`/metrics` serves the samples of all workers, each with a `worker` label.
+The series of a worker stay continuous whichever worker is scraped, so
+`rate()` works; sum them by the other labels for service totals. Samples of
+the other workers are up to `METRICS_SNAPSHOT_INTERVAL` seconds old.
+
+Attributes:
+    METRICS_ENABLED (bool): Whether metrics are collected and served.
+                            Defaults to True.
+    METRICS_COLLECT_TIMEOUT (float): Seconds an async collect function may
+                                     take before it is left out of a
+                                     scrape. Defaults to 2.
+    METRICS_SNAPSHOT_INTERVAL (float): Seconds between the snapshots a
+                                       worker of `serve.py` publishes for
+                                       the others. Defaults to 5.
+    DEFAULT_BUCKETS (tuple): Upper bounds, in seconds, of latency buckets.
+    resolver_duration (Histogram): Duration of root field resolvers.
+    resolver_errors (Counter): Errors raised by root field resolvers.
+    mongo_command_duration (Histogram): Duration of Mongo commands.
+    http_request_duration (Histogram): Duration of outbound HTTP requests,
+                                       until the response headers arrive.
+    router (APIRouter): The `/metrics` route.
+"""
+
+import asyncio
+import bisect
+import inspect
+import os
+import time
+from collections.abc import Callable
+from os import getenv
+
+import httpx
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from pymongo import monitoring
+
+from shared import SHARED_STATE_DIR, read_json, shared_path, write_json
+
+METRICS_ENABLED = getenv("METRICS_ENABLED", "True").lower() in (
+    "true",
+    "1",
+    "t",
+)
+
+METRICS_COLLECT_TIMEOUT = float(getenv("METRICS_COLLECT_TIMEOUT", "2"))
+METRICS_SNAPSHOT_INTERVAL = float(getenv("METRICS_SNAPSHOT_INTERVAL", "5"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry: list["Counter | Histogram | Gauge"] = []
+
+
+def _escape(value: str) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """
+    Monotonically increasing count, by label values.
+
+    Attributes:
+        name (str): Name of the metric.
+        documentation (str): Help text of the metric.
+        labelnames (tuple[str, ...]): Names of its labels.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    async def lines(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+            for labels, value in list(self._values.items())
+        ]
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, by label values.
+
+    Attributes:
+        name (str): Name of the metric.
+        documentation (str): Help text of the metric.
+        labelnames (tuple[str, ...]): Names of its labels.
+        buckets (tuple[float, ...]): Upper bounds of the buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: count of every bucket, then sum and count
+        self._values: dict[tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * len(self.buckets) + [0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def count(self, *labels) -> int:
+        series = self._values.get(labels)
+        return series[-1] if series else 0
+
+    async def lines(self) -> list[str]:
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, series in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(names, labels + (bound,))} {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_bucket"
+                f"{_format_labels(names, labels + ('+Inf',))} {series[-1]}"
+            )
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {series[-2]}")
+            lines.append(f"{self.name}_count{label_text} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """
+    Current value of something, read by a collect function on every scrape.
+
+    Attributes:
+        name (str): Name of the metric.
+        documentation (str): Help text of the metric.
+        collect (Callable): Returns the values by label values, a number
+                            when there are no labels. May be async.
+        labelnames (tuple[str, ...]): Names of its labels.
+        kind (str): "counter" for counts kept elsewhere, like cache hits.
+                    Defaults to "gauge".
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        collect: Callable,
+        labelnames=(),
+        kind: str = "gauge",
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.kind = kind
+        _registry.append(self)
+
+    async def lines(self) -> list[str]:
+        values = self.collect()
+        if inspect.isawaitable(values):
+            values = await asyncio.wait_for(values, METRICS_COLLECT_TIMEOUT)
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+            for labels, value in values.items()
+        ]
+
+
+def _worker() -> str | None:
+    # set by `serve.py` after forking, so it is read when used
+    return getenv("SERVER_WORKER_INDEX")
+
+
+def _with_worker(line: str, worker: str) -> str:
+    # the metric name ends at its labels, or at the value
+    end = min(index for index in (line.find("{"), line.find(" ")) if index > 0)
+    if line[end] == "{":
+        return f'{line[:end]}{{worker="{worker}",{line[end + 1 :]}'
+    return f'{line[:end]}{{worker="{worker}"}}{line[end:]}'
+
+
+async def _collect() -> dict[str, list[str]]:
+    """
+    Sample lines of this process, by metric name.
+
+    With several workers, every line has a `worker` label.
+    """
+    worker = _worker()
+    samples = {}
+    for metric in _registry:
+        try:
+            lines = await metric.lines()
+        except Exception:
+            continue
+        if worker is not None:
+            lines = [_with_worker(line, worker) for line in lines]
+        samples[metric.name] = lines
+    return samples
+
+
+def _snapshot_path(worker: str) -> str | None:
+    return shared_path(f"metrics-{worker}.json")
+
+
+async def publish_snapshots() -> None:
+    """
+    Publishes the metrics of this worker for the others, until cancelled.
+
+    Only runs in the worker processes of `serve.py`; a scrape answered by
+    any worker then includes the latest snapshot of every other worker.
+    """
+    worker = _worker()
+    path = _snapshot_path(worker) if worker is not None else None
+    if path is None:
+        return
+    while True:
+        try:
+            write_json(path, await _collect())
+        except OSError:
+            # e.g. a full disk, the next snapshot may succeed
+            pass
+        await asyncio.sleep(METRICS_SNAPSHOT_INTERVAL)
+
+
+def _other_snapshots(worker: str) -> list[dict]:
+    snapshots = []
+    for filename in sorted(os.listdir(SHARED_STATE_DIR)):
+        if not filename.startswith("metrics-") or not filename.endswith(
+            ".json"
+        ):
+            continue
+        if filename == f"metrics-{worker}.json":
+            continue
+        snapshot = read_json(os.path.join(SHARED_STATE_DIR, filename))
+        if isinstance(snapshot, dict):
+            snapshots.append(snapshot)
+    return snapshots
+
+
+async def render() -> str:
+    """
+    All registered metrics in the Prometheus text exposition format.
+
+    A gauge whose collect function fails or times out is left out. With
+    several workers, the samples of every worker are included, each with
+    its `worker` label: the current ones of this worker and the latest
+    published snapshot of the others.
+    """
+    samples = await _collect()
+    worker = _worker()
+    others = []
+    if worker is not None and _snapshot_path(worker) is not None:
+        others = _other_snapshots(worker)
+
+    chunks = []
+    for metric in _registry:
+        lines = samples.get(metric.name)
+        if lines is None:
+            continue
+        chunks.append(f"# HELP {metric.name} {metric.documentation}")
+        chunks.append(f"# TYPE {metric.name} {metric.kind}")
+        chunks.extend(lines)
+        for snapshot in others:
+            chunks.extend(snapshot.get(metric.name, []))
+    return "\n".join(chunks) + "\n"
+
+
+resolver_duration = Histogram(
+    "graphql_resolver_duration_seconds",
+    "Duration of root field resolvers.",
+    ("operation", "field"),
+)
+resolver_errors = Counter(
+    "graphql_resolver_errors_total",
+    "Errors raised by root field resolvers.",
+    ("operation", "field"),
+)
+mongo_command_duration = Histogram(
+    "mongo_command_duration_seconds",
+    "Duration of Mongo commands.",
+    ("command", "collection", "outcome"),
+)
+http_request_duration = Histogram(
+    "http_client_request_duration_seconds",
+    "Duration of outbound HTTP requests, until the response headers arrive.",
+    ("service", "method", "status"),
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Pymongo command listener timing every command in `mongo_command_duration`.
+    """
+
+    def __init__(self):
+        # collection of every running command, by request id
+        self._collections: dict[int, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        self._collections[event.request_id] = collection
+
+    def _finished(self, event, outcome: str) -> None:
+        mongo_command_duration.observe(
+            event.duration_micros / 1e6,
+            event.command_name,
+            self._collections.pop(event.request_id, ""),
+            outcome,
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finished(event, "success")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finished(event, "failure")
+
+
+def http_event_hooks(service: str) -> dict[str, list[Callable]]:
+    """
+    httpx event hooks timing the requests of a service.
+
+    Args:
+        service (str): Name of the service, used as label.
+
+    Returns:
+        (dict): The hooks, to be passed as `event_hooks` of the client.
+    """
+
+    async def on_request(request: httpx.Request) -> None:
+        request.extensions["metrics_start"] = time.perf_counter()
+
+    async def on_response(response: httpx.Response) -> None:
+        start = response.request.extensions.get("metrics_start")
+        if start is not None:
+            http_request_duration.observe(
+                time.perf_counter() - start,
+                service,
+                response.request.method,
+                str(response.status_code),
+            )
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """
+    Serves all metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        await render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
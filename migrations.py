@@ -0,0 +1,165 @@
+"""
+Data Migrations Module.
+
+Brings existing documents in line with constraints that are introduced by
+new indexes, so that the index bootstrap can build them. Migrations are run
+by `indexes.ensure_indexes` before the indexes are built.
+
+Every migration runs once per database, not once per process: it is
+recorded in the `migrations` collection, and the record doubles as a lock,
+so replicas and workers starting together do not run it concurrently. A
+run that failed, or whose process died, is retried once its lock expires.
+
+Attributes:
+    MIGRATION_LEASE (float): Seconds a running migration is locked for.
+                             Defaults to 600.
+    MIGRATIONS (list): The migrations, in the order they are run.
+"""
+
+import logging
+from datetime import timedelta
+from os import getenv
+
+from pymongo.errors import DuplicateKeyError
+
+from db import TITLE_COLLATION, docsstoragedb, migrationsdb
+from utils import get_utc_time
+
+MIGRATION_LEASE = float(getenv("MIGRATION_LEASE", "600"))
+
+logger = logging.getLogger(__name__)
+
+
+async def deduplicate_storagefile_titles() -> list[dict]:
+    """
+    Renames storage files whose titles differ only in case.
+
+    The oldest file keeps its title, the others get a ` (2)`, ` (3)`, ...
+    suffix, which is what the unique case-insensitive title index needs.
+
+    Returns:
+        (List[dict]): The renames, with the `_id`, `old` and `new` title.
+    """
+    pipeline = [
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": "$title", "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ]
+
+    renamed = []
+    cursor = await docsstoragedb.aggregate(pipeline, collation=TITLE_COLLATION)
+    async for group in cursor:
+        for file_id in group["ids"][1:]:
+            storagefile = await docsstoragedb.find_one(
+                {"_id": file_id}, {"title": 1}
+            )
+
+            number = 2
+            while True:
+                suffix = f" ({number})"
+                title = storagefile["title"][: 100 - len(suffix)] + suffix
+                if not await docsstoragedb.find_one(
+                    {"title": title}, {"_id": 1}, collation=TITLE_COLLATION
+                ):
+                    break
+                number += 1
+
+            await docsstoragedb.update_one(
+                {"_id": file_id}, {"$set": {"title": title}}
+            )
+            logger.warning(
+                "Renamed storage file %s from %r to %r",
+                file_id,
+                storagefile["title"],
+                title,
+            )
+            renamed.append(
+                {"_id": file_id, "old": storagefile["title"], "new": title}
+            )
+
+    return renamed
+
+
+MIGRATIONS = [
+    deduplicate_storagefile_titles,
+]
+
+
+async def _lock(name: str) -> bool:
+    """
+    Takes the lock of a migration that has not completed yet.
+
+    Args:
+        name (str): Name of the migration.
+
+    Returns:
+        (bool): Whether this process got to run the migration.
+    """
+    now = get_utc_time()
+    locked_until = now + timedelta(seconds=MIGRATION_LEASE)
+    try:
+        await migrationsdb.insert_one(
+            {
+                "_id": name,
+                "status": "running",
+                "started_time": now,
+                "locked_until": locked_until,
+            }
+        )
+        return True
+    except DuplicateKeyError:
+        pass
+
+    # completed, running elsewhere, or left behind by a failed run
+    retried = await migrationsdb.find_one_and_update(
+        {"_id": name, "status": "running", "locked_until": {"$lte": now}},
+        {"$set": {"started_time": now, "locked_until": locked_until}},
+    )
+    return retried is not None
+
+
+async def run_migration(migration) -> None:
+    """
+    Runs a migration, unless it completed or is running elsewhere.
+
+    Args:
+        migration (Callable): The migration, recorded under its name.
+    """
+    name = migration.__name__
+    if not await _lock(name):
+        return
+
+    logger.info("Running migration %s", name)
+    try:
+        result = await migration()
+    except Exception:
+        # let the next start retry it right away
+        await migrationsdb.update_one(
+            {"_id": name, "status": "running"},
+            {"$set": {"locked_until": get_utc_time()}},
+        )
+        raise
+
+    await migrationsdb.update_one(
+        {"_id": name},
+        {
+            "$set": {
+                "status": "completed",
+                "completed_time": get_utc_time(),
+                "result": result,
+            }
+        },
+    )
+    logger.info("Completed migration %s", name)
+
+
+async def run_migrations() -> None:
+    """
+    Runs every migration that has not completed yet, logging instead of
+    raising on failure.
+    """
+    for migration in MIGRATIONS:
+        try:
+            await run_migration(migration)
+        except Exception:
+            logger.exception("Migration %s failed", migration.__name__)
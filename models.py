@@ -1,5 +1,5 @@
 from datetime import datetime
-from enum import StrEnum, auto
+from enum import IntEnum, StrEnum, auto
 from typing import Any, List
 
 import strawberry
@@ -100,6 +100,88 @@ class Mails(BaseModel):
     )
 
 
+class MailStatus(StrEnum):
+    """
+    Enum for storing the delivery state of a mail in the outbox.
+    """
+
+    pending = auto()
+    sending = auto()
+    sent = auto()
+    failed = auto()
+
+
+class MailPriority(IntEnum):
+    """
+    Enum for the lanes of the mail send scheduler, lower is sent first.
+    """
+
+    high = 0
+    normal = 1
+    bulk = 2
+
+
+class OutboxMail(BaseModel):
+    """
+    Model for mails waiting in the outbox to be delivered
+
+    Attributes:
+        id (PyObjectId): Unique ObjectId of the document.
+        uid (str): User id of the sender. Defaults to None.
+        subject (str): Subject of the mail.
+        body (str): Body of the mail.
+        to_recipients (List[pydantic.networks.EmailStr]): List
+                                                         of 'to' recipients.
+        cc_recipients (List[pydantic.networks.EmailStr]): List
+                                                         of 'cc' recipients.
+        reply_to (pydantic.networks.EmailStr): Address replies should go to.
+                                               Defaults to None.
+        html_body (bool): Whether the body is in HTML or not.
+        priority (MailPriority): Lane of the mail in the send scheduler.
+                                 Defaults to normal.
+        status (MailStatus): Delivery state of the mail.
+        attempts (int): Number of delivery attempts made so far.
+        next_attempt_time (datetime): Earliest time of the next attempt, or
+                                      the lease expiry while sending.
+        claim_id (PyObjectId): Id of the latest claim on the mail by an
+                               outbox worker. Defaults to None.
+        last_error (str): Reason the last attempt failed. Defaults to None.
+        created_time (datetime): Time when the mail was queued.
+        sent_time (datetime): Time when the mail was delivered. Defaults to
+                              None.
+        failed_time (datetime): Time when delivery was given up. Defaults to
+                                None.
+    """
+
+    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    uid: str | None = None
+    subject: str = Field(...)
+    body: str = Field(...)
+    to_recipients: List[EmailStr] = Field(...)
+    cc_recipients: List[EmailStr] = Field([])
+    reply_to: EmailStr | None = None
+    html_body: bool = Field(default=False)
+    priority: MailPriority = MailPriority.normal
+
+    status: MailStatus = MailStatus.pending
+    attempts: int = 0
+    next_attempt_time: datetime = Field(default_factory=get_utc_time)
+    claim_id: PyObjectId | None = None
+    last_error: str | None = None
+
+    created_time: datetime = Field(default_factory=get_utc_time, frozen=True)
+    sent_time: datetime | None = None
+    failed_time: datetime | None = None
+
+    model_config = ConfigDict(
+        populate_by_name=True,
+        arbitrary_types_allowed=True,
+        extra="forbid",
+        str_strip_whitespace=True,
+        validate_assignment=True,
+    )
+
+
 # Enum for storing category of the team for the recruit
 @strawberry.enum
 class Team(StrEnum):
@@ -114,6 +196,17 @@ class Team(StrEnum):
     Corporate = auto()
 
 
+# Enum for storing the orders storage files can be listed in
+@strawberry.enum
+class StorageFileSort(StrEnum):
+    """
+    Enum for storing the field storage files are sorted by.
+    """
+
+    modified_time = auto()
+    title = auto()
+
+
 class CCRecruitment(BaseModel):
     """
     Model for CC Recruitment form
@@ -2,33 +2,48 @@
 Mutation Resolvers
 """
 
+import logging
 import os
-import re
+from typing import List
 
 import strawberry
 from fastapi.encoders import jsonable_encoder
-
-from db import ccdb, docsstoragedb
-from mailing import send_mail
+from pydantic import ValidationError
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from cache import invalidate_storagefile
+from db import TITLE_COLLATION, ccdb_majority, docsstoragedb
+from digest import (
+    CC_DIGEST_ENABLED,
+    CC_MAILBOX,
+    application_fields,
+    record_application,
+)
+from indexes import constraint_enforced
 from mailing_templates import (
     APPLICANT_CONFIRMATION_BODY,
     APPLICANT_CONFIRMATION_SUBJECT,
     CC_APPLICANT_CONFIRMATION_BODY,
     CC_APPLICANT_CONFIRMATION_SUBJECT,
 )
-from models import CCRecruitment, StorageFile
+from models import MailPriority, OutboxMail, StorageFile
 
 # import all models and types
 from otypes import (
     CCRecruitmentInput,
     Info,
+    MailBatchResult,
     MailInput,
     StorageFileInput,
     StorageFileType,
 )
+from outbox import enqueue_mail, enqueue_mails
 from utils import get_curr_time_str
 
 inter_communication_secret_global = os.getenv("INTER_COMMUNICATION_SECRET")
+mail_batch_max_size = int(os.getenv("MAIL_BATCH_MAX_SIZE", "500"))
+
+logger = logging.getLogger(__name__)
 
 
 # sample mutation
@@ -70,15 +85,15 @@ async def sendMail(
     if mail_input["uid"] is None:
         mail_input["uid"] = user["uid"]
 
-    # send mail as background task
-    info.context.background_tasks.add_task(
-        send_mail,
+    # queue mail in the outbox, it is sent by the outbox workers
+    await enqueue_mail(
         mail_input["subject"],
         mail_input["body"],
         mail_input["to_recipients"],
         mail_input["cc_recipients"],
         None,
         mail_input["html_body"],
+        uid=mail_input["uid"],
     )
 
     # send_mail(mail_input["subject"], mail_input["body"],
@@ -99,13 +114,91 @@ async def sendMail(
     return True
 
 
+@strawberry.mutation
+async def sendMailBatch(
+    info: Info,
+    mailInputs: List[MailInput],
+    inter_communication_secret: str | None = None,
+) -> List[MailBatchResult]:
+    """
+    Resolver that initiates the sending of many emails at once.
+
+    The caller is authenticated once for the whole list, every mail is
+    validated on its own and all valid mails are queued in a single write.
+    Invalid mails are reported back without affecting the others.
+
+    Args:
+        info (otypes.Info): contains the user's context information.
+        mailInputs (List[otypes.MailInput]): The input data of every email.
+        inter_communication_secret (str): The secret key
+                                for inter-communication. Defaults to None.
+
+    Returns:
+        (List[otypes.MailBatchResult]): The outcome of every email, in the
+                                        order they were given.
+
+    Raises:
+        Exception: Not logged in!
+        Exception: Not Authenticated to access this API!!
+        Exception: Too many mails in one batch!
+    """
+
+    user = info.context.user
+    if not user:
+        raise Exception("Not logged in!")
+
+    if user.get("role", None) not in ["cc", "club", "slo", "slc", "email_bot"]:
+        raise Exception("Not Authenticated to access this API!!")
+
+    if inter_communication_secret != inter_communication_secret_global:
+        raise Exception("Authentication Error! Invalid secret!")
+
+    if len(mailInputs) > mail_batch_max_size:
+        raise Exception("Too many mails in one batch!")
+
+    results = []
+    mails = []
+    for index, mailInput in enumerate(mailInputs):
+        try:
+            mail = mailInput.to_pydantic()
+        except ValidationError as e:
+            results.append(
+                MailBatchResult(
+                    index=index,
+                    queued=False,
+                    error="; ".join(error["msg"] for error in e.errors()),
+                )
+            )
+            continue
+
+        # already validated as Mails, skip validating it again
+        mails.append(
+            OutboxMail.model_construct(
+                uid=mail.uid if mail.uid is not None else user["uid"],
+                subject=mail.subject,
+                body=mail.body,
+                to_recipients=mail.to_recipients,
+                cc_recipients=mail.cc_recipients,
+                html_body=mail.html_body,
+                priority=MailPriority.bulk,
+            )
+        )
+        results.append(MailBatchResult(index=index, queued=True))
+
+    # queue all valid mails in the outbox with one write
+    await enqueue_mails(mails)
+
+    return results
+
+
 @strawberry.mutation
 async def ccApply(ccRecruitmentInput: CCRecruitmentInput, info: Info) -> bool:
     """
     This method is used to apply for CC
 
     This method is invoked when a user applies for CC.
-    It send mails to the user and the CC admins regarding the application.
+    It send mails to the user and the CC admins regarding the application;
+    in digest mode the CC admins get it in the next digest instead.
 
     Args:
         ccRecruitmentInput (otypes.CCRecruitmentInput): The input data while
@@ -128,47 +221,56 @@ async def ccApply(ccRecruitmentInput: CCRecruitmentInput, info: Info) -> bool:
     if user.get("role", None) not in ["public"]:
         raise Exception("Not Authenticated to access this API!!")
 
-    cc_recruitment_input = jsonable_encoder(ccRecruitmentInput.to_pydantic())
-    curr_year = int(get_curr_time_str()[:4])
-
-    # Check if the user has already applied
-    if await ccdb.find_one(
-        {"email": cc_recruitment_input["email"], "apply_year": curr_year}
+    created_sample = ccRecruitmentInput.to_pydantic()
+    created_sample.apply_year = int(get_curr_time_str()[:4])
+
+    # the unique (email, apply_year) index rejects a second application in
+    # the same year; check before inserting until it is known to exist
+    enforced = constraint_enforced("email_1_apply_year_1")
+    if not enforced and await ccdb_majority.find_one(
+        {
+            "email": created_sample.email,
+            "apply_year": created_sample.apply_year,
+        },
+        {"_id": 1},
     ):
         raise Exception("You have already applied for CC!!")
 
-    cc_recruitment_input["apply_year"] = curr_year
-
-    # add to database
-    created_id = (await ccdb.insert_one(cc_recruitment_input)).inserted_id
-    created_sample = CCRecruitment.model_validate(
-        await ccdb.find_one({"_id": created_id})
-    )
+    try:
+        await ccdb_majority.insert_one(jsonable_encoder(created_sample))
+    except DuplicateKeyError:
+        raise Exception("You have already applied for CC!!")
 
-    # Send emails
-    info.context.background_tasks.add_task(
-        send_mail,
-        APPLICANT_CONFIRMATION_SUBJECT.safe_substitute(),
-        APPLICANT_CONFIRMATION_BODY.safe_substitute(),
-        [created_sample.email],
+    # the applicant's confirmation is queued first, whatever happens next
+    confirmation = OutboxMail(
+        uid=created_sample.uid,
+        subject=APPLICANT_CONFIRMATION_SUBJECT.safe_substitute(),
+        body=APPLICANT_CONFIRMATION_BODY.safe_substitute(),
+        to_recipients=[created_sample.email],
+        priority=MailPriority.high,
     )
-    info.context.background_tasks.add_task(
-        send_mail,
-        CC_APPLICANT_CONFIRMATION_SUBJECT.safe_substitute(),
-        CC_APPLICANT_CONFIRMATION_BODY.safe_substitute(
-            uid=created_sample.uid,
-            email=created_sample.email,
-            teams=", ".join(created_sample.teams),
-            why_this_position=created_sample.why_this_position,
-            why_cc=created_sample.why_cc,
-            good_fit=created_sample.good_fit,
-            ideas1=created_sample.ideas1,
-            ideas=created_sample.ideas,
-            other_bodies=created_sample.other_bodies,
-            design_experience=created_sample.design_experience or "N/A",
+    cc_mail = OutboxMail(
+        uid=created_sample.uid,
+        subject=CC_APPLICANT_CONFIRMATION_SUBJECT.safe_substitute(),
+        body=CC_APPLICANT_CONFIRMATION_BODY.safe_substitute(
+            **application_fields(created_sample)
         ),
-        ["clubs@iiit.ac.in"],
+        to_recipients=[CC_MAILBOX],
     )
+    if not CC_DIGEST_ENABLED:
+        await enqueue_mails([confirmation, cc_mail])
+        return True
+
+    await enqueue_mails([confirmation])
+    try:
+        await record_application(created_sample)
+    except PyMongoError:
+        # the application is stored, so CC gets it in a mail of its own
+        logger.exception(
+            "Failed to record application %s for the CC digest",
+            created_sample.id,
+        )
+        await enqueue_mails([cc_mail])
 
     return True
 
@@ -205,15 +307,21 @@ async def createStorageFile(
         filetype=details.filetype,
     )
 
-    # Check if any storagefile with same title already exists
-    if await docsstoragedb.find_one(
-        {"title": {"$regex": f"^{re.escape(details.title)}$", "$options": "i"}}
+    # the unique case-insensitive title index rejects an existing title;
+    # check before inserting until it is known to exist
+    enforced = constraint_enforced("title_1_ci")
+    if not enforced and await docsstoragedb.find_one(
+        {"title": storagefile.title}, {"_id": 1}, collation=TITLE_COLLATION
     ):
         raise ValueError("A storagefile already exists with this name.")
 
-    created_id = (
-        await docsstoragedb.insert_one(jsonable_encoder(storagefile))
-    ).inserted_id
+    try:
+        created_id = (
+            await docsstoragedb.insert_one(jsonable_encoder(storagefile))
+        ).inserted_id
+    except DuplicateKeyError:
+        raise ValueError("A storagefile already exists with this name.")
+    invalidate_storagefile(filetype=storagefile.filetype)
     created_storagefile = await docsstoragedb.find_one({"_id": created_id})
 
     return StorageFileType.from_pydantic(
@@ -261,6 +369,7 @@ async def updateStorageFile(id: str, version: int, info: Info) -> bool:
     await docsstoragedb.find_one_and_update(
         {"_id": id}, {"$set": jsonable_encoder(updated_storagefile)}
     )
+    invalidate_storagefile(id, storagefile["filetype"])
     return True
 
 
@@ -294,12 +403,14 @@ async def deleteStorageFile(id: str, info: Info) -> bool:
     # delete_file(storagefile["filename"])
 
     await docsstoragedb.delete_one({"_id": id})
+    invalidate_storagefile(id, storagefile["filetype"])
     return True
 
 
 # register all mutations
 mutations = [
     sendMail,
+    sendMailBatch,
     ccApply,
     createStorageFile,
     updateStorageFile,
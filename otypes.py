@@ -3,10 +3,14 @@ from functools import cached_property
 from typing import Dict, List, Optional, Union
 
 import strawberry
+from strawberry.dataloader import DataLoader
 from strawberry.fastapi import BaseContext
+from strawberry.federation.schema_directives import Key
 from strawberry.types import Info as _Info
 from strawberry.types.info import RootValueType
 
+from cache import storagefile_cache
+from loaders import load_storagefiles
 from models import CCRecruitment, Mails, PyObjectId, StorageFile
 
 
@@ -33,6 +37,10 @@ class Context(BaseContext):
         cookies = json.loads(self.request.headers.get("cookies", "{}"))
         return cookies
 
+    @cached_property
+    def storagefile_loader(self) -> DataLoader[str, StorageFile | None]:
+        return DataLoader(load_fn=load_storagefiles)
+
 
 Info = _Info[Context, RootValueType]
 """custom info Type for user metadata"""
@@ -81,6 +89,22 @@ class MailInput:
     html_body: Optional[bool] = False
 
 
+@strawberry.type
+class MailBatchResult:
+    """
+    Type used for returning the outcome of one mail of a batch.
+
+    Attributes:
+        index (int): Position of the mail in the submitted list.
+        queued (bool): Whether the mail was accepted for sending.
+        error (Optional[str]): Why the mail was rejected. Defaults to None.
+    """
+
+    index: int
+    queued: bool
+    error: Optional[str] = None
+
+
 @strawberry.experimental.pydantic.input(model=CCRecruitment)
 class CCRecruitmentInput:
     """
@@ -125,6 +149,49 @@ class CCRecruitmentType:
     pass
 
 
+@strawberry.type
+class PageInfo:
+    """
+    Type used for returning the pagination state of a connection.
+
+    Attributes:
+        has_next_page (bool): Whether there are more results after this page.
+        end_cursor (Optional[str]): Cursor of the last result of this page,
+                                to be passed as `after`. Defaults to None.
+    """
+
+    has_next_page: bool
+    end_cursor: Optional[str] = None
+
+
+@strawberry.type
+class CCRecruitmentEdge:
+    """
+    Type used for returning one CC application of a page with its cursor.
+
+    Attributes:
+        cursor (str): Cursor of this application.
+        node (CCRecruitmentType): The application.
+    """
+
+    cursor: str
+    node: CCRecruitmentType
+
+
+@strawberry.type
+class CCRecruitmentConnection:
+    """
+    Type used for returning a page of CC applications.
+
+    Attributes:
+        edges (List[CCRecruitmentEdge]): Applications of this page.
+        page_info (PageInfo): Pagination state of this page.
+    """
+
+    edges: List[CCRecruitmentEdge]
+    page_info: PageInfo
+
+
 # signed url object type
 @strawberry.type
 class SignedURL:
@@ -172,13 +239,69 @@ class StorageFileInput:
     filetype: strawberry.auto
 
 
-@strawberry.experimental.pydantic.type(model=StorageFile, all_fields=True)
+@strawberry.experimental.pydantic.type(
+    model=StorageFile, all_fields=True, directives=[Key(fields="_id")]
+)
 class StorageFileType:
     """
     Input used for taking all the details regarding the file.
 
+    It is a federation entity keyed on its id, other subgraphs can reference
+    storage files and the gateway resolves them here.
+
     Attributes:
         fields (models.StorageFile): All fields of the StorageFile model.
     """
 
-    pass
+    @classmethod
+    async def resolve_reference(
+        cls, info: strawberry.Info, **representation
+    ) -> Optional["StorageFileType"]:
+        """
+        Resolves a storage file referenced by another subgraph.
+
+        All references of a gateway query are batched into one lookup by
+        the request's storage file DataLoader.
+        """
+        file_id = str(representation["_id"])
+
+        cached = storagefile_cache.get(file_id)
+        if cached is not None:
+            return cached
+
+        generation = storagefile_cache.generation
+        storage_file = await info.context.storagefile_loader.load(file_id)
+        if storage_file is None:
+            return None
+
+        storage_file = StorageFileType.from_pydantic(storage_file)
+        storagefile_cache.set(file_id, storage_file, generation)
+        return storage_file
+
+
+@strawberry.type
+class StorageFileEdge:
+    """
+    Type used for returning one storage file of a page with its cursor.
+
+    Attributes:
+        cursor (str): Cursor of this file.
+        node (StorageFileType): The file.
+    """
+
+    cursor: str
+    node: StorageFileType
+
+
+@strawberry.type
+class StorageFileConnection:
+    """
+    Type used for returning a page of storage files.
+
+    Attributes:
+        edges (List[StorageFileEdge]): Files of this page.
+        page_info (PageInfo): Pagination state of this page.
+    """
+
+    edges: List[StorageFileEdge]
+    page_info: PageInfo
@@ -0,0 +1,491 @@
+"""
+Mail Outbox Module.
+
+Mails are not sent from the request that asks for them. Instead they are
+written to the `mailoutbox` collection and delivered by a pool of async
+workers, so that a restart loses nothing, failed sends are retried and a
+burst of mails never runs with unbounded concurrency next to GraphQL traffic.
+
+Workers claim pending mails in batches: a single `update_many` flips the due
+mails to `sending` with a lease and stamps them with a claim id, which the
+worker then reads back. A mail whose lease expires (e.g. the worker died) is
+picked up again. Retryable failures are rescheduled with exponential backoff,
+or after the `Retry-After` period when Graph throttles us with a 429. Mails
+that waited too long in the send scheduler of `throttling.py` are
+rescheduled without counting the attempt; the scheduler gives up on them
+well before the lease expires, and the outcome of a delivery is only
+recorded while its claim still holds.
+
+Attributes:
+    OUTBOX_CONCURRENCY (int): Maximum number of mails delivered at once.
+                              Defaults to 20.
+    OUTBOX_BATCH_SIZE (int): Maximum number of mails claimed at once.
+                             Defaults to 20.
+    OUTBOX_MAX_ATTEMPTS (int): Attempts after which a mail is marked failed.
+                               Defaults to 6.
+    OUTBOX_BACKOFF_BASE (float): Delay in seconds before the first retry,
+                                 doubled on every attempt. Defaults to 5.
+    OUTBOX_BACKOFF_MAX (float): Upper bound of the retry delay in seconds.
+                                Defaults to 900.
+    OUTBOX_POLL_INTERVAL (float): Seconds between polls when idle. Defaults
+                                  to 2.
+    OUTBOX_LEASE (float): Seconds a claimed mail is reserved for its worker.
+                          Defaults to 300.
+    OUTBOX_RETENTION (float): Seconds sent and failed mails are kept before
+                              Mongo deletes them. Defaults to 30 days.
+    OUTBOX_DEPTH_INTERVAL (float): Seconds the queue depth reported in
+                                   `/metrics` is reused for. Defaults to 15.
+    RETRYABLE_STATUS_CODES (set): Graph status codes worth retrying.
+    mail_outbox (MailOutbox): The process-wide outbox worker pool.
+    outbox_depth (OutboxDepth): The queue depth reported in `/metrics`.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from datetime import timedelta
+from os import getenv
+
+import httpx
+from bson import ObjectId
+
+from db import mailoutboxdb
+from mailing import MailResult, build_message, deliver_message
+from metrics import Counter, Gauge
+from models import MailStatus, OutboxMail
+from throttling import MAIL_SCHEDULER_MAX_WAIT, send_scheduler
+from utils import get_utc_time
+
+OUTBOX_CONCURRENCY = int(getenv("MAIL_OUTBOX_CONCURRENCY", "20"))
+OUTBOX_BATCH_SIZE = int(getenv("MAIL_OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_MAX_ATTEMPTS = int(getenv("MAIL_OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_BASE = float(getenv("MAIL_OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = float(getenv("MAIL_OUTBOX_BACKOFF_MAX", "900"))
+OUTBOX_POLL_INTERVAL = float(getenv("MAIL_OUTBOX_POLL_INTERVAL", "2"))
+OUTBOX_LEASE = float(getenv("MAIL_OUTBOX_LEASE", "300"))
+OUTBOX_RETENTION = float(getenv("MAIL_OUTBOX_RETENTION", "2592000"))
+OUTBOX_DEPTH_INTERVAL = float(getenv("MAIL_OUTBOX_DEPTH_INTERVAL", "15"))
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+if MAIL_SCHEDULER_MAX_WAIT * 2 > OUTBOX_LEASE:
+    raise Exception(
+        "MAIL_SCHEDULER_MAX_WAIT must be at most half of MAIL_OUTBOX_LEASE"
+    )
+
+logger = logging.getLogger(__name__)
+
+mails_enqueued = Counter(
+    "mail_outbox_enqueued_total", "Mails written to the outbox."
+)
+mail_deliveries = Counter(
+    "mail_outbox_deliveries_total",
+    "Delivery attempts of outbox mails, by outcome.",
+    ("outcome",),
+)
+
+
+async def enqueue_mails(mails: list[OutboxMail]) -> list[str]:
+    """
+    Writes mails to the outbox, to be delivered by the worker pool.
+
+    Args:
+        mails (List[models.OutboxMail]): The mails to be sent.
+
+    Returns:
+        (List[str]): Ids of the queued mails.
+    """
+    if not mails:
+        return []
+
+    await mailoutboxdb.insert_many(
+        [mail.model_dump(by_alias=True) for mail in mails], ordered=False
+    )
+    mails_enqueued.inc(amount=len(mails))
+    mail_outbox.wake()
+    return [str(mail.id) for mail in mails]
+
+
+async def enqueue_mail(
+    subject: str,
+    body: str,
+    to: list,
+    cc: list = [],
+    reply_to: str | None = None,
+    html_body: bool | None = False,
+    uid: str | None = None,
+) -> str:
+    """
+    Writes a single mail to the outbox, same arguments as `send_mail`.
+
+    Args:
+        subject (str): subject for an email.
+        body (str): body of the email.
+        to (list): The list of recipients for an email.
+        cc (list, optional): The list of recipients for an email. Default is
+                             empty.
+        reply_to (str, optional): Address replies should go to. Defaults to
+                                  None.
+        html_body (bool, optional): Whether the body is HTML or not.
+                                    Defaults to False.
+        uid (str, optional): User id of the sender. Defaults to None.
+
+    Returns:
+        (str): Id of the queued mail.
+    """
+    mail = OutboxMail(
+        uid=uid,
+        subject=subject,
+        body=body,
+        to_recipients=to,
+        cc_recipients=cc,
+        reply_to=reply_to,
+        html_body=bool(html_body),
+    )
+    return (await enqueue_mails([mail]))[0]
+
+
+def backoff_delay(attempts: int) -> float:
+    """
+    Exponential backoff with full jitter for the given attempt number.
+
+    Args:
+        attempts (int): Number of attempts made so far.
+
+    Returns:
+        (float): Seconds to wait before the next attempt.
+    """
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class MailOutbox:
+    """
+    Bounded pool of async workers delivering mails from the outbox.
+
+    A single loop claims up to `batch_size` due mails at a time, but never
+    more than there are free delivery slots, and runs each one in its own
+    task. The loop sleeps until the next poll, or until `wake` is called
+    because a mail was queued or a slot became free.
+
+    Attributes:
+        concurrency (int): Maximum number of mails delivered at once.
+        batch_size (int): Maximum number of mails claimed at once.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = OUTBOX_CONCURRENCY,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+    ):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._inflight: set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._runner: asyncio.Task | None = None
+
+    @property
+    def inflight(self) -> int:
+        """
+        Number of mails currently being delivered by this process.
+        """
+        return len(self._inflight)
+
+    def wake(self) -> None:
+        """
+        Makes the claim loop look for due mails right away.
+        """
+        self._wakeup.set()
+
+    async def start(self) -> None:
+        """
+        Starts the claim loop, if it is not running already.
+        """
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops claiming mails and waits for in-flight deliveries to finish.
+
+        Mails that were claimed but not delivered, including those still
+        waiting in the send scheduler, keep their lease and are picked up
+        again once it expires.
+        """
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+        await send_scheduler.stop()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            claimed = 0
+            capacity = min(self.batch_size, self.concurrency - self.inflight)
+            try:
+                for mail in await self._claim(capacity):
+                    claimed += 1
+                    task = asyncio.create_task(self._deliver(mail))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._delivered)
+            except Exception:
+                logger.exception("Failed to claim mails from the outbox")
+
+            # keep claiming while there is a backlog and room for it
+            if claimed and claimed == capacity:
+                continue
+
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL
+                )
+            except TimeoutError:
+                pass
+
+    def _delivered(self, task: asyncio.Task) -> None:
+        self._inflight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Mail delivery crashed, it will be retried after its lease",
+                exc_info=task.exception(),
+            )
+        self.wake()
+
+    async def _claim(self, limit: int) -> list[OutboxMail]:
+        """
+        Atomically reserves up to `limit` due mails for this process.
+
+        Args:
+            limit (int): Maximum number of mails to claim.
+
+        Returns:
+            (List[models.OutboxMail]): The claimed mails.
+        """
+        if limit <= 0:
+            return []
+
+        now = get_utc_time()
+        due = {
+            "status": {"$in": [MailStatus.pending, MailStatus.sending]},
+            "next_attempt_time": {"$lte": now},
+        }
+        # applicant confirmations ahead of bulk announcements
+        order = [("priority", 1), ("next_attempt_time", 1)]
+        ids = [
+            document["_id"]
+            async for document in mailoutboxdb.find(due, {"_id": 1})
+            .sort(order)
+            .limit(limit)
+        ]
+        if not ids:
+            return []
+
+        # repeating the filter skips mails claimed elsewhere in the meantime
+        claim_id = ObjectId()
+        await mailoutboxdb.update_many(
+            {"_id": {"$in": ids}, **due},
+            {
+                "$set": {
+                    "status": MailStatus.sending,
+                    "next_attempt_time": now + timedelta(seconds=OUTBOX_LEASE),
+                    "claim_id": claim_id,
+                },
+                "$inc": {"attempts": 1},
+            },
+        )
+        return [
+            OutboxMail.model_validate(document)
+            async for document in mailoutboxdb.find(
+                {"claim_id": claim_id}
+            ).sort("priority", 1)
+        ]
+
+    async def send(self, mail: OutboxMail) -> MailResult:
+        """
+        Hands a claimed mail over to Microsoft Graph.
+
+        Args:
+            mail (models.OutboxMail): The mail to send.
+
+        Returns:
+            (mailing.MailResult): The outcome reported by Graph.
+        """
+        return await deliver_message(
+            build_message(
+                mail.subject,
+                mail.body,
+                mail.to_recipients,
+                mail.cc_recipients,
+                mail.reply_to,
+                mail.html_body,
+            ),
+            mail.priority,
+        )
+
+    async def _deliver(self, mail: OutboxMail) -> None:
+        try:
+            result = await self.send(mail)
+        except (httpx.TransportError, ValueError) as e:
+            result = MailResult(sent=False, status_code=503)
+            error = f"{type(e).__name__}: {e}"
+        else:
+            error = f"Graph responded with {result.status_code}"
+
+        if result.sent:
+            mail_deliveries.inc("sent")
+            await self._record(
+                mail,
+                {
+                    "$set": {
+                        "status": MailStatus.sent,
+                        "sent_time": get_utc_time(),
+                        "last_error": None,
+                    }
+                },
+            )
+            return
+
+        if not result.attempted:
+            # never reached Graph, the attempt does not count
+            delay = result.retry_after
+            if delay is None:
+                delay = backoff_delay(1)
+            mail_deliveries.inc("deferred")
+            await self._record(
+                mail,
+                {
+                    "$set": {
+                        "status": MailStatus.pending,
+                        "next_attempt_time": get_utc_time()
+                        + timedelta(seconds=delay),
+                    },
+                    "$inc": {"attempts": -1},
+                },
+            )
+            return
+
+        retryable = result.status_code in RETRYABLE_STATUS_CODES
+        if retryable and mail.attempts < OUTBOX_MAX_ATTEMPTS:
+            delay = result.retry_after
+            if delay is None:
+                delay = backoff_delay(mail.attempts)
+            mail_deliveries.inc("retried")
+            update = {
+                "status": MailStatus.pending,
+                "next_attempt_time": get_utc_time() + timedelta(seconds=delay),
+                "last_error": error,
+            }
+        else:
+            logger.warning(
+                "Giving up on mail %s after %d attempt(s): %s",
+                mail.id,
+                mail.attempts,
+                error,
+            )
+            mail_deliveries.inc("failed")
+            update = {
+                "status": MailStatus.failed,
+                "failed_time": get_utc_time(),
+                "last_error": error,
+            }
+
+        await self._record(mail, {"$set": update})
+
+    async def _record(self, mail: OutboxMail, update: dict) -> None:
+        """
+        Records the outcome of a delivery, unless its claim was lost.
+
+        Once the lease of a claim expired, the mail may have been claimed
+        again elsewhere, under another claim id.
+
+        Args:
+            mail (models.OutboxMail): The mail as claimed.
+            update (dict): The update recording the outcome.
+        """
+        result = await mailoutboxdb.update_one(
+            {
+                "_id": mail.id,
+                "status": MailStatus.sending,
+                "claim_id": mail.claim_id,
+            },
+            update,
+        )
+        if result.matched_count == 0:
+            logger.warning(
+                "Lost the claim on mail %s before recording its delivery",
+                mail.id,
+            )
+
+
+mail_outbox = MailOutbox()
+
+
+class OutboxDepth:
+    """
+    Number of outbox mails by status, counted at most once per interval.
+
+    `/metrics` is unauthenticated, so the aggregate over the outbox is not
+    run on every scrape: concurrent scrapes share a single count, which is
+    reused until it is `interval` seconds old.
+
+    Attributes:
+        interval (float): Seconds a count is reused for.
+    """
+
+    def __init__(self, interval: float = OUTBOX_DEPTH_INTERVAL):
+        self.interval = interval
+        self._depth: dict[tuple, int] = {}
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> dict[tuple, int]:
+        async with self._lock:
+            if time.monotonic() >= self._expires_at:
+                self._depth = await self._count()
+                self._expires_at = time.monotonic() + self.interval
+        return self._depth
+
+    @staticmethod
+    async def _count() -> dict[tuple, int]:
+        depth = {
+            (MailStatus.pending.value,): 0,
+            (MailStatus.sending.value,): 0,
+        }
+        async for group in await mailoutboxdb.aggregate(
+            [
+                {
+                    "$match": {
+                        "status": {
+                            "$in": [MailStatus.pending, MailStatus.sending]
+                        }
+                    }
+                },
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+            ]
+        ):
+            depth[(group["_id"],)] = group["count"]
+        return depth
+
+
+outbox_depth = OutboxDepth()
+
+
+Gauge(
+    "mail_outbox_queue_depth",
+    "Mails in the outbox waiting for or in delivery, by status.",
+    outbox_depth.get,
+    ("status",),
+)
+Gauge(
+    "mail_outbox_inflight",
+    "Mails being delivered by this process.",
+    lambda: mail_outbox.inflight,
+)
@@ -0,0 +1,279 @@
+"""
+Projections Module.
+
+Builds Mongo projections from the fields a query actually selects, so list
+resolvers only fetch and decode those fields, e.g. a review table asking for
+`uid`, `email` and `teams` skips the essays of every CC application.
+
+Documents fetched with a projection are partial and cannot be validated by
+their pydantic model as a whole. `from_document` validates every fetched
+field on its own instead, against the same field definition, and sets the
+fields that were not selected to None; they are never resolved.
+
+With the opt-in fast read path, documents are not validated at all: every
+document was validated by this service when it was written, so they are
+mapped straight to their strawberry type, only converting the values BSON
+(or `jsonable_encoder`) cannot represent, like enums and datetimes. A sample
+of the documents is still validated in full, to catch schema drift; failures
+are logged and counted in `read_validation`.
+
+Attributes:
+    READ_FAST_PATH (bool): Whether documents are converted without
+                           validation. Defaults to False.
+    READ_VALIDATION_SAMPLE_RATE (float): Fraction of documents still
+                                         validated on the fast path.
+                                         Defaults to 0.01.
+    read_validation (Counter): Number of `sampled` and `failed` validations
+                               on the fast path.
+"""
+
+import logging
+import random
+from collections import Counter
+from collections.abc import Callable
+from datetime import datetime
+from enum import Enum
+from functools import lru_cache
+from os import getenv
+from types import NoneType, UnionType
+from typing import Annotated, Any, Union, get_args, get_origin
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from strawberry.types.nodes import FragmentSpread, InlineFragment, Selection
+
+from metrics import Gauge
+from otypes import Info
+
+READ_FAST_PATH = getenv("READ_FAST_PATH", "False").lower() in (
+    "true",
+    "1",
+    "t",
+)
+READ_VALIDATION_SAMPLE_RATE = float(
+    getenv("READ_VALIDATION_SAMPLE_RATE", "0.01")
+)
+
+read_validation = Counter()
+Gauge(
+    "read_validation_total",
+    "Documents validated on the fast read path, by result.",
+    lambda: {
+        (result,): read_validation[result] for result in ("sampled", "failed")
+    },
+    ("result",),
+    kind="counter",
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _field_names(selections: list[Selection]) -> set[str]:
+    names = set()
+    for selection in selections:
+        if isinstance(selection, (FragmentSpread, InlineFragment)):
+            names |= _field_names(selection.selections)
+        else:
+            names.add(selection.name)
+    return names
+
+
+def _children(selections: list[Selection], name: str) -> list[Selection]:
+    children = []
+    for selection in selections:
+        if isinstance(selection, (FragmentSpread, InlineFragment)):
+            children.extend(_children(selection.selections, name))
+        elif selection.name == name:
+            children.extend(selection.selections)
+    return children
+
+
+def selected_fields(info: Info, type_: type, *path: str) -> set[str]:
+    """
+    Python names of the fields of a type selected by the current field.
+
+    Args:
+        info (otypes.Info): Info of the resolver.
+        type_ (type): The strawberry type the fields belong to.
+        *path (str): GraphQL field names leading from the current field to
+                     the object of that type, e.g. "edges", "node".
+
+    Returns:
+        (set[str]): The selected fields, empty if the path is not selected.
+    """
+    selections = [
+        selection
+        for field in info.selected_fields
+        for selection in field.selections
+    ]
+    for name in path:
+        selections = _children(selections, name)
+
+    name_converter = info.schema.config.name_converter
+    python_names = {
+        name_converter.from_field(field): field.python_name
+        for field in type_.__strawberry_definition__.fields
+    }
+    return {
+        python_names[name]
+        for name in _field_names(selections)
+        if name in python_names
+    }
+
+
+def projection(model: type[BaseModel], fields: set[str] | None) -> dict | None:
+    """
+    Mongo projection fetching the given fields of a model.
+
+    Args:
+        model (type[BaseModel]): The model of the documents.
+        fields (set[str] | None): Python names of the fields to fetch, None
+                                  to fetch whole documents.
+
+    Returns:
+        (dict | None): The projection, None to fetch whole documents. `_id`
+                       is always fetched.
+    """
+    if fields is None:
+        return None
+    return {"_id": 1} | {
+        model.model_fields[field].alias or field: 1
+        for field in fields
+        if field in model.model_fields
+    }
+
+
+@lru_cache(maxsize=None)
+def _field_adapter(model: type[BaseModel], field: str) -> TypeAdapter:
+    info = model.model_fields[field]
+    # the constraints of the field, e.g. max_length, live in its metadata
+    if not info.metadata:
+        return TypeAdapter(info.annotation)
+    return TypeAdapter(Annotated[info.annotation, *info.metadata])
+
+
+def _parse_datetime(value: Any) -> Any:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+@lru_cache(maxsize=None)
+def _field_converter(
+    model: type[BaseModel], field: str
+) -> Callable[[Any], Any] | None:
+    """
+    Cheap conversion of a stored value to the type of a model field.
+
+    Returns:
+        (Callable | None): The conversion, None if the value is used as is.
+    """
+    annotation = model.model_fields[field].annotation
+    if get_origin(annotation) in (Union, UnionType):
+        # optional fields, None values are never converted
+        args = [arg for arg in get_args(annotation) if arg is not NoneType]
+        if len(args) == 1:
+            annotation = args[0]
+
+    if get_origin(annotation) is list:
+        (item,) = get_args(annotation) or (Any,)
+        if isinstance(item, type) and issubclass(item, Enum):
+            return lambda values: [item(value) for value in values]
+    elif isinstance(annotation, type) and issubclass(annotation, Enum):
+        return annotation
+    elif annotation is datetime:
+        return _parse_datetime
+    return None
+
+
+def _raw_values(
+    model: type[BaseModel], document: dict, fields: set[str] | None
+) -> dict:
+    values = {}
+    for name, info in model.model_fields.items():
+        key = info.alias or name
+        if fields is not None and name not in fields and key != "_id":
+            values[name] = None
+        elif key in document:
+            value = document[key]
+            convert = _field_converter(model, name)
+            if convert is not None and value is not None:
+                value = convert(value)
+            values[name] = value
+        elif info.is_required():
+            raise ValueError(
+                f"{model.__name__} {document.get('_id')} has no {key}"
+            )
+        else:
+            values[name] = info.get_default(call_default_factory=True)
+    return values
+
+
+def _validated_values(
+    model: type[BaseModel], document: dict, fields: set[str]
+) -> dict:
+    values = {}
+    for name, info in model.model_fields.items():
+        key = info.alias or name
+        if name not in fields and key != "_id":
+            values[name] = None
+        elif key in document:
+            values[name] = _field_adapter(model, name).validate_python(
+                document[key]
+            )
+        elif info.is_required():
+            # fails the same way validating the whole document does
+            values[name] = _field_adapter(model, name).validate_python(None)
+        else:
+            values[name] = info.get_default(call_default_factory=True)
+    return values
+
+
+def _sample_validation(
+    model: type[BaseModel], document: dict, fields: set[str] | None
+) -> None:
+    read_validation["sampled"] += 1
+    try:
+        if fields is None:
+            model.model_validate(document)
+        else:
+            _validated_values(model, document, fields)
+    except ValidationError as e:
+        read_validation["failed"] += 1
+        logger.warning(
+            "%s %s does not match its model: %s",
+            model.__name__,
+            document.get("_id"),
+            e,
+        )
+
+
+def from_document(
+    type_: type,
+    model: type[BaseModel],
+    document: dict,
+    fields: set[str] | None,
+) -> Any:
+    """
+    Converts a, possibly partial, document to a strawberry type.
+
+    Args:
+        type_ (type): The strawberry type, generated from `model`.
+        model (type[BaseModel]): The model of the document.
+        document (dict): The document, as fetched with
+                         `projection(model, fields)`.
+        fields (set[str] | None): Python names of the selected fields, None
+                                  if the document is whole.
+
+    Returns:
+        (Any): The strawberry type, fields that were not selected are None.
+
+    Raises:
+        pydantic.ValidationError: If a fetched field is invalid.
+        ValueError: If a required field is missing, on the fast path.
+    """
+    if READ_FAST_PATH and isinstance(document, dict):
+        if random.random() < READ_VALIDATION_SAMPLE_RATE:
+            _sample_validation(model, document, fields)
+        return type_(**_raw_values(model, document, fields))
+
+    if fields is None:
+        return type_.from_pydantic(model.model_validate(document))
+    return type_(**_validated_values(model, document, fields))
@@ -6,23 +6,71 @@ import json
 import os
 from typing import List
 
-import httpx
 import strawberry
+from pymongo.asynchronous.collection import AsyncCollection
 
-from db import ccdb, docsstoragedb
-from models import CCRecruitment, StorageFile
+from cache import (
+    STORAGEFILES_PRIMARY_READ_WINDOW,
+    TTLCache,
+    storagefile_cache,
+    storagefiles_cache,
+)
+from db import (
+    MONGO_MAX_TIME_MS,
+    TITLE_COLLATION,
+    ccdb,
+    docsstorage_reads,
+    docsstoragedb,
+)
+from http_clients import files_client
+from models import CCRecruitment, StorageFile, StorageFileSort, Team
 
 # import all models and types
 from otypes import (
+    CCRecruitmentConnection,
+    CCRecruitmentEdge,
     CCRecruitmentType,
     Info,
+    PageInfo,
     SignedURL,
     SignedURLInput,
+    StorageFileConnection,
+    StorageFileEdge,
     StorageFileType,
 )
-from utils import get_curr_time_str
+from projections import from_document, projection, selected_fields
+from utils import decode_cursor, encode_cursor, get_curr_time_str
 
 inter_communication_secret = os.getenv("INTER_COMMUNICATION_SECRET")
+cc_applications_batch_size = int(
+    os.getenv("CC_APPLICATIONS_BATCH_SIZE", "500")
+)
+max_page_size = int(os.getenv("MAX_PAGE_SIZE", "500"))
+
+
+def cc_applications_filter(year: int, team: Team | None = None) -> dict:
+    """
+    Builds the Mongo filter selecting the CC applications of a year.
+
+    Applications stored before `apply_year` was introduced belong to 2024.
+
+    Args:
+        year (int): The year of application.
+        team (models.Team | None): Only select applications to this team.
+                                   Defaults to None.
+
+    Returns:
+        (dict): The filter.
+    """
+    if year == 2024:
+        query = {"apply_year": {"$in": [year, None]}}
+    else:
+        query = {"apply_year": year}
+
+    if team is not None:
+        query["teams"] = team.value
+
+    return query
 
 
 # fetch signed url from the files service
@@ -47,18 +95,17 @@ async def signedUploadURL(details: SignedURLInput, info: Info) -> SignedURL:
     if not user:
         raise Exception("Not logged in!")
 
-    async with httpx.AsyncClient() as client:
-        # make request to files api
-        response = await client.get(
-            "http://files/signed-url",
-            params={
-                "user": json.dumps(user),
-                "static_file": "true" if details.static_file else "false",
-                "filename": details.filename,
-                "inter_communication_secret": inter_communication_secret,
-                "max_sizeMB": details.max_size_mb,
-            },
-        )
+    # make request to files api
+    response = await files_client().get(
+        "/signed-url",
+        params={
+            "user": json.dumps(user),
+            "static_file": "true" if details.static_file else "false",
+            "filename": details.filename,
+            "inter_communication_secret": inter_communication_secret,
+            "max_sizeMB": details.max_size_mb,
+        },
+    )
 
     # error handling
     if response.status_code != 200:
@@ -71,6 +118,7 @@ async def signedUploadURL(details: SignedURLInput, info: Info) -> SignedURL:
 async def ccApplications(
     info: Info,
     year: int = 2024,
+    team: Team | None = None,
 ) -> List[CCRecruitmentType]:
     """
     Returns list of all CC Applications for CC.
@@ -78,6 +126,8 @@ async def ccApplications(
     Args:
         info (otypes.Info): contains the user's context information.
         year (int): The year of application. Defaults to 2024.
+        team (models.Team | None): Only return applications to this team.
+                                   Defaults to None.
 
     Returns:
         (List[otypes.CCRecruitmentType]): List of all CC Applications
@@ -99,16 +149,105 @@ async def ccApplications(
     if year < 2024:
         raise Exception("Invalid year")
 
-    results = await ccdb.find().to_list(length=None)
+    fields = selected_fields(info, CCRecruitmentType)
+    cursor = ccdb.find(
+        cc_applications_filter(year, team),
+        projection(CCRecruitment, fields),
+        max_time_ms=MONGO_MAX_TIME_MS,
+    ).batch_size(cc_applications_batch_size)
     applications = [
-        CCRecruitmentType.from_pydantic(CCRecruitment.model_validate(result))
-        for result in results
-        if result.get("apply_year", 2024) == year
+        from_document(CCRecruitmentType, CCRecruitment, result, fields)
+        async for result in cursor
     ]
 
     return applications
 
 
+@strawberry.field
+async def ccApplicationsConnection(
+    info: Info,
+    year: int = 2024,
+    first: int = 50,
+    after: str | None = None,
+    team: Team | None = None,
+) -> CCRecruitmentConnection:
+    """
+    Returns a page of CC Applications for CC.
+
+    Applications are ordered by their id, i.e. by submission.
+
+    Args:
+        info (otypes.Info): contains the user's context information.
+        year (int): The year of application. Defaults to 2024.
+        first (int): Number of applications in the page. Defaults to 50.
+        after (str | None): Cursor of the last application of the previous
+                            page. Defaults to None.
+        team (models.Team | None): Only return applications to this team.
+                                   Defaults to None.
+
+    Returns:
+        (otypes.CCRecruitmentConnection): The page of CC Applications.
+
+    Raises:
+        Exception: Not logged in!
+        Exception: Not Authenticated to access this API!!
+        Exception: Invalid year
+        Exception: Invalid page size
+        ValueError: Invalid cursor
+    """
+
+    user = info.context.user
+    if not user:
+        raise Exception("Not logged in!")
+
+    if user.get("role", None) not in ["cc"]:
+        raise Exception("Not Authenticated to access this API!!")
+
+    if year < 2024:
+        raise Exception("Invalid year")
+
+    if first < 1 or first > max_page_size:
+        raise Exception("Invalid page size")
+
+    query = cc_applications_filter(year, team)
+    if after is not None:
+        query["_id"] = {"$gt": decode_cursor(after)[0]}
+
+    fields = selected_fields(info, CCRecruitmentType, "edges", "node")
+
+    # fetch one extra document to know if there is a next page
+    cursor = (
+        ccdb.find(
+            query,
+            projection(CCRecruitment, fields),
+            max_time_ms=MONGO_MAX_TIME_MS,
+        )
+        .sort("_id", 1)
+        .limit(first + 1)
+        .batch_size(min(first + 1, cc_applications_batch_size))
+    )
+    edges = [
+        CCRecruitmentEdge(
+            cursor=encode_cursor(str(result["_id"])),
+            node=from_document(
+                CCRecruitmentType, CCRecruitment, result, fields
+            ),
+        )
+        async for result in cursor
+    ]
+
+    has_next_page = len(edges) > first
+    edges = edges[:first]
+
+    return CCRecruitmentConnection(
+        edges=edges,
+        page_info=PageInfo(
+            has_next_page=has_next_page,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
+    )
+
+
 @strawberry.field
 async def haveAppliedForCC(info: Info, year: int | None = None) -> bool:
     """
@@ -141,34 +280,70 @@ async def haveAppliedForCC(info: Info, year: int | None = None) -> bool:
         raise Exception("Invalid year")
 
     # check if user already applied in the same year
-    results = await ccdb.find({"uid": user["uid"]}).to_list(length=None)
-    for result in results:
-        if result.get("apply_year", 2024) == year:
-            return True
-    return False
+    result = await ccdb.find_one(
+        {"uid": user["uid"], **cc_applications_filter(year)},
+        {"_id": 1},
+        max_time_ms=MONGO_MAX_TIME_MS,
+    )
+    return result is not None
 
 
 # Storagefile queries
 
 
+def storagefile_reads(cache: TTLCache) -> AsyncCollection:
+    """
+    Collection to fill a storage file cache from.
+
+    Args:
+        cache (cache.TTLCache): The cache being filled.
+
+    Returns:
+        (AsyncCollection): The primary right after an invalidation, as a
+                           secondary may not have the write yet, otherwise
+                           the collection of public reads.
+    """
+    if cache.invalidated_within(STORAGEFILES_PRIMARY_READ_WINDOW):
+        return docsstoragedb
+    return docsstorage_reads
+
+
 @strawberry.field
-async def storagefiles(filetype: str) -> List[StorageFileType]:
+async def storagefiles(filetype: str, info: Info) -> List[StorageFileType]:
     """
     Gets all the storage files, has public access
 
+    Whole files are fetched while the cache is enabled, so that one cached
+    list serves every selection; otherwise only the selected fields are.
+
     Args:
         filetype (str): The type of file to get.
+        info (otypes.Info): contains the user's context information.
 
     Returns:
         (List[otypes.StorageFileType]): List of storage files of the given type
     """
-    storage_files = await docsstoragedb.find({"filetype": filetype}).to_list(
-        length=None
+    storage_files = storagefiles_cache.get(filetype)
+    if storage_files is not None:
+        return storage_files
+
+    fields = (
+        selected_fields(info, StorageFileType)
+        if not storagefiles_cache.enabled
+        else None
     )
-    return [
-        StorageFileType.from_pydantic(StorageFile.model_validate(storage_file))
-        for storage_file in storage_files
+    generation = storagefiles_cache.generation
+    storage_files = [
+        from_document(StorageFileType, StorageFile, storage_file, fields)
+        async for storage_file in storagefile_reads(storagefiles_cache).find(
+            {"filetype": filetype},
+            projection(StorageFile, fields),
+            max_time_ms=MONGO_MAX_TIME_MS,
+        )
     ]
+    storagefiles_cache.set(filetype, storage_files, generation)
+
+    return storage_files
 
 
 @strawberry.field
@@ -182,9 +357,113 @@ async def storagefile(file_id: str) -> StorageFileType:
     Returns:
         (otypes.StorageFileType): The storage file with the given id
     """
-    storage_file = await docsstoragedb.find_one({"_id": file_id})
-    return StorageFileType.from_pydantic(
-        StorageFile.model_validate(storage_file)
+    cached = storagefile_cache.get(file_id)
+    if cached is not None:
+        return cached
+
+    generation = storagefile_cache.generation
+    reads = storagefile_reads(storagefile_cache)
+    storage_file = await reads.find_one(
+        {"_id": file_id}, max_time_ms=MONGO_MAX_TIME_MS
+    )
+    if storage_file is None and reads is not docsstoragedb:
+        # a file created moments ago may not have reached the secondary
+        storage_file = await docsstoragedb.find_one(
+            {"_id": file_id}, max_time_ms=MONGO_MAX_TIME_MS
+        )
+    storage_file = from_document(
+        StorageFileType, StorageFile, storage_file, None
+    )
+    storagefile_cache.set(file_id, storage_file, generation)
+
+    return storage_file
+
+
+@strawberry.field
+async def storagefilesConnection(
+    info: Info,
+    filetype: str,
+    first: int = 20,
+    after: str | None = None,
+    sort_by: StorageFileSort = StorageFileSort.modified_time,
+    descending: bool = True,
+) -> StorageFileConnection:
+    """
+    Gets a page of the storage files of a type, has public access
+
+    Titles are compared ignoring case. Files with the same title or
+    modification time are ordered by their id.
+
+    Args:
+        info (otypes.Info): contains the user's context information.
+        filetype (str): The type of file to get.
+        first (int): Number of files in the page. Defaults to 20.
+        after (str | None): Cursor of the last file of the previous page.
+                            Defaults to None.
+        sort_by (models.StorageFileSort): The field to sort by. Defaults to
+                                          modified_time.
+        descending (bool): Whether to sort in descending order. Defaults to
+                           True, i.e. latest first.
+
+    Returns:
+        (otypes.StorageFileConnection): The page of storage files.
+
+    Raises:
+        Exception: Invalid page size
+        ValueError: Invalid cursor
+    """
+    if first < 1 or first > max_page_size:
+        raise Exception("Invalid page size")
+
+    key = sort_by.value
+    direction = -1 if descending else 1
+    operator = "$lt" if descending else "$gt"
+
+    query = {"filetype": filetype}
+    if after is not None:
+        cursor_values = decode_cursor(after)
+        if len(cursor_values) != 2:
+            raise ValueError("Invalid cursor")
+        value, last_id = cursor_values
+        query["$or"] = [
+            {key: {operator: value}},
+            {key: value, "_id": {operator: last_id}},
+        ]
+
+    fields = selected_fields(info, StorageFileType, "edges", "node")
+
+    # fetch one extra document to know if there is a next page
+    cursor = (
+        docsstorage_reads.find(
+            query,
+            projection(StorageFile, fields | {key}),
+            collation=(
+                TITLE_COLLATION if sort_by == StorageFileSort.title else None
+            ),
+            max_time_ms=MONGO_MAX_TIME_MS,
+        )
+        .sort([(key, direction), ("_id", direction)])
+        .limit(first + 1)
+    )
+    edges = [
+        StorageFileEdge(
+            cursor=encode_cursor(storage_file[key], str(storage_file["_id"])),
+            node=from_document(
+                StorageFileType, StorageFile, storage_file, fields
+            ),
+        )
+        async for storage_file in cursor
+    ]
+
+    has_next_page = len(edges) > first
+    edges = edges[:first]
+
+    return StorageFileConnection(
+        edges=edges,
+        page_info=PageInfo(
+            has_next_page=has_next_page,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
     )
 
 
@@ -192,7 +471,9 @@ async def storagefile(file_id: str) -> StorageFileType:
 queries = [
     signedUploadURL,
     ccApplications,
+    ccApplicationsConnection,
     haveAppliedForCC,
     storagefiles,
     storagefile,
+    storagefilesConnection,
 ]
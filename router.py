@@ -0,0 +1,288 @@
+"""
+GraphQL HTTP Router Module.
+
+Extends Strawberry's FastAPI `GraphQLRouter` so that the public queries can be
+cached by the gateway, CDNs and browsers:
+
+- Automatic persisted queries (APQ): clients may send only the sha256 hash of
+  a query, in the `persistedQuery` extension, instead of its full text. An
+  unknown hash is answered with a `PersistedQueryNotFound` error, after which
+  the client sends hash and text together and the text is remembered in a
+  store with bounded memory.
+- Cacheable GET: read-only operations sent via GET get an `ETag` derived from
+  the response data and a `Cache-Control` header, `public` for operations
+  selecting only public fields and `private` otherwise. A request whose
+  `If-None-Match` matches the `ETag` is answered with an empty 304.
+
+Every operation is also run under the admission control of `admission.py`,
+operations that are not admitted are answered with a 503 and `Retry-After`.
+
+Attributes:
+    PERSISTED_QUERIES_MAX_BYTES (int): Memory budget, in bytes of query
+                                       text, of the persisted query store.
+                                       Defaults to 4 MiB.
+    PUBLIC_CACHE_MAX_AGE (int): `max-age` of public GET responses, in
+                                seconds. Defaults to 60.
+    PUBLIC_FIELDS (set): Root fields that return the same data to everyone.
+    persisted_queries (PersistedQueryStore): The persisted query store.
+"""
+
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from os import getenv
+
+from fastapi import HTTPException, Request, Response
+from graphql import GraphQLError, GraphQLSyntaxError, OperationDefinitionNode
+from graphql import parse as parse_document
+from strawberry.fastapi import GraphQLRouter
+from strawberry.http import GraphQLRequestData
+from strawberry.types import ExecutionResult
+from strawberry.types.unset import UNSET
+
+from admission import OverloadedError, admission, operation_priority
+
+PERSISTED_QUERIES_MAX_BYTES = int(
+    getenv("PERSISTED_QUERIES_MAX_BYTES", str(4 * 1024 * 1024))
+)
+PUBLIC_CACHE_MAX_AGE = int(getenv("PUBLIC_CACHE_MAX_AGE", "60"))
+
+PUBLIC_FIELDS = {
+    "storagefiles",
+    "storagefile",
+    "storagefilesConnection",
+    "__typename",
+}
+
+
+class PersistedQueryStore:
+    """
+    Maps sha256 hashes to query texts, within a fixed memory budget.
+
+    The least recently used queries are evicted once the total size of the
+    stored query texts exceeds the budget.
+
+    Attributes:
+        max_bytes (int): Memory budget in bytes of query text.
+        size (int): Bytes of query text currently stored, UTF-8 encoded.
+    """
+
+    def __init__(self, max_bytes: int = PERSISTED_QUERIES_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # query texts along with their size in bytes, by hash
+        self._queries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._queries)
+
+    def get(self, sha256_hash: str) -> str | None:
+        entry = self._queries.get(sha256_hash)
+        if entry is None:
+            return None
+        self._queries.move_to_end(sha256_hash)
+        return entry[0]
+
+    def add(self, sha256_hash: str, query: str) -> None:
+        size = len(query.encode())
+        if sha256_hash in self._queries or size > self.max_bytes:
+            return
+
+        self._queries[sha256_hash] = (query, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._queries.popitem(last=False)
+            self.size -= evicted
+
+
+persisted_queries = PersistedQueryStore()
+
+
+@lru_cache(maxsize=256)
+def root_fields(query: str, operation_name: str | None) -> frozenset[str]:
+    """
+    Names of the root fields an operation selects.
+
+    Args:
+        query (str): The query text.
+        operation_name (str | None): The operation to run, if there are many.
+
+    Returns:
+        (frozenset[str]): The root field names, empty if the operation can
+                          not be determined.
+    """
+    try:
+        document = parse_document(query)
+    except GraphQLSyntaxError:
+        return frozenset()
+
+    operations = [
+        definition
+        for definition in document.definitions
+        if isinstance(definition, OperationDefinitionNode)
+        and (
+            operation_name is None
+            # anonymous operations never match a name
+            or (
+                definition.name is not None
+                and definition.name.value == operation_name
+            )
+        )
+    ]
+    if len(operations) != 1:
+        return frozenset()
+
+    fields = set()
+    for selection in operations[0].selection_set.selections:
+        # fragments may select anything, treat them as non public
+        if not hasattr(selection, "alias"):
+            return frozenset({"..."})
+        fields.add(selection.name.value)
+    return frozenset(fields)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(
+        tag.removeprefix("W/") == etag for tag in candidates
+    )
+
+
+class CachingGraphQLRouter(GraphQLRouter):
+    """
+    `GraphQLRouter` with automatic persisted queries, cacheable GETs and
+    admission control.
+    """
+
+    def should_render_graphql_ide(self, request) -> bool:
+        # a persisted query GET carries no query text, it is not the IDE
+        return super().should_render_graphql_ide(request) and (
+            request.query_params.get("extensions") is None
+        )
+
+    async def execute_single(
+        self,
+        request,
+        request_adapter,
+        sub_response,
+        context,
+        root_value,
+        request_data: GraphQLRequestData,
+    ) -> ExecutionResult:
+        persisted = (request_data.extensions or {}).get("persistedQuery")
+        if isinstance(persisted, dict):
+            error = self._resolve_persisted_query(request_data, persisted)
+            if error is not None:
+                return ExecutionResult(data=None, errors=[error])
+
+        fields = (
+            root_fields(request_data.query, request_data.operation_name)
+            if request_data.query is not None
+            else frozenset()
+        )
+        try:
+            async with admission.admit(operation_priority(fields)):
+                result = await super().execute_single(
+                    request=request,
+                    request_adapter=request_adapter,
+                    sub_response=sub_response,
+                    context=context,
+                    root_value=root_value,
+                    request_data=request_data,
+                )
+        except OverloadedError as e:
+            sub_response.status_code = 503
+            sub_response.headers["Retry-After"] = str(e.retry_after)
+            sub_response.headers["Cache-Control"] = "no-store"
+            return ExecutionResult(
+                data=None,
+                errors=[
+                    GraphQLError(
+                        str(e), extensions={"code": "SERVICE_UNAVAILABLE"}
+                    )
+                ],
+            )
+
+        if request_adapter.method == "GET":
+            sub_response.headers["Cache-Control"] = self._cache_control(
+                request_data, result
+            )
+        return result
+
+    @staticmethod
+    def _resolve_persisted_query(
+        request_data: GraphQLRequestData, persisted: dict
+    ) -> GraphQLError | None:
+        """
+        Fills in, or remembers, the query text of a persisted query.
+
+        Returns:
+            (GraphQLError | None): The error to answer with, if any.
+
+        Raises:
+            HTTPException: If the hash does not match the query.
+        """
+        if persisted.get("version") != 1:
+            return GraphQLError(
+                "Unsupported persisted query version",
+                extensions={"code": "PERSISTED_QUERY_NOT_SUPPORTED"},
+            )
+
+        sha256_hash = persisted.get("sha256Hash")
+        if not isinstance(sha256_hash, str):
+            raise HTTPException(400, "Missing persisted query hash")
+
+        if request_data.query is None:
+            request_data.query = persisted_queries.get(sha256_hash)
+            if request_data.query is None:
+                return GraphQLError(
+                    "PersistedQueryNotFound",
+                    extensions={"code": "PERSISTED_QUERY_NOT_FOUND"},
+                )
+            return None
+
+        digest = hashlib.sha256(request_data.query.encode()).hexdigest()
+        if digest != sha256_hash:
+            raise HTTPException(400, "provided sha does not match query")
+        persisted_queries.add(sha256_hash, request_data.query)
+        return None
+
+    @staticmethod
+    def _cache_control(
+        request_data: GraphQLRequestData, result: ExecutionResult
+    ) -> str:
+        if result.errors or request_data.query is None:
+            return "no-store"
+
+        fields = root_fields(request_data.query, request_data.operation_name)
+        if fields and fields <= PUBLIC_FIELDS:
+            return f"public, max-age={PUBLIC_CACHE_MAX_AGE}"
+        return "private, no-cache"
+
+    async def run(self, request, context=UNSET, root_value=UNSET):
+        response = await super().run(
+            request, context=context, root_value=root_value
+        )
+
+        if (
+            not isinstance(request, Request)
+            or request.method != "GET"
+            or response.status_code != 200
+            or not hasattr(response, "body")
+            or response.headers.get("Cache-Control", "no-store") == "no-store"
+        ):
+            return response
+
+        etag = f'"{hashlib.sha256(response.body).hexdigest()[:32]}"'
+        response.headers["ETag"] = etag
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(
+                status_code=304,
+                headers={
+                    "ETag": etag,
+                    "Cache-Control": response.headers["Cache-Control"],
+                },
+            )
+        return response
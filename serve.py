@@ -0,0 +1,172 @@
+"""
+Pre-fork Server.
+
+Serves the application with one or more worker processes. The application,
+and with it the Strawberry schema and the pydantic models, is imported once
+in the parent process; workers are forked from it and accept connections on
+a socket they all inherit, so they start without rebuilding anything.
+
+Every worker opens its own Mongo connections and HTTP clients: the Mongo
+client of `db.py` connects on first use, which happens after the fork, and
+the HTTP clients are started by the lifespan of each worker. State that has
+to agree across workers, like the Graph token and cache invalidations, is
+shared through the files of `shared.py`; everything else is per worker,
+e.g. `ADMISSION_MAX_CONCURRENCY` applies to each worker on its own.
+
+The background jobs, the mail outbox and the CC digest, run in the first
+worker only, so their concurrency does not grow with the number of workers.
+Every worker is told its index in `SERVER_WORKER_INDEX`, and a worker that
+is replaced keeps the index of the one it replaces.
+Metrics are kept per worker too, and served by every worker for all of
+them with a `worker` label, see `metrics.py`.
+
+A worker that dies is replaced. SIGTERM or SIGINT shuts all workers down
+gracefully.
+
+Usage:
+
+    python serve.py --host 0.0.0.0 --port 80 --workers 4
+
+Attributes:
+    SERVER_WORKERS (int): Number of worker processes, 0 for one per CPU
+                          core. Defaults to 1, a single process without
+                          forking.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+import uvicorn
+from uvicorn.importer import import_from_string
+
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def run_worker(config: uvicorn.Config, sock: socket.socket) -> None:
+    """
+    Serves on the inherited socket until told to stop, in a forked worker.
+    """
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn(config: uvicorn.Config, sock: socket.socket, index: int) -> int:
+    """
+    Forks a worker.
+
+    Args:
+        config (uvicorn.Config): Configuration of the server.
+        sock (socket.socket): The socket to serve on.
+        index (int): Index of the worker, 0 runs the background jobs.
+
+    Returns:
+        (int): Process id of the worker.
+    """
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    os.environ["SERVER_WORKER_INDEX"] = str(index)
+    status = 0
+    try:
+        run_worker(config, sock)
+    except BaseException:
+        logger.exception("Worker %d crashed", os.getpid())
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def supervise(config: uvicorn.Config, workers: int) -> None:
+    """
+    Runs the workers until SIGTERM or SIGINT, replacing those that die.
+
+    Args:
+        config (uvicorn.Config): Configuration of the server.
+        workers (int): Number of worker processes.
+    """
+    sock = config.bind_socket()
+    # worker indexes by process id
+    children = {spawn(config, sock, index): index for index in range(workers)}
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+
+        logger.warning(
+            "Worker %d exited with status %d, restarting it",
+            pid,
+            os.waitstatus_to_exitcode(status),
+        )
+        # do not spin if workers die right away, e.g. on a bad config
+        time.sleep(1)
+        if not stopping:
+            children[spawn(config, sock, index)] = index
+
+    sock.close()
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--app", default="main:app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--log-config")
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    state_dir = None
+    if workers > 1 and not os.getenv("SHARED_STATE_DIR"):
+        # private to this server, must be set before the app is imported
+        state_dir = tempfile.mkdtemp(prefix="interfaces-")
+        os.environ["SHARED_STATE_DIR"] = state_dir
+
+    config = uvicorn.Config(
+        # builds the schema and models once, before forking
+        import_from_string(args.app),
+        host=args.host,
+        port=args.port,
+        **({"log_config": args.log_config} if args.log_config else {}),
+    )
+
+    try:
+        if workers == 1:
+            uvicorn.Server(config).run()
+        else:
+            logger.info("Starting %d workers", workers)
+            supervise(config, workers)
+    finally:
+        if state_dir is not None:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_cli()
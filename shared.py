@@ -0,0 +1,162 @@
+"""
+Shared State Module.
+
+State that has to agree across the worker processes started by `serve.py`,
+kept in small files of a directory only those processes use: counters and
+floats in memory-mapped files, and JSON documents replaced atomically.
+Updates are serialized with `fcntl` file locks, so no extra service is
+needed.
+
+A single process shares nothing, and every helper falls back to plain
+in-process state.
+
+Attributes:
+    SHARED_STATE_DIR (str): Directory of the shared state files, empty when
+                            state is not shared. `serve.py` sets it for its
+                            workers. Defaults to "".
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+SHARED_STATE_DIR = os.getenv("SHARED_STATE_DIR", "")
+
+_COUNTER = struct.Struct("<Q")
+
+
+def shared_path(name: str) -> str | None:
+    """
+    Path of a shared state file, None when state is not shared.
+    """
+    if not SHARED_STATE_DIR:
+        return None
+    return os.path.join(SHARED_STATE_DIR, name)
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """
+    Holds an exclusive lock on `<path>.lock`, blocking until it is free.
+    """
+    fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class SharedCounter:
+    """
+    Counter in a memory-mapped file, seen by every process mapping it.
+
+    Reading the value is a memory read; increments are serialized with a
+    file lock.
+
+    Attributes:
+        path (str): Path of the file holding the counter.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < _COUNTER.size:
+                os.ftruncate(fd, _COUNTER.size)
+            self._map = mmap.mmap(fd, _COUNTER.size)
+        finally:
+            os.close(fd)
+
+    @property
+    def value(self) -> int:
+        return _COUNTER.unpack_from(self._map)[0]
+
+    def increment(self) -> int:
+        """
+        Adds one to the counter.
+
+        Returns:
+            (int): The new value.
+        """
+        with file_lock(self.path):
+            value = self.value + 1
+            _COUNTER.pack_into(self._map, 0, value)
+        return value
+
+
+class SharedFloats:
+    """
+    Fixed number of floats in a memory-mapped file, all zero at first.
+
+    Reads and writes are not synchronized; hold `locked()` around a read
+    and the write depending on it.
+
+    Attributes:
+        path (str): Path of the file holding the floats.
+        count (int): Number of floats.
+    """
+
+    def __init__(self, path: str, count: int):
+        self.path = path
+        self.count = count
+        self._struct = struct.Struct(f"<{count}d")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < self._struct.size:
+                os.ftruncate(fd, self._struct.size)
+            self._map = mmap.mmap(fd, self._struct.size)
+        finally:
+            os.close(fd)
+
+    def locked(self):
+        return file_lock(self.path)
+
+    def read(self) -> tuple[float, ...]:
+        return self._struct.unpack_from(self._map)
+
+    def write(self, values: list[float]) -> None:
+        self._struct.pack_into(self._map, 0, *values)
+
+
+def shared_counter(name: str) -> SharedCounter | None:
+    """
+    The shared counter of the given name, None when state is not shared.
+    """
+    path = shared_path(f"{name}.counter")
+    return SharedCounter(path) if path is not None else None
+
+
+def read_json(path: str) -> Any | None:
+    """
+    Reads a shared JSON document, None if it does not exist or is invalid.
+    """
+    try:
+        with open(path) as file:
+            text = file.read()
+    except OSError:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def write_json(path: str, value: Any) -> None:
+    """
+    Replaces a shared JSON document, readers never see a partial write.
+    """
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(value, file)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
@@ -0,0 +1,510 @@
+"""
+Mail Send Scheduler Module.
+
+Graph limits how many mails a mailbox may send per minute and per day, and
+answers bursts beyond that with 429s. Every send therefore goes through a
+scheduler that paces it with token buckets of the sending mailbox: a mail
+leaves once every bucket has a token for it. Waiting mails leave by
+priority lane, so applicant confirmations overtake bulk announcements.
+
+A 429 or 503 pauses the mailbox for the `Retry-After` period, or an
+exponential backoff without one, and halves its send rate; every accepted
+mail afterwards wins back a tenth of the configured rate. Throttled sends
+reported during a pause count as the same throttling event. The throttled
+mail is retried up to `MAIL_THROTTLE_RETRIES` times before its outcome is
+handed back to the caller.
+
+A mail waits in the scheduler for `MAIL_SCHEDULER_MAX_WAIT` at most; one
+that is not on its way to Graph by then fails with `ThrottledError`, so the
+outbox reschedules it long before the lease of its claim runs out.
+
+With several worker processes (see `serve.py`) the buckets, the pause and
+the rate factor live in shared memory, so the workers share one budget per
+mailbox and all of them hold back once Graph throttles one of them.
+
+Attributes:
+    MAIL_SCHEDULER_ENABLED (bool): Whether sends are paced, otherwise they
+                                   go out right away. Defaults to True.
+    MAIL_RATE_PER_MINUTE (float): Mails a mailbox may send per minute.
+                                  Defaults to 30.
+    MAIL_BURST (float): Mails a mailbox may send at once after being idle.
+                        Defaults to 10.
+    MAIL_DAILY_LIMIT (float): Mails a mailbox may send per day. Defaults to
+                              10000.
+    MAIL_THROTTLE_RETRIES (int): Retries of a throttled mail. Defaults to 2.
+    MAIL_THROTTLE_BACKOFF_BASE (float): Pause in seconds after a throttled
+                                        send without `Retry-After`, doubled
+                                        for every further one. Defaults to
+                                        5.
+    MAIL_THROTTLE_BACKOFF_MAX (float): Upper bound of the pause in seconds.
+                                       Defaults to 120.
+    MAIL_SCHEDULER_MAX_WAIT (float): Seconds a mail may wait before being
+                                     sent, at most half of
+                                     `MAIL_OUTBOX_LEASE`. Defaults to 60.
+    THROTTLED_STATUS_CODES (set): Graph status codes asking us to slow down.
+    send_scheduler (SendScheduler): The process-wide scheduler.
+"""
+
+import asyncio
+import heapq
+import itertools
+import re
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager
+from os import getenv
+from typing import Any
+
+from metrics import Counter, Gauge, Histogram
+from models import MailPriority
+from shared import SharedFloats, shared_path
+
+MAIL_SCHEDULER_ENABLED = getenv("MAIL_SCHEDULER_ENABLED", "True").lower() in (
+    "true",
+    "1",
+    "t",
+)
+MAIL_RATE_PER_MINUTE = float(getenv("MAIL_RATE_PER_MINUTE", "30"))
+MAIL_BURST = float(getenv("MAIL_BURST", "10"))
+MAIL_DAILY_LIMIT = float(getenv("MAIL_DAILY_LIMIT", "10000"))
+MAIL_THROTTLE_RETRIES = int(getenv("MAIL_THROTTLE_RETRIES", "2"))
+MAIL_THROTTLE_BACKOFF_BASE = float(getenv("MAIL_THROTTLE_BACKOFF_BASE", "5"))
+MAIL_THROTTLE_BACKOFF_MAX = float(getenv("MAIL_THROTTLE_BACKOFF_MAX", "120"))
+MAIL_SCHEDULER_MAX_WAIT = float(getenv("MAIL_SCHEDULER_MAX_WAIT", "60"))
+
+THROTTLED_STATUS_CODES = {429, 503}
+
+# lowest share of the configured rate adaptive backoff goes down to
+MIN_RATE_FACTOR = 0.1
+
+wait_seconds = Histogram(
+    "mail_scheduler_wait_seconds",
+    "Time mails waited in the send scheduler, by priority.",
+    ("priority",),
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+throttled_sends = Counter(
+    "mail_scheduler_throttled_total",
+    "Sends Graph throttled, by status code.",
+    ("status",),
+)
+
+
+class ThrottledError(Exception):
+    """
+    Raised when a mail waited too long in the scheduler to be sent.
+
+    Attributes:
+        retry_after (float | None): Seconds left of the throttling pause of
+                                    the mailbox, if it is paused.
+    """
+
+    def __init__(self, retry_after: float | None = None):
+        super().__init__("Mail waited too long to be sent")
+        self.retry_after = retry_after
+
+
+class MailboxBudget:
+    """
+    Send budget of a mailbox: token buckets and the throttling state.
+
+    Bucket `i` holds up to `capacities[i]` tokens and gains `rates[i]`
+    tokens per second, scaled by the rate factor; a mail takes a token from
+    every bucket. A throttling event pauses the mailbox and halves the
+    factor, accepted mails win it back a tenth at a time.
+
+    The state is kept as the tokens of every bucket, the time of their last
+    update, the end of the pause, how much the factor is lowered, and the
+    number of throttling events in a row; in memory, or in a shared file
+    so that every process sees the same budget and pause. A zeroed state
+    reads as full buckets at the configured rate.
+
+    Attributes:
+        rates (List[float]): Tokens gained per second by every bucket.
+        capacities (List[float]): Size of every bucket.
+    """
+
+    def __init__(
+        self,
+        rates: list[float],
+        capacities: list[float],
+        shared: SharedFloats | None = None,
+    ):
+        self.rates = rates
+        self.capacities = capacities
+        self._shared = shared
+        self._state = [0.0] * self.size(len(rates))
+
+    @staticmethod
+    def size(buckets: int) -> int:
+        """
+        Number of floats in the state of a budget with that many buckets.
+        """
+        return buckets + 4
+
+    @contextmanager
+    def _locked(self) -> Iterator[list[float]]:
+        if self._shared is None:
+            yield self._state
+            return
+        with self._shared.locked():
+            state = list(self._shared.read())
+            yield state
+            self._shared.write(state)
+
+    def _fields(self, state: list[float]) -> tuple[float, float, float, int]:
+        # last update, end of the pause, lowering of the factor, strikes
+        last, paused_until, lowered, strikes = state[len(self.rates) :]
+        return last, paused_until, lowered, int(strikes)
+
+    def take(self) -> float:
+        """
+        Takes a token from every bucket, if all of them have one.
+
+        Returns:
+            (float): 0 if the tokens were taken, otherwise seconds until
+                     they are expected to be available.
+        """
+        now = time.time()
+        with self._locked() as state:
+            last, paused_until, lowered, _ = self._fields(state)
+            if paused_until > now:
+                return paused_until - now
+
+            factor = 1 - lowered
+            elapsed = max(now - last, 0.0)
+            tokens = [
+                min(capacity, value + rate * factor * elapsed)
+                for value, rate, capacity in zip(
+                    state, self.rates, self.capacities
+                )
+            ]
+            state[len(self.rates)] = now
+            delay = max(
+                (1 - value) / (rate * factor) if value < 1 else 0.0
+                for value, rate in zip(tokens, self.rates)
+            )
+            if delay == 0:
+                tokens = [value - 1 for value in tokens]
+            state[: len(self.rates)] = tokens
+            return delay
+
+    def throttled(self, retry_after: float | None) -> bool:
+        """
+        Pauses the mailbox and halves its rate, once per throttling event.
+
+        Throttled sends reported during a pause, e.g. the other mails of the
+        same `$batch`, belong to the event that started it and are ignored.
+
+        Args:
+            retry_after (float | None): Pause asked for by Graph, if any.
+
+        Returns:
+            (bool): Whether this started a new pause.
+        """
+        now = time.time()
+        with self._locked() as state:
+            _, paused_until, lowered, strikes = self._fields(state)
+            if paused_until > now:
+                return False
+
+            strikes += 1
+            if retry_after is None:
+                retry_after = min(
+                    MAIL_THROTTLE_BACKOFF_MAX,
+                    MAIL_THROTTLE_BACKOFF_BASE * 2 ** (strikes - 1),
+                )
+            factor = max(MIN_RATE_FACTOR, (1 - lowered) / 2)
+            state[len(self.rates) + 1 :] = [
+                now + retry_after,
+                1 - factor,
+                strikes,
+            ]
+            return True
+
+    def accepted(self) -> None:
+        """
+        Ends a series of throttling events and wins back some of the rate.
+        """
+        with self._locked() as state:
+            _, paused_until, lowered, _ = self._fields(state)
+            state[len(self.rates) + 1 :] = [
+                paused_until,
+                max(0.0, lowered - 0.1),
+                0,
+            ]
+
+    def status(self) -> tuple[float, float]:
+        """
+        Seconds left of the pause, and the share of the rates in effect.
+        """
+        with self._locked() as state:
+            _, paused_until, lowered, _ = self._fields(state)
+        return max(paused_until - time.time(), 0.0), 1 - lowered
+
+
+class _Mailbox:
+    def __init__(self, budget: MailboxBudget):
+        self.budget = budget
+        # (priority, sequence, enqueued, deadline, attempts, send, future)
+        self.queue: list[tuple] = []
+        self.wakeup = asyncio.Event()
+        self.runner: asyncio.Task | None = None
+
+
+class SendScheduler:
+    """
+    Paces sends per mailbox with token buckets, in priority order.
+
+    Every mailbox with waiting mails has a loop handing its mails, one at a
+    time, to their send function as soon as its buckets allow; sends run
+    concurrently, so `$batch` coalescing still applies.
+
+    Attributes:
+        rate_per_minute (float): Mails a mailbox may send per minute.
+        burst (float): Mails a mailbox may send at once after being idle.
+        daily_limit (float): Mails a mailbox may send per day.
+        retries (int): Retries of a throttled mail.
+        max_wait (float): Seconds a mail may wait before being sent.
+
+    Raises:
+        Exception: If the rates, the burst or the limits cannot work.
+    """
+
+    def __init__(
+        self,
+        rate_per_minute: float = MAIL_RATE_PER_MINUTE,
+        burst: float = MAIL_BURST,
+        daily_limit: float = MAIL_DAILY_LIMIT,
+        retries: int = MAIL_THROTTLE_RETRIES,
+        max_wait: float = MAIL_SCHEDULER_MAX_WAIT,
+    ):
+        if rate_per_minute <= 0 or daily_limit < 1 or burst < 1:
+            raise Exception(
+                "MAIL_RATE_PER_MINUTE must be positive, MAIL_BURST and "
+                "MAIL_DAILY_LIMIT at least 1"
+            )
+        if retries < 0 or max_wait <= 0:
+            raise Exception(
+                "MAIL_THROTTLE_RETRIES must not be negative and "
+                "MAIL_SCHEDULER_MAX_WAIT must be positive"
+            )
+
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.retries = retries
+        self.max_wait = max_wait
+        self._mailboxes: dict[str, _Mailbox] = {}
+        self._sequence = itertools.count()
+        self._tasks: set[asyncio.Task] = set()
+        # futures of the mails being sent right now
+        self._sending: set[asyncio.Future] = set()
+
+    def _mailbox(self, name: str) -> _Mailbox:
+        mailbox = self._mailboxes.get(name)
+        if mailbox is None:
+            path = shared_path("mail_budget_" + re.sub(r"\W", "_", name))
+            shared = None
+            if path is not None:
+                shared = SharedFloats(path, MailboxBudget.size(2))
+            mailbox = self._mailboxes[name] = _Mailbox(
+                MailboxBudget(
+                    [self.rate_per_minute / 60, self.daily_limit / 86400],
+                    [self.burst, self.daily_limit],
+                    shared,
+                )
+            )
+        return mailbox
+
+    async def submit(
+        self,
+        mailbox: str,
+        priority: MailPriority,
+        send: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        """
+        Waits for the turn of a mail, then sends it.
+
+        Args:
+            mailbox (str): The sending mailbox.
+            priority (models.MailPriority): Lane of the mail.
+            send (Callable): Sends the mail and returns its `MailResult`;
+                             called again for every retry.
+
+        Returns:
+            (mailing.MailResult): The outcome of the last attempt.
+
+        Raises:
+            ThrottledError: If the mail was not sent within `max_wait`.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        state = self._mailbox(mailbox)
+        enqueued = time.monotonic()
+        deadline = enqueued + self.max_wait
+        timer = loop.call_at(
+            loop.time() + self.max_wait, self._expire, state, future
+        )
+        future.add_done_callback(lambda _: timer.cancel())
+        self._enqueue(
+            state,
+            (
+                priority,
+                next(self._sequence),
+                enqueued,
+                deadline,
+                0,
+                send,
+                future,
+            ),
+        )
+        return await future
+
+    def _expire(self, mailbox: _Mailbox, future: asyncio.Future) -> None:
+        # a mail on its way to Graph gets its outcome
+        if future.done() or future in self._sending:
+            return
+        pause, _ = mailbox.budget.status()
+        future.set_exception(ThrottledError(pause or None))
+
+    def _enqueue(self, mailbox: _Mailbox, item: tuple) -> None:
+        heapq.heappush(mailbox.queue, item)
+        mailbox.wakeup.set()
+        if mailbox.runner is None or mailbox.runner.done():
+            mailbox.runner = asyncio.create_task(self._run(mailbox))
+
+    async def _sleep(self, mailbox: _Mailbox, seconds: float) -> None:
+        # a new mail may be of a higher lane, or a mail may have been
+        # throttled
+        mailbox.wakeup.clear()
+        try:
+            await asyncio.wait_for(mailbox.wakeup.wait(), timeout=seconds)
+        except TimeoutError:
+            pass
+
+    async def _run(self, mailbox: _Mailbox) -> None:
+        while mailbox.queue:
+            # drop mails whose sender gave up waiting
+            if mailbox.queue[0][-1].done():
+                heapq.heappop(mailbox.queue)
+                continue
+
+            # also waits out a pause, wherever it was started
+            delay = mailbox.budget.take()
+            if delay > 0:
+                await self._sleep(mailbox, delay)
+                continue
+
+            item = heapq.heappop(mailbox.queue)
+            priority, _, enqueued, *_, future = item
+            wait_seconds.observe(
+                time.monotonic() - enqueued, MailPriority(priority).name
+            )
+            self._sending.add(future)
+            task = asyncio.create_task(self._send(mailbox, item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, mailbox: _Mailbox, item: tuple) -> None:
+        priority, sequence, enqueued, deadline, attempts, send, future = item
+        try:
+            result = await send()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        finally:
+            self._sending.discard(future)
+
+        if result.status_code in THROTTLED_STATUS_CODES:
+            throttled_sends.inc(str(result.status_code))
+            mailbox.budget.throttled(result.retry_after)
+            retry = attempts < self.retries and not future.done()
+            if retry and time.monotonic() < deadline:
+                # keeps its place in the lane
+                self._enqueue(
+                    mailbox,
+                    (
+                        priority,
+                        sequence,
+                        enqueued,
+                        deadline,
+                        attempts + 1,
+                        send,
+                        future,
+                    ),
+                )
+                return
+        elif result.sent:
+            mailbox.budget.accepted()
+
+        if not future.done():
+            future.set_result(result)
+
+    def stats(self) -> dict[str, dict]:
+        """
+        State of every mailbox.
+
+        Returns:
+            (dict): By mailbox, the number of waiting mails of every lane,
+                    seconds left of a throttling pause, and the share of the
+                    configured rate in effect.
+        """
+        stats = {}
+        for name, mailbox in self._mailboxes.items():
+            paused_for, rate_factor = mailbox.budget.status()
+            stats[name] = {
+                "queued": {
+                    lane.name: sum(
+                        1
+                        for item in mailbox.queue
+                        if item[0] == lane and not item[-1].done()
+                    )
+                    for lane in MailPriority
+                },
+                "paused_for": paused_for,
+                "rate_factor": rate_factor,
+            }
+        return stats
+
+    async def stop(self) -> None:
+        """
+        Stops scheduling; waiting mails are cancelled, sent ones finish.
+        """
+        for mailbox in self._mailboxes.values():
+            if mailbox.runner is not None:
+                mailbox.runner.cancel()
+            for *_, future in mailbox.queue:
+                future.cancel()
+            mailbox.queue.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+send_scheduler = SendScheduler()
+
+
+def _queue_depth() -> dict[tuple, int]:
+    depth = {(lane.name,): 0 for lane in MailPriority}
+    for mailbox in send_scheduler.stats().values():
+        for lane, count in mailbox["queued"].items():
+            depth[(lane,)] += count
+    return depth
+
+
+Gauge(
+    "mail_scheduler_queue_depth",
+    "Mails waiting in the send scheduler, by priority.",
+    _queue_depth,
+    ("priority",),
+)
+Gauge(
+    "mail_scheduler_rate_factor",
+    "Share of the configured send rate in effect, by mailbox.",
+    lambda: {
+        (name,): mailbox["rate_factor"]
+        for name, mailbox in send_scheduler.stats().items()
+    },
+    ("mailbox",),
+)
@@ -1,8 +1,10 @@
+import base64
+import json
 import os
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
-import httpx
+from http_clients import files_client
 
 inter_communication_secret = os.getenv("INTER_COMMUNICATION_SECRET")
 
@@ -26,15 +28,14 @@ async def delete_file(filename) -> str:
     Raises:
         Exception: If the response is not successful
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "http://files/delete-file",
-            params={
-                "filename": filename,
-                "inter_communication_secret": inter_communication_secret,
-                "static_file": "true",
-            },
-        )
+    response = await files_client().post(
+        "/delete-file",
+        params={
+            "filename": filename,
+            "inter_communication_secret": inter_communication_secret,
+            "static_file": "true",
+        },
+    )
 
     if response.status_code != 200:
         raise Exception(response.text)
@@ -60,3 +61,38 @@ def get_curr_time_str() -> str:
         str: Current IST time as a formatted string
     """
     return datetime.now(ist).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def encode_cursor(*values) -> str:
+    """
+    Encodes the sort key of a document into an opaque pagination cursor.
+
+    Args:
+        *values: JSON serialisable values the results are ordered by.
+
+    Returns:
+        str: The cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    """
+    Decodes a cursor made by `encode_cursor` back into its values.
+
+    Args:
+        cursor (str): The cursor
+
+    Returns:
+        list: The values the cursor was made from
+
+    Raises:
+        ValueError: Invalid cursor
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("Invalid cursor") from None
+    if not isinstance(values, list) or not values:
+        raise ValueError("Invalid cursor")
+    return values
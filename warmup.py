@@ -0,0 +1,168 @@
+"""
+Warm-up Module.
+
+Pays the first-use costs of a fresh process before it is sent traffic: the
+Mongo connection pool is opened and pinged, the Graph token is optionally
+fetched, and a synthetic query is run through the schema so that parsing,
+validation and the resolver code paths are warm.
+
+Warm-up runs as a background task from the FastAPI lifespan in `main.py`;
+`/ready` answers 503 until it has finished, so the orchestrator only routes
+traffic to warm instances. Warm-up waits for Mongo to be reachable, while
+a failing token fetch or synthetic query is only logged. Missing constraint
+indexes of `indexes.py` are logged too: the mutations check for duplicates
+themselves until the indexes are in place.
+
+Attributes:
+    WARMUP_ENABLED (bool): Whether to warm up on startup, otherwise the
+                           service is ready right away. Defaults to True.
+    WARMUP_GRAPH_TOKEN (bool): Whether to fetch the Graph token during
+                               warm-up. Defaults to False.
+    WARMUP_QUERY (str): GraphQL query run through the schema, empty to skip
+                        it. Defaults to a `storagefiles` query.
+    WARMUP_RETRY_INTERVAL (float): Seconds between attempts to reach Mongo.
+                                   Defaults to 2.
+    readiness (Readiness): Whether this process is ready to serve.
+    router (APIRouter): The `/ready` route.
+"""
+
+import asyncio
+import logging
+import time
+from os import getenv
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from pymongo.errors import PyMongoError
+from strawberry import Schema
+
+from db import MONGO_MIN_POOL_SIZE, db
+from indexes import verify_constraints
+from mailing import token_manager
+from metrics import Gauge
+from otypes import Context
+
+WARMUP_ENABLED = getenv("WARMUP_ENABLED", "True").lower() in (
+    "true",
+    "1",
+    "t",
+)
+WARMUP_GRAPH_TOKEN = getenv("WARMUP_GRAPH_TOKEN", "False").lower() in (
+    "true",
+    "1",
+    "t",
+)
+WARMUP_QUERY = getenv(
+    "WARMUP_QUERY",
+    'query Warmup { storagefiles(filetype: "pdf") { _id title } }',
+)
+WARMUP_RETRY_INTERVAL = float(getenv("WARMUP_RETRY_INTERVAL", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """
+    Readiness of this process to serve traffic.
+
+    Attributes:
+        ready (bool): Whether warm-up has finished and the process is not
+                      shutting down.
+        warmup_seconds (float | None): Duration of the warm-up, None until
+                                       it has finished.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.warmup_seconds = None
+
+
+readiness = Readiness()
+Gauge(
+    "service_ready",
+    "Whether the service has warmed up and is ready to serve.",
+    lambda: int(readiness.ready),
+)
+
+
+async def warm_mongo() -> None:
+    """
+    Opens `MONGO_MIN_POOL_SIZE` connections, at least one, and pings Mongo.
+
+    Every concurrent ping checks out a connection of its own, so the pool
+    is filled up front instead of by the first requests.
+    """
+    connections = max(1, MONGO_MIN_POOL_SIZE)
+    await asyncio.gather(*(db.command("ping") for _ in range(connections)))
+
+
+async def check_constraints() -> None:
+    """
+    Checks whether the unique indexes writes rely on exist as declared.
+    """
+    try:
+        broken = await verify_constraints()
+    except PyMongoError as e:
+        logger.warning("Warm-up could not list the indexes: %s", e)
+        return
+    if broken:
+        logger.warning(
+            "Constraint indexes are not in place, writes check for "
+            "duplicates first: %s",
+            ", ".join(broken),
+        )
+
+
+async def warm_graph_token() -> None:
+    try:
+        await token_manager.get_token()
+    except Exception as e:
+        logger.warning("Warm-up could not fetch the Graph token: %s", e)
+
+
+async def warm_schema(schema: Schema) -> None:
+    result = await schema.execute(WARMUP_QUERY, context_value=Context())
+    if result.errors:
+        logger.warning("Warm-up query failed: %s", result.errors[0])
+
+
+async def warm_up(schema: Schema) -> None:
+    """
+    Warms up the process, then marks it ready.
+
+    Args:
+        schema (strawberry.Schema): The schema served by the application.
+    """
+    start = time.perf_counter()
+    while True:
+        try:
+            await warm_mongo()
+            break
+        except PyMongoError as e:
+            logger.warning("Warm-up could not reach Mongo: %s", e)
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+    await check_constraints()
+
+    if WARMUP_GRAPH_TOKEN:
+        await warm_graph_token()
+    if WARMUP_QUERY:
+        await warm_schema(schema)
+
+    readiness.warmup_seconds = time.perf_counter() - start
+    readiness.ready = True
+    logger.info("Warmed up in %.2fs", readiness.warmup_seconds)
+
+
+router = APIRouter()
+
+
+@router.get("/ready")
+async def ready() -> JSONResponse:
+    """
+    Answers 200 once the process is warm, 503 until then.
+    """
+    if not readiness.ready:
+        return JSONResponse({"ready": False}, status_code=503)
+    return JSONResponse(
+        {"ready": True, "warmup_seconds": readiness.warmup_seconds}
+    )